@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from cache import TTLCache
+from db import Database
+
+_MISSING = object()
+
+
+# Внешняя мидлварь апдейтов: запоминает, когда пользователь появлялся и какой у него
+# сейчас username, не обращаясь к базе на каждом апдейте. Кэш помнит username,
+# записанный (или ждущий записи) не дольше resolution секунд назад: пока он совпадает,
+# апдейт ничего не стоит. Иначе пользователь попадает в dirty, и раз в flush_interval
+# все изменения уходят в базу одной транзакцией (Database.record_activity).
+# Поэтому last_seen точен до resolution, а новый username появляется в базе
+# не позже чем через flush_interval - даже у тех, кто больше не нажимает /start
+class ActivityTracker(BaseMiddleware):
+    def __init__(
+        self,
+        db: Database,
+        flush_interval: float = 30,
+        resolution: float = 300,
+        cache_size: int = 100_000,
+    ):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.cache = TTLCache(cache_size, resolution)
+        self._dirty: Dict[int, Tuple[Optional[str], float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.recorded = 0
+        self.renamed = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is not None and self.cache.get(user.id, _MISSING) != user.username:
+            self.cache.set(user.id, user.username)
+            self._dirty[user.id] = (user.username, time.time())
+        return await handler(event, data)
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    # Записывает накопленные изменения; при ошибке они остаются до следующей попытки
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            renamed = await self.db.record_activity(
+                [(user_id, username, seen) for user_id, (username, seen) in dirty.items()]
+            )
+        except Exception:
+            logging.exception("Не удалось записать активность %d пользователей", len(dirty))
+            for user_id, entry in dirty.items():
+                self._dirty.setdefault(user_id, entry)
+            return
+        self.flushes += 1
+        self.recorded += len(dirty)
+        self.renamed += renamed
+        if renamed:
+            logging.info("Обновлены username у %d пользователей", renamed)
@@ -0,0 +1,192 @@
+import asyncio
+import glob
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+
+# Готовый снимок базы
+@dataclass(frozen=True)
+class Snapshot:
+    path: str
+    size: int
+    compressed_size: int
+    pages: int
+    restarts: int
+    seconds: float
+
+
+class _Restarted(Exception):
+    pass
+
+
+# Резервные копии базы через online backup API SQLite. Копирование идёт в отдельном
+# потоке по pages страниц за шаг с паузой step_pause между шагами: каждый шаг
+# держит чтение источника лишь на время копирования своих страниц, поэтому
+# обработчики с базой не ждут. Если базу меняет другое соединение, SQLite начинает
+# копирование заново; после max_restarts таких перезапусков снимок делается одним
+# шагом (в WAL это тоже не блокирует писателя, лишь дольше держит чтение).
+# Снимок сжимается gzip, проверяется восстановлением во временный файл с
+# PRAGMA integrity_check, в каталоге остаются keep последних снимков.
+class BackupManager:
+    def __init__(
+        self,
+        db_path: str,
+        directory: str,
+        keep: int = 7,
+        interval: float = 24 * 3600,
+        pages: int = 256,
+        step_pause: float = 0.005,
+        max_restarts: int = 3,
+    ):
+        self.db_path = db_path
+        self.directory = directory
+        self.keep = keep
+        self.interval = interval
+        self.pages = pages
+        self.step_pause = step_pause
+        self.max_restarts = max_restarts
+        self._stem = os.path.splitext(os.path.basename(db_path))[0]
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.last: Optional[Snapshot] = None
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def start(self) -> None:
+        self._pool = ThreadPoolExecutor(1, thread_name_prefix="db-backup")
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._pool:
+            # Начатый снимок дописывается до конца
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.backup()
+            except Exception:
+                logging.exception("Не удалось сделать резервную копию %s", self.db_path)
+
+    # Делает снимок; если снимок уже делается, дожидается его и делает следующий
+    async def backup(self) -> Snapshot:
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            snapshot = await loop.run_in_executor(self._pool, self._backup)
+        self.last = snapshot
+        logging.info(
+            "Резервная копия %s: %.1f МБ -> %.1f МБ за %.2f с (%d страниц, перезапусков: %d)",
+            snapshot.path, snapshot.size / 2 ** 20, snapshot.compressed_size / 2 ** 20,
+            snapshot.seconds, snapshot.pages, snapshot.restarts,
+        )
+        return snapshot
+
+    def snapshots(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.directory, f"{self._stem}-*.db.gz")))
+
+    def _backup(self) -> Snapshot:
+        started = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        name = f"{self._stem}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now * 1000) % 1000:03d}"
+        raw_path = os.path.join(self.directory, f".{name}.db")
+        path = os.path.join(self.directory, f"{name}.db.gz")
+        try:
+            pages, restarts = self._copy(raw_path)
+            size = os.path.getsize(raw_path)
+            with open(raw_path, "rb") as source, gzip.open(path + ".tmp", "wb", compresslevel=6) as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+            self._verify(path + ".tmp", raw_path)
+            os.replace(path + ".tmp", path)
+        finally:
+            for leftover in (raw_path, path + ".tmp"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        self._rotate()
+        return Snapshot(path, size, os.path.getsize(path), pages, restarts, time.perf_counter() - started)
+
+    # Копирует базу в path, возвращает (число страниц, число перезапусков)
+    def _copy(self, path: str) -> Tuple[int, int]:
+        source = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        source.execute("PRAGMA busy_timeout=5000")
+        try:
+            state = {"remaining": None, "total": 0, "restarts": 0}
+
+            def progress(status: int, remaining: int, total: int) -> None:
+                # Оставшихся страниц не стало меньше - источник изменили и копирование началось заново
+                if state["remaining"] is not None and remaining >= state["remaining"]:
+                    state["restarts"] += 1
+                    if state["restarts"] > self.max_restarts:
+                        raise _Restarted()
+                state["remaining"], state["total"] = remaining, total
+                # Пауза между шагами: sleep= у Connection.backup действует только при SQLITE_BUSY
+                if remaining:
+                    time.sleep(self.step_pause)
+
+            target = sqlite3.connect(path)
+            try:
+                try:
+                    source.backup(target, pages=self.pages, progress=progress)
+                except _Restarted:
+                    logging.warning(
+                        "База меняется быстрее, чем копируется (%d перезапусков), снимок одним шагом",
+                        state["restarts"],
+                    )
+                    source.backup(target, pages=-1)
+                    state["total"] = target.execute("PRAGMA page_count").fetchone()[0]
+                # Снимок - самостоятельный файл: без WAL, который у копии унаследован от источника
+                target.execute("PRAGMA journal_mode=DELETE")
+            finally:
+                target.close()
+            return state["total"], min(state["restarts"], self.max_restarts + 1)
+        finally:
+            source.close()
+
+    # Проверка восстановлением: распаковывает снимок во временный файл рядом,
+    # проверяет целостность и сверяет число пользователей с несжатой копией
+    def _verify(self, compressed_path: str, raw_path: str) -> None:
+        restored_path = compressed_path + ".restore"
+        try:
+            with gzip.open(compressed_path, "rb") as source, open(restored_path, "wb") as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+            restored = sqlite3.connect(f"file:{restored_path}?mode=ro", uri=True)
+            original = sqlite3.connect(f"file:{raw_path}?mode=ro", uri=True)
+            try:
+                result = restored.execute("PRAGMA integrity_check").fetchone()[0]
+                if result != "ok":
+                    raise RuntimeError(f"Снимок {compressed_path} повреждён: {result}")
+                count_sql = "SELECT COUNT(*) FROM users"
+                restored_users = restored.execute(count_sql).fetchone()[0]
+                original_users = original.execute(count_sql).fetchone()[0]
+                if restored_users != original_users:
+                    raise RuntimeError(
+                        f"Снимок {compressed_path}: {restored_users} пользователей вместо {original_users}"
+                    )
+            finally:
+                restored.close()
+                original.close()
+        finally:
+            if os.path.exists(restored_path):
+                os.remove(restored_path)
+
+    def _rotate(self) -> None:
+        for old in self.snapshots()[:-self.keep] if self.keep > 0 else []:
+            os.remove(old)
+            logging.info("Удалена старая резервная копия %s", old)
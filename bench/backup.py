@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from typing import List, Optional
+
+from backup import BackupManager
+from db import Database
+
+
+def _fill(conn: sqlite3.Connection, users: int) -> None:
+    conn.executemany(
+        "INSERT INTO users (user_id, username, discount) VALUES (?, ?, ?)",
+        ((user_id, f"user{user_id}", user_id % 50) for user_id in range(1, users + 1)),
+    )
+
+
+# Обычная нагрузка бота: чтения профиля и изменения скидки вперемешку.
+# Возвращает задержки операций, пока не выставлен stop
+async def load(db: Database, users: int, stop: asyncio.Event, latencies: List[float]) -> None:
+    user_id = 0
+    while not stop.is_set():
+        user_id = user_id % users + 1
+        started = time.perf_counter()
+        if user_id % 4:
+            await db.get_user(user_id * 7919 % users + 1)
+        else:
+            await db.adjust_discount(user_id, 0.01)
+        latencies.append(time.perf_counter() - started)
+
+
+# Насколько опаздывает event loop: таймер на 1 мс и его фактическая задержка
+async def loop_lag(stop: asyncio.Event, lags: List[float]) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - started - 0.001)
+
+
+def naive_backup(db_path: str, target: str) -> None:
+    source = sqlite3.connect(db_path)
+    dump = sqlite3.connect(target + ".db")
+    source.backup(dump)
+    dump.close()
+    source.close()
+    with open(target + ".db", "rb") as raw, gzip.open(target, "wb") as compressed:
+        shutil.copyfileobj(raw, compressed)
+    os.remove(target + ".db")
+
+
+def report(name: str, latencies: List[float], lags: List[float], extra: str = "") -> None:
+    latencies.sort()
+    print(
+        f"{name:<22} ops {len(latencies):6d}  p50 {latencies[len(latencies) // 2] * 1000:6.2f} ms  "
+        f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.2f} ms  max {latencies[-1] * 1000:7.2f} ms  "
+        f"loop lag max {max(lags) * 1000:7.2f} ms  {extra}"
+    )
+
+
+# Задержка операций с базой и отставание event loop в трёх режимах: без резервного
+# копирования, во время снимка BackupManager и во время "наивного" снимка прямо в
+# потоке event loop (backup одним шагом + gzip)
+async def run(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "users.db")
+        db = Database(db_path, write_behind=args.write_behind)
+        await db.connect()
+        await db.write(_fill, args.users)
+        size = os.path.getsize(db_path) / 2 ** 20
+        print(f"{args.users} users, {size:.1f} MB, pages per step {args.pages}, write_behind={args.write_behind}")
+        manager = BackupManager(db_path, os.path.join(tmpdir, "backups"), keep=2, interval=0, pages=args.pages)
+        await manager.start()
+
+        async def phase(name: str, action: Optional[str]) -> None:
+            stop = asyncio.Event()
+            latencies: List[float] = []
+            lags: List[float] = []
+            tasks = [asyncio.create_task(load(db, args.users, stop, latencies)) for _ in range(args.clients)]
+            tasks.append(asyncio.create_task(loop_lag(stop, lags)))
+            await asyncio.sleep(0.2)
+            extra = ""
+            started = time.perf_counter()
+            if action == "manager":
+                snapshot = await manager.backup()
+                extra = f"backup {snapshot.seconds:.2f} s, restarts {snapshot.restarts}"
+            elif action == "naive":
+                naive_backup(db_path, os.path.join(tmpdir, "naive.db.gz"))
+                extra = f"backup {time.perf_counter() - started:.2f} s"
+            else:
+                await asyncio.sleep(1.0)
+            stop.set()
+            await asyncio.gather(*tasks)
+            report(name, latencies, lags, extra)
+
+        await phase("no backup", None)
+        await phase("BackupManager", "manager")
+        await phase("naive, in event loop", "naive")
+        await manager.close()
+        await db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure database latency during online backups")
+    parser.add_argument("--users", type=int, default=200_000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--pages", type=int, default=256)
+    parser.add_argument("--write-behind", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+from bench.fake_bot_api import FakeBotAPI, FakeSession
+
+ADMIN_ID = 10 ** 9
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Доли видов апдейтов в синтетическом потоке
+MIX = {
+    "start": 0.25,
+    "profile": 0.30,
+    "catalog": 0.25,
+    "referral": 0.10,
+    "admin": 0.10,
+}
+
+
+class UpdateFactory:
+    def __init__(self, seed: int):
+        self.random = random.Random(seed)
+        self.update_id = 0
+        self.next_user_id = 1000
+        self.registered: List[int] = []
+        with open(os.path.join(ROOT, "catalog.json"), encoding="utf-8") as file:
+            self.pages = [page["button"] for page in json.load(file)["pages"]]
+
+    def _message(self, user_id: int, text: str) -> Update:
+        self.update_id += 1
+        return Update(update_id=self.update_id, message={
+            "message_id": self.update_id,
+            "date": datetime.now(),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}"},
+            "text": text,
+        })
+
+    def _known_user(self) -> int:
+        return self.random.choice(self.registered) if self.registered else 1
+
+    # Следующий апдейт: (вид, апдейт)
+    def make(self) -> Tuple[str, Update]:
+        kind = self.random.choices(list(MIX), weights=list(MIX.values()))[0]
+        if kind == "start" or not self.registered:
+            user_id = self.next_user_id
+            self.next_user_id += 1
+            payload = f" {self._known_user()}" if self.registered and self.random.random() < 0.8 else ""
+            self.registered.append(user_id)
+            return "start", self._message(user_id, f"/start{payload}")
+        if kind == "profile":
+            return kind, self._message(self._known_user(), "👤 My Profile")
+        if kind == "referral":
+            return kind, self._message(self._known_user(), "🎁 Referral System")
+        if kind == "catalog":
+            return kind, self._message(self._known_user(), self.random.choice(self.pages))
+        command = self.random.choice([
+            f"/user {self._known_user()}",
+            f"/userstat @user{self._known_user()}",
+            "/top_referrers",
+            "/sales",
+            "/users",
+        ])
+        return kind, self._message(ADMIN_ID, command)
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# Нагрузка на настоящий диспетчер из bot.py: синтетические апдейты подаются в
+# dp.feed_update из concurrency параллельных задач (или через полосы UpdateLanes
+# с --lanes N), ответы уходят в фейковую сессию
+# или в локальную заглушку Bot API. Троттлинг и лимиты очереди отправки отключены,
+# чтобы мерить сами обработчики
+async def run(args: argparse.Namespace) -> List[str]:
+    tmpdir = tempfile.mkdtemp()
+    os.environ.update({
+        "API_TOKEN": "42:BENCH",
+        "ADMIN_ID": str(ADMIN_ID),
+        "DB_PATH": os.path.join(tmpdir, "users.db"),
+        "METRICS_PORT": "0",
+        "UPDATE_WORKERS": str(args.lanes),
+    })
+    app = importlib.import_module("bot")
+    logging.getLogger().setLevel(args.log_level)
+
+    api = None
+    if args.api == "stub":
+        api = FakeBotAPI(global_limit=10 ** 9, chat_interval=0, latency=args.latency)
+        await api.start()
+        session = AiohttpSession(api=TelegramAPIServer.from_base(api.base_url))
+    else:
+        session = FakeSession(latency=args.latency)
+    session.middleware = app.bot.session.middleware
+    app.bot.session = session
+
+    from middlewares import RateLimit
+    app.throttling.limits = {key: RateLimit(burst=1e9, rate=1e9) for key in app.throttling.limits}
+    app.sender.rate = 1e6
+    app.sender.private_interval = app.sender.group_interval = 0
+
+    await app.dp.emit_startup()
+    factory = UpdateFactory(args.seed)
+    for _ in range(args.warmup):
+        await app.dp.feed_update(app.bot, factory.make()[1])
+    sql_before = {name: histogram.count for name, histogram in app.metrics.sql.items()}
+    api_before = {name: histogram.count for name, histogram in app.metrics.api.items()}
+    updates_before = Counter(app.metrics.updates)
+
+    stream = [factory.make() for _ in range(args.updates)]
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    # Апдейты одного пользователя, начатые до завершения его предыдущего апдейта
+    in_flight: Counter = Counter()
+    overlaps = 0
+
+    async def feed(kind: str, update: Update, queued_at: float) -> None:
+        nonlocal overlaps
+        user_id = update.message.from_user.id
+        overlaps += in_flight[user_id] > 0
+        in_flight[user_id] += 1
+        try:
+            await app.dp.feed_update(app.bot, update)
+        finally:
+            in_flight[user_id] -= 1
+        latencies[kind].append(time.perf_counter() - queued_at)
+
+    started = time.perf_counter()
+    if args.lanes:
+        # Латентность считается от постановки в очередь, то есть включает ожидание в полосе
+        kinds = {update.update_id: (kind, 0.0) for kind, update in stream}
+
+        async def process(update: Update) -> None:
+            kind, queued_at = kinds[update.update_id]
+            await feed(kind, update, queued_at)
+
+        app.lanes._process = process
+        for kind, update in stream:
+            kinds[update.update_id] = (kind, time.perf_counter())
+            await app.lanes.put(update)
+        while app.lanes.depth:
+            await asyncio.sleep(0.001)
+    else:
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in stream:
+            queue.put_nowait(item)
+
+        async def worker() -> None:
+            while not queue.empty():
+                kind, update = queue.get_nowait()
+                await feed(kind, update, time.perf_counter())
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    sql_ops = Counter({
+        name: histogram.count - sql_before.get(name, 0) for name, histogram in app.metrics.sql.items()
+    })
+    api_calls = Counter({
+        name: histogram.count - api_before.get(name, 0) for name, histogram in app.metrics.api.items()
+    })
+    outcomes = Counter(app.metrics.updates)
+    outcomes.subtract(updates_before)
+    cache = app.db.cache_stats()
+    lane_stats = app.lanes.stats() if app.lanes else None
+    await app.dp.emit_shutdown()
+    if api:
+        await session.close()
+        await api.stop()
+
+    everything = [value for values in latencies.values() for value in values]
+    lines = [
+        f"bot_load {datetime.now():%Y-%m-%d %H:%M:%S} revision {git_revision()}",
+        f"updates={args.updates} "
+        + (f"lanes={args.lanes} queue={lane_stats['capacity']}" if lane_stats else f"concurrency={args.concurrency}")
+        + f" api={args.api} latency={args.latency * 1000:g}ms seed={args.seed}",
+        f"throughput: {args.updates / elapsed:.0f} updates/s ({elapsed:.2f}s)",
+        f"latency: p50 {percentile(everything, 0.5) * 1000:.2f} ms, p99 {percentile(everything, 0.99) * 1000:.2f} ms, "
+        f"max {max(everything) * 1000:.2f} ms",
+    ]
+    for kind in MIX:
+        values = latencies.get(kind, [])
+        if values:
+            lines.append(
+                f"  {kind:<9} n={len(values):<6} p50 {percentile(values, 0.5) * 1000:7.2f} ms  "
+                f"p99 {percentile(values, 0.99) * 1000:7.2f} ms  mean {statistics.fmean(values) * 1000:7.2f} ms"
+            )
+    total_ops = sum(sql_ops.values())
+    lines.append(f"db ops: {total_ops} ({total_ops / args.updates:.2f} per update)")
+    for name, count in sql_ops.most_common():
+        if count:
+            lines.append(f"  {name:<24} {count}")
+    lines.append(f"api calls: {sum(api_calls.values())} " + ", ".join(
+        f"{name}={count}" for name, count in api_calls.most_common() if count
+    ))
+    lines.append(f"outcomes: {dict(+outcomes)}")
+    lines.append(f"same-user overlaps: {overlaps}")
+    if lane_stats:
+        lines.append(f"polling stalls: {lane_stats['stalls']}")
+    lines.append(f"user cache: hit rate {cache['hit_rate'] or 0:.1%}, size {cache['size']}")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load benchmark for the bot dispatcher with synthetic updates")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--lanes", type=int, default=0,
+                        help="feed updates through UpdateLanes with this many workers instead of --concurrency tasks")
+    parser.add_argument("--api", choices=["fake", "stub"], default="fake",
+                        help="in-process fake session or local HTTP stub (bench.fake_bot_api)")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated Bot API latency, seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", default=os.path.join(ROOT, "bench_output.txt"))
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    print("\n".join(report))
+    with open(args.output, "w", encoding="utf-8") as file:
+        file.write("\n".join(report) + "\n")
@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from bench.fake_bot_api import FakeBotAPI
+from broadcast import Broadcaster
+from db import Database
+from sender import MessageScheduler
+
+ADMIN_CHAT_ID = 10 ** 9
+
+
+# Нагрузочный тест /broadcast против локальной заглушки Bot API:
+# рассылка прерывается "перезапуском" посередине и продолжается с контрольной точки.
+# Возвращает число получателей, которым сообщение пришло повторно
+async def run(users: int, rate: float, interrupt_after: float, blocked_every: int) -> int:
+    api = FakeBotAPI(global_limit=int(rate), blocked_every=blocked_every)
+    await api.start()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(os.path.join(tmpdir, "users.db"))
+        await db.connect()
+        await db.write(lambda conn: conn.executemany(
+            "INSERT INTO users (user_id, username) VALUES (?, ?)", [(i, f"user{i}") for i in range(1, users + 1)]
+        ))
+
+        session = AiohttpSession(api=TelegramAPIServer.from_base(api.base_url))
+        bot = Bot("42:FAKE", session=session)
+        started = time.monotonic()
+
+        sender = MessageScheduler(bot, rate=rate)
+        await sender.start()
+        broadcaster = Broadcaster(bot, db, sender, progress_interval=1.0)
+        broadcast = await broadcaster.start("<b>Popypara</b> is back in stock!", ADMIN_CHAT_ID)
+        await asyncio.sleep(interrupt_after)
+
+        # Имитация перезапуска бота
+        await broadcaster.close()
+        await sender.close()
+        checkpoint = await db.get_broadcast(broadcast.id)
+        print(f"interrupted at user_id={checkpoint.last_user_id}, sent={checkpoint.sent}")
+
+        sender = MessageScheduler(bot, rate=rate)
+        await sender.start()
+        broadcaster = Broadcaster(bot, db, sender, progress_interval=1.0)
+        await broadcaster.resume()
+        while broadcaster.active:
+            await asyncio.sleep(0.2)
+        elapsed = time.monotonic() - started
+
+        result = await db.get_broadcast(broadcast.id)
+        duplicates = sum(1 for chat_id, n in api.delivered.items() if n > 1 and int(chat_id) != ADMIN_CHAT_ID)
+        blocked = await db.read(lambda conn: conn.execute("SELECT COUNT(*) FROM users WHERE blocked = 1").fetchone()[0])
+        print(f"status={result.status} sent={result.sent} blocked={result.blocked} failed={result.failed}")
+        print(f"elapsed={elapsed:.1f}s throughput={result.sent / elapsed:.1f} msg/s (limit {rate:g}/s)")
+        print(f"server: {api.stats()}")
+        print(f"duplicate deliveries={duplicates} users marked blocked={blocked}")
+        print(f"scheduler: {sender.stats()}")
+
+        await sender.close()
+        await session.close()
+        await db.close()
+    await api.stop()
+    return duplicates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for /broadcast against a fake Bot API")
+    parser.add_argument("--users", type=int, default=600)
+    parser.add_argument("--rate", type=float, default=30)
+    parser.add_argument("--interrupt-after", type=float, default=5)
+    parser.add_argument("--blocked-every", type=int, default=17)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    duplicates = asyncio.run(run(args.users, args.rate, args.interrupt_after, args.blocked_every))
+    if duplicates:
+        sys.exit(f"FAILED: {duplicates} users received the broadcast more than once")
@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import logging
+import time
+
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import Update
+
+from buttons import ButtonRouter
+
+
+# Микробенчмарк диспетчеризации кнопок: цепочка фильтров F.text == "..."
+# против одного словаря ButtonRouter при разном числе кнопок.
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+def filter_chain(texts):
+    dp = Dispatcher()
+    for text in texts:
+        dp.message(F.text == text)(_noop)
+    dp.message()(_noop)
+    return dp
+
+
+def button_router(texts):
+    dp = Dispatcher()
+    buttons = ButtonRouter()
+    for text in texts:
+        buttons.on(text)(_noop)
+
+    async def handle_button(message, button_handler):
+        return await button_handler(message)
+
+    dp.message(buttons.filter)(handle_button)
+    dp.message()(_noop)
+    return dp
+
+
+def make_update(text):
+    return Update(
+        update_id=1,
+        message={
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+            "text": text,
+        },
+    )
+
+
+async def measure(dp, bot, update, iterations):
+    for _ in range(100):
+        await dp.feed_update(bot, update)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await dp.feed_update(bot, update)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+async def run(sizes, iterations):
+    bot = Bot("42:BENCH")
+    print(f"{'buttons':>8} {'case':>10} {'filter chain, us':>17} {'ButtonRouter, us':>17}")
+    for size in sizes:
+        texts = [f"Button {i}" for i in range(size)]
+        chain, router = filter_chain(texts), button_router(texts)
+        for case, text in (("last", texts[-1]), ("unmatched", "random text")):
+            update = make_update(text)
+            chain_us = await measure(chain, bot, update, iterations)
+            router_us = await measure(router, bot, update, iterations)
+            print(f"{size:>8} {case:>10} {chain_us:>17.1f} {router_us:>17.1f}")
+    await bot.session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Button dispatch micro-benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 15, 50, 200])
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args.sizes, args.iterations))
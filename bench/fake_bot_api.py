@@ -0,0 +1,194 @@
+import asyncio
+import json
+import time
+from collections import Counter, defaultdict, deque
+from typing import Any, AsyncGenerator, Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetMe, TelegramMethod
+from aiohttp import web
+
+
+# Локальная заглушка Telegram Bot API для нагрузочных тестов.
+# Отвечает на любые методы правдоподобными объектами и, как настоящий сервер,
+# возвращает 429 с retry_after при превышении общего лимита или лимита на чат
+# и 403 для "заблокировавших бота" пользователей.
+class FakeBotAPI:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        global_limit: int = 30,
+        chat_interval: float = 1.0,
+        latency: float = 0.02,
+        blocked_every: int = 0,
+        url_fetch_latency: float = 0.0,
+    ):
+        self.host = host
+        self.port = port
+        self.global_limit = global_limit
+        self.chat_interval = chat_interval
+        self.latency = latency
+        self.blocked_every = blocked_every
+        self.url_fetch_latency = url_fetch_latency
+        self.calls: Counter = Counter()
+        self.flood_errors = 0
+        self.delivered: Dict[Any, int] = defaultdict(int)
+        self.per_second: Counter = Counter()
+        self._recent: deque = deque()
+        self._last_chat_send: Dict[Any, float] = {}
+        self._message_id = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    def _flood(self, retry_after: int) -> web.Response:
+        self.flood_errors += 1
+        return web.json_response(
+            {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            },
+            status=429,
+        )
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            return web.json_response(
+                {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}}
+            )
+        if not method.startswith("send"):
+            if method == "editMessageText":
+                return web.json_response({"ok": True, "result": self._message(data)})
+            return web.json_response({"ok": True, "result": True})
+
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] > 1:
+            self._recent.popleft()
+        if len(self._recent) >= self.global_limit:
+            return self._flood(1)
+        chat_id = data.get("chat_id")
+        if now - self._last_chat_send.get(chat_id, -1e9) < self.chat_interval:
+            return self._flood(1)
+        if self.blocked_every and chat_id and int(chat_id) % self.blocked_every == 0:
+            return web.json_response(
+                {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"},
+                status=403,
+            )
+
+        # Фото по URL Telegram сначала скачивает сам - имитируем эту задержку
+        photo = data.get("photo")
+        if self.url_fetch_latency and isinstance(photo, str) and photo.startswith("http"):
+            await asyncio.sleep(self.url_fetch_latency)
+
+        self._recent.append(now)
+        self._last_chat_send[chat_id] = now
+        self.delivered[chat_id] += 1
+        self.per_second[int(now)] += 1
+        return web.json_response({"ok": True, "result": self._message(data)})
+
+    def _message(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        self._message_id += 1
+        chat_id = int(data.get("chat_id") or 0)
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "text": data.get("text", ""),
+        }
+        if "photo" in data:
+            message["photo"] = [
+                {"file_id": f"fake-photo-{self._message_id}", "file_unique_id": "fake", "width": 1, "height": 1}
+            ]
+        if "document" in data:
+            message["document"] = {"file_id": f"fake-doc-{self._message_id}", "file_unique_id": "fake"}
+        return message
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": dict(self.calls),
+            "flood_errors": self.flood_errors,
+            "peak_per_second": max(self.per_second.values(), default=0),
+        }
+
+
+# Сессия бота без сети: отвечает на методы сразу, без лимитов, и считает вызовы.
+# Для бенчмарков, где нужна стоимость самого бота, а не HTTP
+class FakeSession(BaseSession):
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_id = 0
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        name = type(method).__name__
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, GetMe):
+            result: Any = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif name.startswith("Send") or name == "EditMessageText":
+            self._message_id += 1
+            chat_id = int(getattr(method, "chat_id", 0) or 0)
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+                "text": getattr(method, "text", None) or "",
+            }
+            if name == "SendPhoto":
+                result["photo"] = [
+                    {"file_id": f"fake-photo-{self._message_id}", "file_unique_id": "fake", "width": 1, "height": 1}
+                ]
+        else:
+            result = True
+        return method.build_response({"ok": True, "result": result}).result
+
+    async def stream_content(
+        self, url: str, timeout: int, chunk_size: int, raise_for_status: bool
+    ) -> AsyncGenerator[bytes, None]:
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+if __name__ == "__main__":
+    # Запуск заглушки как отдельного сервера: python -m bench.fake_bot_api
+    async def _serve() -> None:
+        api = FakeBotAPI(port=8081)
+        await api.start()
+        print(f"Fake Bot API on {api.base_url}")
+        try:
+            while True:
+                await asyncio.sleep(10)
+                print(json.dumps(api.stats()))
+        finally:
+            await api.stop()
+
+    asyncio.run(_serve())
@@ -0,0 +1,66 @@
+import argparse
+import logging
+import os
+import time
+
+from logging_setup import setup_logging
+
+
+def reset_root() -> None:
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
+
+def fail() -> None:
+    raise ValueError("boom")
+
+
+# Время, которое вызывающий поток (в боте - event loop) тратит на вызовы логгера
+def measure(count: int) -> tuple:
+    started = time.perf_counter()
+    for i in range(count):
+        logging.info("Пользователь %s пришел по реферальной ссылке от %s", i, i // 2)
+    info = (time.perf_counter() - started) / count
+    started = time.perf_counter()
+    for i in range(count // 10):
+        try:
+            fail()
+        except ValueError as e:
+            logging.error("Ошибка при обработке апдейта %s: %s", i, e, exc_info=e, extra={"update": {"update_id": i}})
+    error = (time.perf_counter() - started) / (count // 10)
+    return info, error
+
+
+# Старый вариант (basicConfig: StreamHandler прямо в потоке вызова) против очереди
+# с записью в отдельном потоке: JSON и текст, с ограничением частоты INFO и без
+def main(count: int, target: str) -> None:
+    print(f"{count} info + {count // 10} error calls, output to {target}")
+    print(f"{'setup':<28}{'info us/call':>14}{'error us/call':>15}{'drain ms':>10}")
+    with open(target, "w", encoding="utf-8") as stream:
+        for name, json_format, info_rate in (
+            ("queue json, rate 10/s", True, 10),
+            ("queue json, no rate limit", True, 0),
+            ("queue text, no rate limit", False, 0),
+        ):
+            listener = setup_logging("INFO", json_format=json_format, info_rate=info_rate, stream=stream)
+            info, error = measure(count)
+            started = time.perf_counter()
+            listener.stop()
+            drain = time.perf_counter() - started
+            reset_root()
+            print(f"{name:<28}{info * 1e6:>14.2f}{error * 1e6:>15.2f}{drain * 1e3:>10.1f}")
+
+        logging.basicConfig(level=logging.INFO, stream=stream)
+        info, error = measure(count)
+        reset_root()
+        print(f"{'basicConfig (sync)':<28}{info * 1e6:>14.2f}{error * 1e6:>15.2f}{'-':>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure logging cost on the calling thread")
+    parser.add_argument("--count", type=int, default=50000)
+    parser.add_argument("--target", default=os.devnull, help="file the log is written to")
+    args = parser.parse_args()
+    main(args.count, args.target)
@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from bench.fake_bot_api import FakeBotAPI
+from db import Database
+from media import MediaRegistry
+
+PHOTO_URL = "https://i.imgur.com/lnr4Z0M.jpeg"
+
+
+# Задержка приветственного фото /start: отправка по URL каждый раз
+# против повторного использования file_id из MediaRegistry.
+# Заглушка Bot API имитирует время, за которое Telegram скачивает фото по URL.
+async def run(requests: int, fetch_latency: float) -> None:
+    api = FakeBotAPI(latency=0.01, url_fetch_latency=fetch_latency, global_limit=10 ** 6, chat_interval=0)
+    await api.start()
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api.base_url))
+    bot = Bot("42:FAKE", session=session)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(os.path.join(tmpdir, "users.db"))
+        await db.connect()
+        media = MediaRegistry(bot, db)
+        media.register("welcome", PHOTO_URL)
+        await media.load()
+
+        results = {}
+        for name, send in (
+            ("photo by URL", lambda chat_id: bot.send_photo(chat_id, PHOTO_URL)),
+            ("MediaRegistry", lambda chat_id: media.send("welcome", chat_id)),
+        ):
+            latencies = []
+            for chat_id in range(1, requests + 1):
+                started = time.perf_counter()
+                await send(chat_id)
+                latencies.append((time.perf_counter() - started) * 1000)
+            results[name] = latencies
+
+        for name, latencies in results.items():
+            latencies.sort()
+            print(
+                f"{name:>14}: mean {statistics.mean(latencies):6.1f} ms, "
+                f"p50 {latencies[len(latencies) // 2]:6.1f} ms, p99 {latencies[int(len(latencies) * 0.99)]:6.1f} ms"
+            )
+        print(f"registry: uploads={media.uploads} reuses={media.reuses}")
+        await db.close()
+
+    await session.close()
+    await api.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/start welcome photo latency benchmark")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--fetch-latency", type=float, default=0.25, help="simulated URL fetch time, s")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args.requests, args.fetch_latency))
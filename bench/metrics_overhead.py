@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import time
+from datetime import datetime
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message, Update
+
+from metrics import HandlerMetricsMiddleware, Histogram, Metrics, UpdateMetricsMiddleware
+
+
+def make_update(update_id: int) -> Update:
+    return Update(update_id=update_id, message={
+        "message_id": update_id,
+        "date": datetime.now(),
+        "chat": {"id": update_id % 1000, "type": "private"},
+        "from": {"id": update_id % 1000, "is_bot": False, "first_name": "User"},
+        "text": "👤 My Profile",
+    })
+
+
+def make_dispatcher(metrics: Metrics = None) -> Dispatcher:
+    dp = Dispatcher()
+    if metrics:
+        dp.update.outer_middleware(UpdateMetricsMiddleware(metrics))
+        dp.message.middleware(HandlerMetricsMiddleware(metrics))
+
+    @dp.message()
+    async def handle_profile(message: Message):
+        return None
+
+    return dp
+
+
+async def feed(dp: Dispatcher, bot: Bot, updates) -> float:
+    started = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    return time.perf_counter() - started
+
+
+# Стоимость метрик: один и тот же поток апдейтов через диспетчер без мидлварей метрик и с ними.
+# Обработчик пустой, поэтому разница - это чистые накладные расходы измерений
+async def main(count: int, rounds: int) -> None:
+    bot = Bot("42:TEST")
+    updates = [make_update(i) for i in range(count)]
+    metrics = Metrics()
+    plain, measured = make_dispatcher(), make_dispatcher(metrics)
+    await feed(plain, bot, updates[:1000])
+    await feed(measured, bot, updates[:1000])
+
+    best_plain = best_measured = float("inf")
+    for _ in range(rounds):
+        best_plain = min(best_plain, await feed(plain, bot, updates))
+        best_measured = min(best_measured, await feed(measured, bot, updates))
+    per_plain = best_plain / count * 1e6
+    per_measured = best_measured / count * 1e6
+    print(f"{count} updates x {rounds} rounds (best round)")
+    print(f"without metrics: {per_plain:7.2f} us/update")
+    print(f"with metrics:    {per_measured:7.2f} us/update")
+    print(f"overhead:        {per_measured - per_plain:7.2f} us/update ({per_measured / per_plain - 1:.1%})")
+
+    histogram = Histogram()
+    started = time.perf_counter()
+    for i in range(count):
+        histogram.observe(i * 1e-6)
+    print(f"Histogram.observe: {(time.perf_counter() - started) / count * 1e9:.0f} ns")
+    await bot.session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure metrics middleware overhead")
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.updates, args.rounds))
@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import List
+
+from db import Database
+
+REFERRER_ID = 1
+# Второй реферер получает меньше 25 рефералов, и его скидка не упирается в потолок 50%
+SMALL_REFERRER_ID = 2
+DISCOUNT_STEP = 2
+DISCOUNT_CAP = 50
+
+
+def expected_discounts(referrals: int) -> List[float]:
+    return [min(DISCOUNT_STEP * n, DISCOUNT_CAP) for n in range(1, referrals + 1)]
+
+
+# Стресс-тест регистрации: много одновременных /start по ссылкам двух рефереров,
+# каждый новый пользователь приходит несколько раз. Счётчики рефералов и скидки
+# должны получиться точными. Скидки, возвращённые в уведомлениях, проверяются
+# целиком (2, 4, ..., 50, 50, ...): потерянное или двойное начисление видно,
+# даже когда итоговая скидка упирается в потолок
+async def run(users: int, small_users: int, repeats: int) -> bool:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(os.path.join(tmpdir, "users.db"))
+        await db.connect()
+        await db.add_user(REFERRER_ID, "referrer")
+        await db.add_user(SMALL_REFERRER_ID, "small_referrer")
+
+        invitees = [(user_id, REFERRER_ID) for user_id in range(10, users + 10)]
+        invitees += [(user_id, SMALL_REFERRER_ID) for user_id in range(users + 10, users + small_users + 10)]
+        calls = [
+            db.add_user(user_id, f"user{user_id}", referrer_id)
+            for _ in range(repeats)
+            for user_id, referrer_id in invitees
+        ]
+        started = time.perf_counter()
+        results = await asyncio.gather(*calls)
+        elapsed = time.perf_counter() - started
+        print(f"{len(calls)} concurrent add_user calls in {elapsed:.2f}s ({len(calls) / elapsed:.0f}/s)")
+
+        ok = True
+        for referrer_id, count in ((REFERRER_ID, users), (SMALL_REFERRER_ID, small_users)):
+            referrer = await db.get_user(referrer_id)
+            invited = len(await db.get_invited(referrer_id))
+            discounts = sorted(result[1] for result in results if result and result[0] == referrer_id)
+            expected = expected_discounts(count)
+            referrer_ok = (
+                referrer.referrals_count == count
+                and invited == count
+                and discounts == expected
+                and referrer.discount == (expected[-1] if expected else 0)
+            )
+            ok = ok and referrer_ok
+            print(
+                f"referrer {referrer_id}: referrals_count={referrer.referrals_count} invited={invited} "
+                f"notifications={len(discounts)} discount={referrer.discount} (expected {count}, "
+                f"{expected[-1] if expected else 0}), discount trajectory {'exact' if discounts == expected else 'WRONG'}"
+            )
+        await db.close()
+        return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent referral registration stress test")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--small-users", type=int, default=20, help="referrals of the second referrer (keep below 25)")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    ok = asyncio.run(run(args.users, args.small_users, args.repeats))
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import cProfile
+import importlib
+import logging
+import os
+import pstats
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, List, Tuple
+
+from aiogram.types import Update
+
+from bench.bot_load import ROOT, git_revision
+from bench.fake_bot_api import FakeSession
+from migrations import migrate
+from recorder import RECORDED_ADMIN_ID, Anonymizer, read_recording
+
+# Токен бота при воспроизведении: его id входит в ключи состояний FSM
+REPLAY_BOT_ID = 42
+
+# Колонки с id пользователей, которые в копии базы заменяются анонимными
+ID_COLUMNS = {
+    "users": ("user_id", "referrer_id"),
+    "referral_stats": ("user_id",),
+    "purchases": ("user_id", "referrer_id"),
+    "user_sales": ("user_id",),
+    "user_activity": ("user_id",),
+    "broadcasts": ("admin_chat_id",),
+}
+
+
+# Копия базы через backup API (можно делать с работающей базы) с теми же анонимными
+# id и username, что в записи: иначе апдейты ссылались бы на несуществующих пользователей
+def prepare_database(source: str, target: str, anonymizer: Anonymizer) -> None:
+    original, copy = sqlite3.connect(f"file:{source}?mode=ro", uri=True), sqlite3.connect(target)
+    try:
+        original.backup(copy)
+    finally:
+        original.close()
+        copy.close()
+    conn = sqlite3.connect(target, isolation_level=None)
+    try:
+        migrate(conn)
+        conn.create_function("anon_id", 1, anonymizer.user_id, deterministic=True)
+        conn.create_function("anon_username", 1, anonymizer.username, deterministic=True)
+        conn.execute("BEGIN IMMEDIATE")
+        # Журнал покупок защищён от изменений триггером - снимаем его на время замены
+        trigger = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'purchases_no_update'"
+        ).fetchone()
+        conn.execute("DROP TRIGGER IF EXISTS purchases_no_update")
+        for table, columns in ID_COLUMNS.items():
+            assignments = ", ".join(f"{column} = anon_id({column})" for column in columns)
+            conn.execute(f"UPDATE {table} SET {assignments}")
+        conn.execute("UPDATE users SET username = anon_username(username) WHERE username IS NOT NULL")
+        if trigger:
+            conn.execute(trigger[0])
+        # Индекс /find ссылается на строки users по user_id, а триггер смены username удалял
+        # из индекса строки уже по новому id - строим индекс заново по анонимной таблице
+        conn.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+        # Ключ FSM - "bot_id:chat_id:user_id:destiny"
+        states = conn.execute("SELECT key FROM fsm_states").fetchall()
+        for (key,) in states:
+            _, chat_id, user_id, destiny = key.split(":", 3)
+            conn.execute(
+                "UPDATE fsm_states SET key = ? WHERE key = ?",
+                (f"{REPLAY_BOT_ID}:{anonymizer.user_id(int(chat_id))}:{anonymizer.user_id(int(user_id))}:{destiny}",
+                 key),
+            )
+        # Незавершённые рассылки не возобновляются: их курсор - порядок настоящих id
+        conn.execute("UPDATE broadcasts SET status = 'cancelled' WHERE status = 'running'")
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def load_recording(paths: List[str]) -> List[Tuple[float, Update]]:
+    return [(received_at, Update(**data)) for received_at, data in read_recording(paths)]
+
+
+def _table(title: str, rows: List[Tuple[str, Any]], total: float) -> List[str]:
+    lines = [f"{title}: {'n':>7} {'total s':>9} {'share':>6} {'mean ms':>9} {'p50 ms':>8} {'p99 ms':>8}"]
+    for name, histogram in sorted(rows, key=lambda row: -row[1].sum):
+        if histogram.count:
+            lines.append(
+                f"  {name:<28} {histogram.count:>7} {histogram.sum:>9.3f} {histogram.sum / total if total else 0:>6.1%} "
+                f"{histogram.mean * 1000:>9.3f} {histogram.quantile(0.5) * 1000:>8.3f} "
+                f"{histogram.quantile(0.99) * 1000:>8.3f}"
+            )
+    return lines
+
+
+# Воспроизведение записи RECORD_UPDATES через настоящий диспетчер из bot.py на анонимной
+# копии базы и фейковой сессии Bot API: либо как можно быстрее, либо с исходными
+# интервалами между апдейтами (ускоренными в --speed раз). Event loop профилируется
+# cProfile, профиль сохраняется в --profile (snakeviz, flameprof, gprof2dot);
+# запросы к базе идут в потоках базы и видны в профиле как ожидание, их время - в отчёте
+async def run(args: argparse.Namespace) -> List[str]:
+    tmpdir = tempfile.mkdtemp()
+    db_path = os.path.join(tmpdir, "users.db")
+    anonymizer = Anonymizer(args.secret, admin_ids=args.admin_id)
+    started = time.perf_counter()
+    prepare_database(args.db, db_path, anonymizer)
+    prepared = time.perf_counter() - started
+    recording = load_recording(args.recording)
+    if not recording:
+        raise SystemExit("В записи нет апдейтов")
+
+    os.environ.update({
+        "API_TOKEN": f"{REPLAY_BOT_ID}:REPLAY",
+        "ADMIN_ID": str(RECORDED_ADMIN_ID),
+        "DB_PATH": db_path,
+        "METRICS_PORT": "0",
+        "BACKUP_DIR": os.path.join(tmpdir, "backups"),
+        "BACKUP_INTERVAL_HOURS": "0",
+        "RECORD_UPDATES": "0",
+        "UPDATE_WORKERS": str(args.lanes),
+    })
+    app = importlib.import_module("bot")
+    logging.getLogger().setLevel(args.log_level)
+    session = FakeSession(latency=args.latency)
+    session.middleware = app.bot.session.middleware
+    app.bot.session = session
+    if not args.keep_limits:
+        from middlewares import RateLimit
+        app.throttling.limits = {key: RateLimit(burst=1e9, rate=1e9) for key in app.throttling.limits}
+        app.sender.rate = 1e6
+        app.sender.private_interval = app.sender.group_interval = 0
+
+    await app.dp.emit_startup()
+    sql_before = {name: (histogram.count, histogram.sum) for name, histogram in app.metrics.sql.items()}
+    tasks = set()
+
+    async def feed(update: Update) -> None:
+        if app.lanes:
+            await app.lanes.put(update)
+        else:
+            # Как dp.start_polling: каждый апдейт в своей задаче
+            task = asyncio.create_task(app.dp.feed_update(app.bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    profiler = cProfile.Profile()
+    first_at = recording[0][0]
+    lag = 0.0
+    profiler.enable()
+    started = time.perf_counter()
+    for received_at, update in recording:
+        if args.timing == "original":
+            delay = started + (received_at - first_at) / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lag = max(lag, -delay)
+        await feed(update)
+    while (app.lanes and app.lanes.depth) or tasks:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - started
+    profiler.disable()
+
+    handlers = dict(app.metrics.handlers)
+    handler_total = sum(histogram.sum for histogram in handlers.values())
+    sql_ops = Counter({
+        name: histogram.count - sql_before.get(name, (0, 0))[0] for name, histogram in app.metrics.sql.items()
+    })
+    sql_time = {
+        name: histogram.sum - sql_before.get(name, (0, 0.0))[1] for name, histogram in app.metrics.sql.items()
+    }
+    outcomes = Counter(app.metrics.updates)
+    await app.dp.emit_shutdown()
+
+    recorded_span = recording[-1][0] - first_at
+    lines = [
+        f"replay {datetime.now():%Y-%m-%d %H:%M:%S} revision {git_revision()}",
+        f"updates={len(recording)} recorded over {recorded_span:.1f}s timing={args.timing}"
+        + (f" speed={args.speed:g}" if args.timing == "original" else "")
+        + f" lanes={args.lanes} latency={args.latency * 1000:g}ms limits={'on' if args.keep_limits else 'off'}",
+        f"database copy prepared in {prepared:.2f}s",
+        f"replayed in {elapsed:.2f}s: {len(recording) / elapsed:.0f} updates/s"
+        + (f", max feed lag {lag * 1000:.1f} ms" if args.timing == "original" else ""),
+    ]
+    lines += _table("handlers", list(handlers.items()), handler_total)
+    total_sql = sum(sql_ops.values())
+    lines.append(f"db ops: {total_sql} ({total_sql / len(recording):.2f} per update), "
+                 f"{sum(sql_time.values()):.3f}s in database threads")
+    for name, count in sql_ops.most_common(args.top):
+        if count:
+            lines.append(f"  {name:<28} {count:>7} {sql_time[name]:>9.3f}s")
+    lines.append(f"api calls: {sum(session.calls.values())} " + ", ".join(
+        f"{name}={count}" for name, count in session.calls.most_common()
+    ))
+    lines.append(f"outcomes: {dict(outcomes)}")
+
+    profiler.dump_stats(args.profile)
+    lines.append(f"event loop profile: {args.profile} (snakeviz / flameprof {args.profile})")
+    stats = pstats.Stats(profiler)
+    stats.sort_stats(pstats.SortKey.TIME)
+    lines.append("top functions by own time:")
+    for (filename, line, function), (_, calls, own, cumulative, _) in sorted(
+        stats.stats.items(), key=lambda item: -item[1][2]
+    )[:args.top]:
+        location = os.path.relpath(filename, ROOT) if filename.startswith(ROOT) else os.path.basename(filename)
+        lines.append(f"  {own:>8.3f}s {cumulative:>8.3f}s {calls:>8}  {function} ({location}:{line})")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded updates (RECORD_UPDATES=1) through the bot dispatcher")
+    parser.add_argument("recording", nargs="+", help="recorded .jsonl.gz files or recording directories")
+    parser.add_argument("--db", default=os.path.join(ROOT, "users.db"), help="database to copy (never modified)")
+    parser.add_argument("--secret", default=os.getenv("RECORD_SECRET"),
+                        help="RECORD_SECRET the recording was made with (default: $RECORD_SECRET)")
+    parser.add_argument("--admin-id", type=int, action="append", default=[],
+                        help="real ADMIN_ID, so that the admin row in the copy becomes the replay admin")
+    parser.add_argument("--timing", choices=["fast", "original"], default="fast")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed-up factor for --timing original")
+    parser.add_argument("--lanes", type=int, default=64, help="UPDATE_WORKERS for the replay (0 - task per update)")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated Bot API latency, seconds")
+    parser.add_argument("--keep-limits", action="store_true", help="keep throttling and send rate limits")
+    parser.add_argument("--profile", default=os.path.join(ROOT, "replay.prof"))
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", default=os.path.join(ROOT, "replay_output.txt"))
+    args = parser.parse_args()
+    if not args.secret:
+        parser.error("--secret or RECORD_SECRET is required")
+    if not args.admin_id and os.getenv("ADMIN_ID"):
+        args.admin_id = [int(os.getenv("ADMIN_ID"))]
+    report = asyncio.run(run(args))
+    print("\n".join(report))
+    with open(args.output, "w", encoding="utf-8") as file:
+        file.write("\n".join(report) + "\n")
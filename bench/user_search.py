@@ -0,0 +1,102 @@
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import string
+import tempfile
+import time
+from typing import Callable, List
+
+from db import _search_users
+from migrations import migrate
+
+SYLLABLES = ["an", "ar", "el", "ka", "li", "mo", "na", "ri", "sa", "ta", "vi", "zo", "dex", "max", "kin", "lee"]
+
+
+def make_username(rng: random.Random) -> str:
+    name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    if rng.random() < 0.5:
+        name += rng.choice(["_", ""]) + str(rng.randint(1, 9999))
+    return name.capitalize() if rng.random() < 0.3 else name
+
+
+def like_scan(conn: sqlite3.Connection, fragment: str, limit: int) -> list:
+    return conn.execute(
+        "SELECT user_id, username FROM users WHERE username LIKE ? ORDER BY length(username) LIMIT ?",
+        (f"%{fragment}%", limit),
+    ).fetchall()
+
+
+def typo(rng: random.Random, text: str) -> str:
+    i = rng.randrange(len(text))
+    return text[:i] + rng.choice(string.ascii_lowercase) + text[i + 1:]
+
+
+def timed(fn: Callable, conn: sqlite3.Connection, fragments: List[str]) -> List[float]:
+    times = []
+    for fragment in fragments:
+        started = time.perf_counter()
+        fn(conn, fragment, 10)
+        times.append(time.perf_counter() - started)
+    return sorted(times)
+
+
+# Поиск пользователя по фрагменту username: _search_users (триграммный индекс
+# users_fts и префиксный поиск по idx_users_username) против сканирования LIKE '%...%'
+def main(users: int, queries: int, seed: int) -> None:
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn = sqlite3.connect(os.path.join(tmpdir, "users.db"), isolation_level=None)
+        migrate(conn)
+        names = {}
+        while len(names) < users:
+            name = make_username(rng)
+            names.setdefault(name.lower(), name)
+        started = time.perf_counter()
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO users (user_id, username) VALUES (?, ?)", enumerate(names.values(), start=1)
+        )
+        conn.execute("COMMIT")
+        print(f"{users} users inserted with FTS triggers in {time.perf_counter() - started:.2f} s")
+
+        sample = rng.sample(list(names.values()), queries)
+        cases = {
+            "exact": sample,
+            "substring (4-6 chars)": [
+                name[i:i + length]
+                for name in sample
+                for length in [min(len(name), rng.randint(4, 6))]
+                for i in [rng.randrange(len(name) - length + 1)]
+            ],
+            "prefix (2 chars)": [name[:2] for name in sample],
+            "typo": [typo(rng, name) for name in sample],
+        }
+        # Для точного имени и имени с опечаткой известно, кого ищем: считаем, попал ли он в выдачу
+        print(f"{'query':<24}{'search p50':>12}{'p99':>10}{'LIKE p50':>12}{'p99':>10}  target in top 10")
+        for case, fragments in cases.items():
+            search = timed(_search_users, conn, fragments)
+            scan = timed(like_scan, conn, fragments)
+            found = "-"
+            if case in ("exact", "typo"):
+                hits = sum(
+                    any(user.username.lower() == name.lower() for user in _search_users(conn, fragment, 10))
+                    for fragment, name in zip(fragments, sample)
+                )
+                found = f"{hits}/{len(fragments)}"
+            print(
+                f"{case:<24}{statistics.median(search) * 1000:10.2f}ms{search[int(len(search) * 0.99)] * 1000:8.2f}ms"
+                f"{statistics.median(scan) * 1000:10.2f}ms{scan[int(len(scan) * 0.99)] * 1000:8.2f}ms"
+                f"  {found}"
+            )
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare username search with the FTS5 trigram index and a LIKE scan")
+    parser.add_argument("--users", type=int, default=300_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    main(args.users, args.queries, args.seed)
@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+from typing import List
+
+from db import Database
+
+
+def _touch_user(conn: sqlite3.Connection, user_id: int) -> None:
+    conn.execute(
+        "INSERT INTO users (user_id, username) VALUES (?, ?) "
+        "ON CONFLICT (user_id) DO UPDATE SET username = excluded.username",
+        (user_id, f"user{user_id}"),
+    )
+
+
+# Нагрузка на запись: clients одновременных клиентов, каждый делает записи
+# подряд и ждёт подтверждения коммита (как обработчик /start).
+# Сравниваем обычный режим (транзакция на запись) и group commit с разными пачками.
+async def run(writes: int, clients: int, flush_ops: int, flush_ms: float, synchronous: str) -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(
+            os.path.join(tmpdir, "users.db"),
+            write_behind=flush_ops > 0,
+            flush_interval=flush_ms / 1000,
+            flush_ops=max(flush_ops, 1),
+            synchronous=synchronous,
+        )
+        await db.connect()
+        latencies: List[float] = []
+
+        async def client(first: int) -> None:
+            for user_id in range(first, writes, clients):
+                started = time.perf_counter()
+                await db.write(_touch_user, user_id)
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(i) for i in range(clients)))
+        elapsed = time.perf_counter() - started
+        await db.close()
+
+        latencies.sort()
+        mode = f"batch {flush_ops:>4} / {flush_ms:g} ms" if flush_ops else "per-write commit"
+        batches = f"{db.flushed_ops / db.flushes:6.1f} ops/flush" if db.flushes else " " * 15
+        print(
+            f"{mode:<22} {writes / elapsed:8.0f} writes/s  {batches}  "
+            f"commit latency p50 {statistics.median(latencies) * 1000:6.2f} ms  "
+            f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.2f} ms"
+        )
+
+
+async def main(args: argparse.Namespace) -> None:
+    print(f"{args.writes} writes, {args.clients} concurrent clients, synchronous={args.synchronous}")
+    for flush_ops in [0] + args.batch_sizes:
+        await run(args.writes, args.clients, flush_ops, args.flush_ms, args.synchronous)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Group-commit write-behind benchmark")
+    parser.add_argument("--writes", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--flush-ms", type=float, default=5)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 50, 200])
+    parser.add_argument("--synchronous", default="FULL", choices=["OFF", "NORMAL", "FULL"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(args))
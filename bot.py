@@ -1,130 +1,244 @@
 import logging
-import sqlite3
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, Update
+from aiogram.types import (
+    Message, Update, CallbackQuery,
+    InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile,
+)
 from aiogram.filters import Command
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.filters.callback_data import CallbackData
 import asyncio
-from datetime import datetime
+import tempfile
+import time
 
 from dotenv import load_dotenv
 import os
 
+from db import Database
+from backup import BackupManager
+from fsm_storage import SQLiteStorage
+from middlewares import ThrottlingMiddleware
+from activity import ActivityTracker
+from recorder import Anonymizer, UpdateRecorder
+from sender import MessageScheduler
+from broadcast import Broadcaster
+from webhook_server import run_webhook
+from update_lanes import UpdateLanes, run_polling
+from buttons import ButtonRouter
+from catalog import Catalog
+from media import MediaRegistry
+from bulk import parse_discount_rows
+from logging_setup import setup_logging, update_summary
+from metrics import (
+    Metrics, UpdateMetricsMiddleware, HandlerMetricsMiddleware, ApiMetricsMiddleware, start_metrics_server,
+)
+
 load_dotenv()
 API_TOKEN = os.getenv("API_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
-
+DB_PATH = os.getenv("DB_PATH", "users.db")
+# Отложенная запись: коммит пачкой раз в DB_FLUSH_MS мс или по DB_FLUSH_OPS операций
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "0") == "1"
+DB_FLUSH_MS = float(os.getenv("DB_FLUSH_MS", "5"))
+DB_FLUSH_OPS = int(os.getenv("DB_FLUSH_OPS", "100"))
+# Через сколько секунд без изменений состояние FSM считается устаревшим
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", str(7 * 24 * 3600)))
+# Активность пользователей: как часто сбрасывать её в базу и с какой точностью хранить last_seen, секунды
+ACTIVITY_FLUSH_SECONDS = float(os.getenv("ACTIVITY_FLUSH_SECONDS", "30"))
+ACTIVITY_RESOLUTION_SECONDS = float(os.getenv("ACTIVITY_RESOLUTION_SECONDS", "300"))
+# Резервные копии базы: каталог, период в часах (0 - только по /backup) и сколько снимков хранить
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "backups"))
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "24"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+# Запись входящих апдейтов для bench.replay (RECORD_UPDATES=1): каталог, секрет анонимизации
+# (тот же нужен при воспроизведении), размер файла до смены в МБ и сколько файлов хранить
+RECORD_UPDATES = os.getenv("RECORD_UPDATES", "0") == "1"
+RECORD_DIR = os.getenv("RECORD_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "recordings"))
+RECORD_SECRET = os.getenv("RECORD_SECRET")
+RECORD_ROTATE_MB = float(os.getenv("RECORD_ROTATE_MB", "64"))
+RECORD_KEEP = int(os.getenv("RECORD_KEEP", "20"))
+# Приветственное фото /start: путь к файлу или URL
+WELCOME_PHOTO = os.getenv("WELCOME_PHOTO", "https://i.imgur.com/lnr4Z0M.jpeg")
+CATALOG_PATH = os.getenv("CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook (нужны WEBHOOK_URL и WEBHOOK_SECRET)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", "8080"))
+# Локальный эндпоинт метрик Prometheus (/metrics); не задан - эндпоинт не поднимается
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Параллельная обработка апдейтов: число полос (0 - обработка средствами aiogram,
+# задача на каждый апдейт) и сколько апдейтов может ждать в очереди
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "64"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# Логи: уровень, формат (json или text) и сколько однотипных INFO-записей в секунду пропускать
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_INFO_RATE = float(os.getenv("LOG_INFO_RATE", "10"))
+
+# Логирование: записи пишутся в отдельном потоке, event loop не ждёт вывода
+log_listener = setup_logging(LOG_LEVEL, json_format=LOG_FORMAT == "json", info_rate=LOG_INFO_RATE)
+
+
+# Метрики: задержки обработчиков, запросов к базе и к Bot API (/stats и METRICS_PORT)
+metrics = Metrics()
+metrics_runner = None
+
+# Подключение к базе данных SQLite (открывается при старте диспетчера)
+db = Database(
+    DB_PATH, write_behind=DB_WRITE_BEHIND, flush_interval=DB_FLUSH_MS / 1000, flush_ops=DB_FLUSH_OPS,
+    on_query=metrics.observe_sql,
+)
+
+# Сжатые снимки базы по расписанию и по команде /backup
+backups = BackupManager(DB_PATH, BACKUP_DIR, keep=BACKUP_KEEP, interval=BACKUP_INTERVAL_HOURS * 3600)
+
+# Состояния FSM хранятся в той же базе и переживают перезапуск
+fsm_storage = SQLiteStorage(db, state_ttl=FSM_STATE_TTL)
 
 bot = Bot(token=API_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
-
-# Логирование
-logging.basicConfig(level=logging.INFO)
-
-# Подключение к базе данных SQLite
-conn = sqlite3.connect('users.db')
-cursor = conn.cursor()
-
-# Добавляем колонку discount, если её нет
-try:
-    cursor.execute("ALTER TABLE users ADD COLUMN discount REAL DEFAULT 0.0")
-    conn.commit()
-except sqlite3.OperationalError:
-    # Колонка уже существует
-    pass
-
-# Таблица пользователей
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        referrer_id INTEGER,
-        referrals_count INTEGER DEFAULT 0,
-        discount REAL DEFAULT 0.0
+bot.session.middleware(ApiMetricsMiddleware(metrics))
+dp = Dispatcher(storage=fsm_storage)
+dp.update.outer_middleware(UpdateMetricsMiddleware(metrics))
+
+# Запись апдейтов с анонимными id - до троттлинга, чтобы воспроизводился весь входящий поток
+recorder = None
+if RECORD_UPDATES:
+    if not RECORD_SECRET:
+        logging.warning("RECORD_SECRET не задан: запись нельзя будет воспроизвести на копии базы")
+    recorder = UpdateRecorder(
+        RECORD_DIR,
+        Anonymizer(RECORD_SECRET or os.urandom(16).hex(), admin_ids=[ADMIN_ID]),
+        rotate_bytes=int(RECORD_ROTATE_MB * 2 ** 20),
+        keep=RECORD_KEEP,
     )
-""")
-conn.commit()
-
-# Словарь для отслеживания времени последнего использования команды
-last_command_time = {}
-
-# Функция для ограничения частоты команд
-async def throttle_command(user_id: int, command: str, rate: int = 2):
-    now = datetime.now()
-    if user_id in last_command_time:
-        last_time = last_command_time[user_id].get(command)
-        if last_time and (now - last_time).total_seconds() < rate:
-            return False
-    last_command_time.setdefault(user_id, {})[command] = now
-    return True
-
-# Функция добавления нового пользователя в БД
-def add_user(user_id, username, referrer_id=None):
-    # Проверяем, существует ли пользователь
-    cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    if cursor.fetchone():
-        logging.info(f"Пользователь {user_id} уже существует в базе данных.")
-        return
-
-    # Проверяем, существует ли реферер
-    if referrer_id:
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (referrer_id,))
-        if not cursor.fetchone():
-            logging.warning(f"Реферальный ID {referrer_id} не существует. Пользователь {user_id} добавлен без реферера.")
-            referrer_id = None
-
-    # Добавляем нового пользователя
-    cursor.execute("INSERT INTO users (user_id, username, referrer_id) VALUES (?, ?, ?)", 
-                   (user_id, username, referrer_id))
-    conn.commit()
-    logging.info(f"Добавлен новый пользователь: {user_id}, реферер: {referrer_id}")
-
-    # Если есть реферер, обновляем его данные
-    if referrer_id:
-        logging.info(f"Обновляем данные реферера: {referrer_id}")
-        update_referrals_count(referrer_id)
-        update_discount_and_notify(referrer_id)
-
-# Функция обновления количества рефералов
-def update_referrals_count(user_id):
-    cursor.execute("UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id = ?", (user_id,))
-    conn.commit()
-    logging.info(f"Количество рефералов обновлено для пользователя {user_id}")
-
-# Функция обновления скидки и уведомления реферера
-def update_discount_and_notify(user_id):
-    cursor.execute("SELECT referrals_count FROM users WHERE user_id = ?", (user_id,))
-    referrals_count = cursor.fetchone()[0]
-    discount = min(referrals_count * 2, 50)  # 2% за каждого реферала, максимум 50%
-    cursor.execute("UPDATE users SET discount = ? WHERE user_id = ?", (discount, user_id))
-    conn.commit()
-    logging.info(f"Скидка обновлена для пользователя {user_id}: {discount}%")
-
-    # Уведомляем реферера
-    asyncio.create_task(bot.send_message(
-        user_id,
+    dp.update.outer_middleware(recorder)
+handler_metrics = HandlerMetricsMiddleware(metrics)
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+
+# Апдейты одного пользователя обрабатываются по порядку, разных - параллельно в UPDATE_WORKERS полос
+lanes = UpdateLanes(dp, bot, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE, metrics=metrics) if UPDATE_WORKERS else None
+
+# Долгие команды администратора (/backup, /export_users, массовые скидки) идут в фоновых
+# задачах: полоса администратора (и всех пользователей, попавших в неё) не ждёт их
+# окончания, ответ приходит, когда команда выполнится
+admin_jobs = set()
+
+def start_admin_job(message: Message, title: str, job) -> None:
+    task = asyncio.create_task(run_admin_job(message, title, job))
+    admin_jobs.add(task)
+    task.add_done_callback(admin_jobs.discard)
+
+async def run_admin_job(message: Message, title: str, job) -> None:
+    try:
+        await job
+    except Exception as e:
+        logging.exception("Фоновая команда администратора (%s) завершилась ошибкой", title)
+        await message.answer(f"❌ {title} failed: {e}")
+
+# Дожидается фоновых команд при остановке (не дольше timeout), остальные отменяет
+async def close_admin_jobs(timeout: float = 30) -> None:
+    if not admin_jobs:
+        return
+    _, pending = await asyncio.wait(set(admin_jobs), timeout=timeout)
+    if pending:
+        logging.warning("Фоновые команды не завершились за %s с, отменяем %d", timeout, len(pending))
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+# Очередь исходящих уведомлений: обработчики не ждут доставки
+sender = MessageScheduler(bot)
+
+# Рассылки по всем пользователям с сохранением прогресса
+broadcaster = Broadcaster(bot, db, sender)
+
+# Кнопки reply-клавиатуры: обработчик ищется по тексту кнопки в словаре
+buttons = ButtonRouter()
+
+# Каталог товаров и статические страницы (catalog.json), перезагружается при изменении файла
+catalog = Catalog(CATALOG_PATH)
+catalog.load()
+catalog_watcher = None
+
+# Медиафайлы загружаются в Telegram один раз, дальше отправляется сохранённый file_id
+media = MediaRegistry(bot, db)
+media.register("welcome", WELCOME_PHOTO)
+
+# Последняя активность и актуальный username каждого пользователя, запись пачками (/active)
+activity = ActivityTracker(db, flush_interval=ACTIVITY_FLUSH_SECONDS, resolution=ACTIVITY_RESOLUTION_SECONDS)
+dp.update.outer_middleware(activity)
+
+# Ограничение частоты апдейтов для всех обработчиков (администратор не ограничивается)
+throttling = ThrottlingMiddleware(exempt=[ADMIN_ID])
+dp.update.outer_middleware(throttling)
+
+metrics.gauge("bot_sender_pending", lambda: sender.pending)
+metrics.gauge("bot_activity_pending", lambda: activity.pending)
+if lanes:
+    metrics.gauge("bot_update_queue_depth", lambda: lanes.depth)
+    metrics.gauge("bot_update_queue_stalls_total", lambda: lanes.stalls)
+metrics.gauge("bot_throttled_total", lambda: sum(throttling.dropped.values()))
+metrics.gauge("bot_user_cache_hit_rate", lambda: db.user_cache.hit_rate or 0.0)
+metrics.gauge("bot_fsm_cache_hit_rate", lambda: fsm_storage.cache.hit_rate or 0.0)
+
+# Уведомление реферера о новом реферале
+def notify_referrer(referrer_id, discount):
+    sender.send_message(
+        referrer_id,
         f"🎉 *You have +1 new referral!*\n"
         f"*Your discount has been increased by 2%.*\n"
         f"*Current discount: {discount}%.*",
         parse_mode="Markdown"
-    ))
+    )
 
-# Главное меню (Reply-кнопки)
+# Главное меню (Reply-кнопки), собрано один раз при загрузке каталога
 def main_menu():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="👤 My Profile"), KeyboardButton(text="🛒 Catalog ")],
-            [KeyboardButton(text="ℹ️ About Us"), KeyboardButton(text="🎁 Referral System")],
-            [KeyboardButton(text="💬 Help & Support"), KeyboardButton(text="👀 Soon...")]
-        ],
-        resize_keyboard=True,  # Уменьшает размер кнопок для компактного отображения
-    )
-    return keyboard
+    return catalog.main_menu
 
 # Проверка, является ли пользователь администратором
 def is_admin(user_id):
     return user_id == ADMIN_ID
 
+# Количество пользователей на одной странице /users
+USERS_PAGE_SIZE = 10
+
+# Кнопки листания списка пользователей
+class UsersPage(CallbackData, prefix="users"):
+    direction: str
+    cursor: int
+
+# Страница списка пользователей: текст и inline-кнопки "назад/вперёд"
+async def render_users_page(cursor=0, direction="next"):
+    users, has_prev, has_next = await db.users_page(cursor, direction, USERS_PAGE_SIZE)
+    if not users:
+        return None, None
+
+    response = "👥 *List of Users:*\n\n"
+    for user in users:
+        response += (
+            f"🆔 *User ID:* `{user.user_id}`\n"
+            f"👤 *Username:* {user.username or 'N/A'}\n"
+            f"👥 *Referrals:* {user.referrals_count}\n"
+            f"💸 *Discount:* {user.discount}%\n\n"
+        )
+
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(
+            text="⬅️ Prev", callback_data=UsersPage(direction="prev", cursor=users[0].user_id).pack()
+        ))
+    if has_next:
+        buttons.append(InlineKeyboardButton(
+            text="Next ➡️", callback_data=UsersPage(direction="next", cursor=users[-1].user_id).pack()
+        ))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return response, keyboard
+
 # Команда для просмотра всех пользователей
 @dp.message(Command(commands=["users"]))
 async def handle_users(message: Message):
@@ -132,24 +246,43 @@ async def handle_users(message: Message):
         await message.answer("🚫 You don't have permission to use this command.")
         return
 
-    cursor.execute("SELECT user_id, username, referrals_count, discount FROM users")
-    users = cursor.fetchall()
+    response, keyboard = await render_users_page()
 
-    if not users:
+    if not response:
         await message.answer("No users found in the database.")
         return
 
-    response = "👥 *List of Users:*\n\n"
-    for user in users:
-        user_id, username, referrals_count, discount = user
-        response += (
-            f"🆔 *User ID:* `{user_id}`\n"
-            f"👤 *Username:* {username or 'N/A'}\n"
-            f"👥 *Referrals:* {referrals_count}\n"
-            f"💸 *Discount:* {discount}%\n\n"
-        )
+    await message.answer(response, parse_mode="Markdown", reply_markup=keyboard)
 
-    await message.answer(response, parse_mode="Markdown")
+# Листание списка пользователей
+@dp.callback_query(UsersPage.filter())
+async def handle_users_page(callback: CallbackQuery, callback_data: UsersPage):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("🚫 You don't have permission to use this command.")
+        return
+
+    response, keyboard = await render_users_page(callback_data.cursor, callback_data.direction)
+    if response:
+        await callback.message.edit_text(response, parse_mode="Markdown", reply_markup=keyboard)
+    await callback.answer()
+
+# Команда для выгрузки всех пользователей в CSV
+@dp.message(Command(commands=["export_users"]))
+async def handle_export_users(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
+    start_admin_job(message, "Export", run_export_users(message))
+
+async def run_export_users(message: Message):
+    started = time.monotonic()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "users.csv.gz")
+        count = await db.export_users_csv(path)
+        await message.answer_document(
+            FSInputFile(path),
+            caption=f"👥 Exported {count} users in {time.monotonic() - started:.2f}s."
+        )
 
 # Команда для просмотра профиля конкретного пользователя
 @dp.message(Command(commands=["user"]))
@@ -171,20 +304,18 @@ async def handle_user(message: Message):
         return
 
     # Получаем данные пользователя
-    cursor.execute("SELECT user_id, username, referrals_count, discount FROM users WHERE user_id = ?", (user_id,))
-    user = cursor.fetchone()
+    user = await db.get_user(user_id)
 
     if not user:
         await message.answer(f"No user found with ID `{user_id}`.", parse_mode="Markdown")
         return
 
-    user_id, username, referrals_count, discount = user
     response = (
         f"👤 *User Profile:*\n\n"
-        f"🆔 *User ID:* `{user_id}`\n"
-        f"👤 *Username:* {username or 'N/A'}\n"
-        f"👥 *Referrals:* {referrals_count}\n"
-        f"💸 *Discount:* {discount}%\n"
+        f"🆔 *User ID:* `{user.user_id}`\n"
+        f"👤 *Username:* {user.username or 'N/A'}\n"
+        f"👥 *Referrals:* {user.referrals_count}\n"
+        f"💸 *Discount:* {user.discount}%\n"
     )
 
     await message.answer(response, parse_mode="Markdown")
@@ -205,37 +336,190 @@ async def handle_userstat(message: Message):
     username = args[1].lstrip("@")  # Убираем символ @, если он есть
 
     # Получаем данные пользователя
-    cursor.execute("SELECT user_id, username, referrals_count, discount FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
+    user = await db.get_user_by_username(username)
 
     if not user:
-        await message.answer(f"No user found with username `@{username}`.", parse_mode="Markdown")
+        await message.answer(
+            f"No user found with username `@{username}`. Try `/find {username}`.", parse_mode="Markdown"
+        )
         return
 
-    user_id, username, referrals_count, discount = user
+    await message.answer(await render_profile(user), parse_mode="Markdown")
 
+# Полный профиль пользователя для администратора: данные, сеть и приглашённые.
+# Username выводятся в `...`: "_" в них иначе ломает разметку Markdown всего сообщения
+async def render_profile(user):
     # Получаем список приглашенных пользователей
-    cursor.execute("SELECT username, user_id FROM users WHERE referrer_id = ?", (user_id,))
-    invited_users = cursor.fetchall()
+    invited_users = await db.get_invited(user.user_id)
 
     # Формируем список приглашенных
     if invited_users:
-        invited_list = "\n".join([f"👤 @{invited[0] or 'N/A'} (ID: `{invited[1]}`)" for invited in invited_users])
+        invited_list = "\n".join([f"👤 `@{invited[0] or 'N/A'}` (ID: `{invited[1]}`)" for invited in invited_users])
     else:
         invited_list = "No invited users."
 
+    # Вся сеть пользователя - из материализованной статистики
+    stats = await db.get_referral_stats(user.user_id)
+
     # Формируем ответ
     response = (
         f"👤 *User Profile:*\n\n"
-        f"🆔 *User ID:* `{user_id}`\n"
-        f"👤 *Username:* @{username}\n"
-        f"👥 *Referrals:* {referrals_count}\n"
-        f"💸 *Discount:* {discount}%\n\n"
+        f"🆔 *User ID:* `{user.user_id}`\n"
+        f"👤 *Username:* `@{user.username}`\n"
+        f"👥 *Referrals:* {user.referrals_count}\n"
+        f"🌳 *Network:* {stats.downline if stats else 0} users, {stats.depth if stats else 0} levels\n"
+        f"💸 *Discount:* {user.discount}%\n\n"
         f"📋 *Invited Users:*\n{invited_list}"
     )
+    return response
+
+# Кнопка профиля в результатах /find
+class UserProfile(CallbackData, prefix="profile"):
+    user_id: int
+
+# Команда для поиска пользователей по части username
+@dp.message(Command(commands=["find"]))
+async def handle_find(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
+
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        await message.answer("Usage: `/find <part of username>`", parse_mode="Markdown")
+        return
+
+    fragment = args[1].strip().lstrip("@")
+    users = await db.search_users(fragment, limit=10)
+    if not users:
+        await message.answer(f"No users match `{fragment}`.", parse_mode="Markdown")
+        return
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=f"@{user.username} · ID {user.user_id} · {user.discount}%",
+            callback_data=UserProfile(user_id=user.user_id).pack(),
+        )]
+        for user in users
+    ])
+    await message.answer(f"🔎 Users matching `{fragment}`:", parse_mode="Markdown", reply_markup=keyboard)
+
+# Открытие профиля из результатов поиска
+@dp.callback_query(UserProfile.filter())
+async def handle_user_profile(callback: CallbackQuery, callback_data: UserProfile):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("🚫 You don't have permission to use this command.")
+        return
+
+    user = await db.get_user(callback_data.user_id)
+    if not user:
+        await callback.answer("User not found.")
+        return
+
+    await callback.message.answer(await render_profile(user), parse_mode="Markdown")
+    await callback.answer()
+
+# Сколько лидеров показывает /top_referrers
+TOP_REFERRERS_LIMIT = 10
+
+# Команда для просмотра лидеров по размеру реферальной сети
+@dp.message(Command(commands=["top_referrers"]))
+async def handle_top_referrers(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
 
+    top = await db.top_referrers(TOP_REFERRERS_LIMIT)
+    if not top:
+        await message.answer("No referrals yet.")
+        return
+
+    response = "🏆 *Top Referrers:*\n\n"
+    for place, stats in enumerate(top, start=1):
+        response += (
+            f"{place}. `@{stats.username or 'N/A'}` (ID: `{stats.user_id}`)\n"
+            f"    👥 Invited: {stats.invited} | 🌳 Network: {stats.downline} | 📶 Levels: {stats.depth}\n"
+        )
     await message.answer(response, parse_mode="Markdown")
 
+# Строки дерева приглашений с отступом по уровню
+def render_referral_tree(node, indent=""):
+    lines = []
+    for child in node.children:
+        name = f"@{child.stats.username}" if child.stats.username else str(child.stats.user_id)
+        lines.append(f"{indent}└ {name}: {child.stats.invited} invited, {child.stats.downline} in network")
+        lines.extend(render_referral_tree(child, indent + "   "))
+    if node.hidden:
+        lines.append(f"{indent}└ … and {node.hidden} more")
+    return lines
+
+# Команда для просмотра реферального дерева пользователя
+@dp.message(Command(commands=["referral_tree"]))
+async def handle_referral_tree(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
+
+    args = message.text.split()
+    if len(args) < 2:
+        await message.answer("Usage: `/referral_tree @username`", parse_mode="Markdown")
+        return
+
+    username = args[1].lstrip("@")
+    user = await db.get_user_by_username(username)
+    tree = await db.referral_tree(user.user_id) if user else None
+    if not tree:
+        await message.answer(f"No user found with username `@{username}`.", parse_mode="Markdown")
+        return
+
+    lines = [f"@{username}: {tree.stats.invited} invited, {tree.stats.downline} in network, {tree.stats.depth} levels"]
+    lines.extend(render_referral_tree(tree))
+    tree_text = "\n".join(lines)
+    await message.answer(f"🌳 *Referral Tree:*\n```\n{tree_text}\n```", parse_mode="Markdown")
+
+# Команда для сверки и пересчёта реферальной статистики
+@dp.message(Command(commands=["check_referrals"]))
+async def handle_check_referrals(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
+
+    started = time.monotonic()
+    stats_drift, count_drift = await db.check_referrals()
+    elapsed = time.monotonic() - started
+    if stats_drift or count_drift:
+        await message.answer(
+            f"🔧 Referral stats rebuilt in {elapsed:.2f}s: fixed {stats_drift} network rows "
+            f"and {count_drift} referral counters."
+        )
+    else:
+        await message.answer(f"✅ Referral stats are consistent (checked in {elapsed:.2f}s).")
+
+# Команда для резервной копии базы по требованию
+@dp.message(Command(commands=["backup"]))
+async def handle_backup(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
+    start_admin_job(message, "Backup", run_backup(message))
+
+async def run_backup(message: Message):
+    if backups.running:
+        await message.answer("⏳ A backup is already running, yours will start right after it.")
+    try:
+        snapshot = await backups.backup()
+    except Exception as e:
+        logging.exception("Не удалось сделать резервную копию по команде /backup")
+        await message.answer(f"❌ Backup failed: {e}")
+        return
+
+    await message.answer(
+        f"💾 Backup `{os.path.basename(snapshot.path)}` done in {snapshot.seconds:.2f}s\n"
+        f"Size: {format_size(snapshot.size)}, compressed {format_size(snapshot.compressed_size)}\n"
+        f"Integrity check: ok. Snapshots kept: {len(backups.snapshots())}",
+        parse_mode="Markdown",
+    )
+
 # Команда для удаления пользователя
 @dp.message(Command(commands=["delete_user"]))
 async def delete_user(message: Message):
@@ -250,8 +534,7 @@ async def delete_user(message: Message):
 
     try:
         user_id = int(args[1])
-        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-        conn.commit()
+        await db.delete_user(user_id)
         await message.answer(f"User with ID `{user_id}` has been deleted.", parse_mode="Markdown")
     except ValueError:
         await message.answer("Invalid user ID. Please provide a valid number.")
@@ -273,21 +556,18 @@ async def handle_give_discount(message: Message):
         discount_to_add = float(args[2])
 
         # Проверяем, существует ли пользователь
-        cursor.execute("SELECT user_id, discount FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        user = await db.get_user_by_username(username)
         if not user:
             await message.answer(f"User with username `@{username}` not found.", parse_mode="Markdown")
             return
 
-        user_id, current_discount = user
-        new_discount = current_discount + discount_to_add
+        user_id = user.user_id
 
         # Обновляем скидку пользователя
-        cursor.execute("UPDATE users SET discount = ? WHERE user_id = ?", (new_discount, user_id))
-        conn.commit()
+        new_discount = await db.adjust_discount(user_id, discount_to_add)
 
         # Уведомляем пользователя о новой скидке
-        await bot.send_message(
+        sender.send_message(
             user_id,
             f"🎉* You have received a bonus discount: {discount_to_add:.2f}%*\n"
             f"*Ваша текущая скидка: {new_discount:.2f}%.*",
@@ -321,21 +601,18 @@ async def handle_remove_discount(message: Message):
         discount_to_remove = float(args[2])
 
         # Проверяем, существует ли пользователь
-        cursor.execute("SELECT user_id, discount FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        user = await db.get_user_by_username(username)
         if not user:
             await message.answer(f"User with username `@{username}` not found.", parse_mode="Markdown")
             return
 
-        user_id, current_discount = user
-        new_discount = max(current_discount - discount_to_remove, 0)  # Скидка не может быть меньше 0
+        user_id = user.user_id
 
-        # Обновляем скидку пользователя
-        cursor.execute("UPDATE users SET discount = ? WHERE user_id = ?", (new_discount, user_id))
-        conn.commit()
+        # Обновляем скидку пользователя (скидка не может быть меньше 0)
+        new_discount = await db.adjust_discount(user_id, -discount_to_remove)
 
         # Уведомляем пользователя об изменении скидки
-        await bot.send_message(
+        sender.send_message(
             user_id,
             f"❌ *Your discount has been decreased on: {discount_to_remove:.2f}%*\n"
             f"*Your current discount: {new_discount:.2f}% ⭐*",
@@ -351,6 +628,81 @@ async def handle_remove_discount(message: Message):
     except ValueError:
         await message.answer("Invalid input. Please provide a valid username and discount amount.")
 
+# Максимальный размер CSV-файла для массовых операций
+BULK_FILE_LIMIT = 1024 * 1024
+
+# Массовое изменение скидок: список "@username amount" в тексте команды
+# или CSV-файл "username,amount" с командой в подписи (выполняется в фоне, см. start_admin_job)
+async def run_bulk_discount(message: Message, sign):
+    command = "give_discount_bulk" if sign > 0 else "remove_discount_bulk"
+    started = time.monotonic()
+    if message.document:
+        if message.document.file_size and message.document.file_size > BULK_FILE_LIMIT:
+            await message.answer("The file is too large (max 1 MB).")
+            return
+        text = (await bot.download(message.document)).read().decode("utf-8-sig", errors="replace")
+    else:
+        args = message.text.split(maxsplit=1)
+        text = args[1] if len(args) > 1 else ""
+
+    rows, errors = parse_discount_rows(text)
+    if not rows:
+        await message.answer(
+            f"Usage: `/{command}` followed by one `@username amount` per line,\n"
+            f"or send a CSV file `username,amount` with `/{command}` as the caption.",
+            parse_mode="Markdown"
+        )
+        return
+    parsed = time.monotonic()
+
+    updated, not_found = await db.bulk_adjust_discount([(username, sign * amount) for username, amount in rows])
+    applied = time.monotonic()
+
+    # Уведомления уходят через общую очередь отправки с соблюдением лимитов
+    for user, delta in updated:
+        if delta > 0:
+            text = (
+                f"🎉* You have received a bonus discount: {delta:.2f}%*\n"
+                f"*Ваша текущая скидка: {user.discount:.2f}%.*"
+            )
+        else:
+            text = (
+                f"❌ *Your discount has been decreased on: {-delta:.2f}%*\n"
+                f"*Your current discount: {user.discount:.2f}% ⭐*"
+            )
+        sender.send_message(user.user_id, text, parse_mode="Markdown")
+
+    response = f"✅ Discounts updated for {len(updated)} users.\n"
+    if not_found:
+        shown = ", ".join(f"@{username}" for username in not_found[:20])
+        more = f" and {len(not_found) - 20} more" if len(not_found) > 20 else ""
+        response += f"❓ Not found ({len(not_found)}): {shown}{more}\n"
+    if errors:
+        more = f" and {len(errors) - 10} more" if len(errors) > 10 else ""
+        response += f"⚠️ Skipped rows ({len(errors)}): {'; '.join(errors[:10])}{more}\n"
+    response += (
+        f"📨 Notifications queued: {len(updated)}\n"
+        f"⏱ Parsed in {parsed - started:.2f}s, applied in one transaction in {applied - parsed:.3f}s, "
+        f"total {time.monotonic() - started:.2f}s."
+    )
+    await message.answer(response)
+
+# Массовая выдача скидок
+@dp.message(Command(commands=["give_discount_bulk"]))
+async def handle_give_discount_bulk(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
+    start_admin_job(message, "Bulk discount", run_bulk_discount(message, 1))
+
+# Массовое уменьшение скидок
+@dp.message(Command(commands=["remove_discount_bulk"]))
+async def handle_remove_discount_bulk(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
+    start_admin_job(message, "Bulk discount", run_bulk_discount(message, -1))
+
 # Команда для регистрации покупки по username
 @dp.message(Command(commands=["register_purchase"]))
 async def handle_register_purchase(message: Message):
@@ -368,27 +720,31 @@ async def handle_register_purchase(message: Message):
         amount = float(args[2])
 
         # Проверяем, существует ли пользователь
-        cursor.execute("SELECT user_id, referrer_id FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        user = await db.get_user_by_username(username)
         if not user:
             await message.answer(f"User with username `@{username}` not found.", parse_mode="Markdown")
             return
 
-        user_id, referrer_id = user
-
-        # Начисляем скидку рефереру, если он существует
-        if referrer_id:
-            discount = 10  # 10% за покупку
-            cursor.execute("SELECT discount FROM users WHERE user_id = ?", (referrer_id,))
-            referrer_discount = cursor.fetchone()[0]
-            new_discount = referrer_discount + discount
+        if not 0 < amount < float("inf"):
+            await message.answer("Amount must be a positive number.")
+            return
 
-            cursor.execute("UPDATE users SET discount = ? WHERE user_id = ?", (new_discount, referrer_id))
-            conn.commit()
+        # Покупка записывается в журнал, реферер получает скидку в той же транзакции.
+        # Ключ идемпотентности - сообщение администратора: повторная доставка апдейта
+        # не зарегистрирует покупку второй раз
+        discount = 10  # 10% за покупку
+        result = await db.register_purchase(
+            user.user_id, amount, f"{message.chat.id}:{message.message_id}", referrer_bonus=discount
+        )
+        if result is None:
+            await message.answer("This purchase has already been registered.")
+            return
 
+        purchase, new_discount = result
+        if new_discount is not None:
             # Уведомляем реферера
-            await bot.send_message(
-                referrer_id,
+            sender.send_message(
+                purchase.referrer_id,
                 f"*🎉 The user you invited made a purchase!*\n"
                 f"*You've received a discount: {discount}%.*\n"
                 f"*Current discount: {new_discount}%.*",
@@ -404,6 +760,148 @@ async def handle_register_purchase(message: Message):
     except ValueError:
         await message.answer("Invalid input. Please provide a valid username and amount.")
 
+# Отчёт о продажах: итоги по периодам и лучшие покупатели, либо итоги одного пользователя
+@dp.message(Command(commands=["sales"]))
+async def handle_sales(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
+
+    args = message.text.split()
+    if len(args) >= 2:
+        username = args[1].lstrip("@")
+        user = await db.get_user_by_username(username)
+        if not user:
+            await message.answer(f"User with username `@{username}` not found.", parse_mode="Markdown")
+            return
+        sales = await db.user_sales(user.user_id)
+        if not sales:
+            await message.answer(f"`@{username}` has no purchases yet.", parse_mode="Markdown")
+            return
+        await message.answer(
+            f"💰 *Sales for* `@{username}`:\n\n"
+            f"🛍 *Purchases:* {sales.purchases}\n"
+            f"💵 *Revenue:* {sales.revenue:.2f}",
+            parse_mode="Markdown"
+        )
+        return
+
+    summary = await db.sales_summary()
+    response = "💰 *Sales Report (UTC):*\n\n"
+    for title, period in (("Today", "day"), ("This month", "month"), ("All time", "all")):
+        sales = summary[period]
+        response += f"📅 *{title}:* {sales.purchases} purchases, {sales.revenue:.2f}\n"
+
+    top = await db.top_buyers()
+    if top:
+        response += "\n🏆 *Top Buyers:*\n"
+        for place, (user_id, username, sales) in enumerate(top, start=1):
+            response += f"{place}. `@{username or 'N/A'}` (ID: `{user_id}`): {sales.purchases} purchases, {sales.revenue:.2f}\n"
+    await message.answer(response, parse_mode="Markdown")
+
+# Строки "имя: количество, p50 / p99 мс" для самых затратных операций
+def render_latencies(histograms):
+    return "".join(
+        f"  {name}: {histogram.count}, {histogram.quantile(0.5) * 1000:.1f} / {histogram.quantile(0.99) * 1000:.1f} ms\n"
+        for name, histogram in Metrics.top(histograms)
+    ) or "  no data\n"
+
+def format_size(size):
+    return f"{size / 2 ** 20:.1f} MB" if size >= 2 ** 20 else f"{size / 1024:.0f} KB"
+
+def format_rate(rate):
+    return f"{rate:.0%}" if rate is not None else "n/a"
+
+# Команда для просмотра метрик бота
+@dp.message(Command(commands=["stats"]))
+async def handle_stats(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
+
+    uptime = int(time.time() - metrics.started)
+    updates = metrics.updates
+    throttled = throttling.stats()
+    queue = sender.stats()
+    cache = db.cache_stats()
+    response = (
+        f"📊 Bot stats (uptime {uptime // 3600}h {uptime % 3600 // 60:02d}m)\n\n"
+        f"📥 Updates: {updates['handled']} handled, {updates['unhandled']} unhandled, {updates['error']} errors\n"
+        f"🚦 Throttled: {sum(throttled['dropped'].values())} ({throttled['tracked_buckets']} users tracked)\n\n"
+        f"⏱ Handlers (count, p50 / p99):\n{render_latencies(metrics.handlers)}\n"
+        f"🗄 Database (count, p50 / p99):\n{render_latencies(metrics.sql)}\n"
+        f"📡 Bot API (count, p50 / p99):\n{render_latencies(metrics.api)}"
+        f"  errors: {sum(metrics.api_errors.values())}\n"
+        f"🛤 Queue wait (count, p50 / p99):\n{render_latencies(metrics.waits)}\n"
+        f"📨 Sender: {queue['pending']} pending, {queue['sent']} sent, {queue['failed']} failed, "
+        f"{queue['retried']} retried, {queue['flood_waits']} flood waits\n"
+        f"👤 User cache: {cache['size']} users, hit rate {format_rate(cache['hit_rate'])}\n"
+        f"📝 FSM cache: hit rate {format_rate(fsm_storage.cache.hit_rate)}"
+    )
+    if lanes:
+        lane_stats = lanes.stats()
+        response += (
+            f"\n🛤 Lanes: {lane_stats['workers']} workers, {lane_stats['queued']}/{lane_stats['capacity']} queued "
+            f"(busiest lane {lane_stats['busiest_lane']}), {lane_stats['stalls']} polling stalls"
+        )
+    await message.answer(response)
+
+# Команда для просмотра числа активных пользователей
+@dp.message(Command(commands=["active"]))
+async def handle_active(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
+
+    # Сначала дописываем накопленную активность, чтобы цифры были актуальными
+    await activity.flush()
+    active = await db.active_users({"day": 24 * 3600, "week": 7 * 24 * 3600, "month": 30 * 24 * 3600})
+    await message.answer(
+        f"📈 *Active users:*\n\n"
+        f"Last 24 hours (DAU): {active['day']}\n"
+        f"Last 7 days (WAU): {active['week']}\n"
+        f"Last 30 days (MAU): {active['month']}\n\n"
+        f"🔄 Usernames refreshed since start: {activity.renamed}",
+        parse_mode="Markdown",
+    )
+
+# Команда для рассылки сообщения всем пользователям
+@dp.message(Command(commands=["broadcast"]))
+async def handle_broadcast(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
+
+    # Текст берём в HTML, чтобы сохранить форматирование сообщения администратора
+    args = message.html_text.split(maxsplit=1)
+    if len(args) < 2:
+        await message.answer("Usage: `/broadcast <text>`", parse_mode="Markdown")
+        return
+
+    await broadcaster.start(args[1], message.chat.id)
+
+# Команда для остановки рассылки
+@dp.message(Command(commands=["broadcast_stop"]))
+async def handle_broadcast_stop(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 You don't have permission to use this command.")
+        return
+
+    args = message.text.split()
+    if len(args) < 2:
+        active = ", ".join(f"`{broadcast_id}`" for broadcast_id in broadcaster.active) or "none"
+        await message.answer(f"Usage: `/broadcast_stop <id>`\nActive broadcasts: {active}", parse_mode="Markdown")
+        return
+
+    try:
+        broadcast_id = int(args[1])
+    except ValueError:
+        await message.answer("Invalid broadcast ID. Please provide a valid number.")
+        return
+
+    if not await broadcaster.cancel(broadcast_id):
+        await message.answer(f"Broadcast `{broadcast_id}` is not running.", parse_mode="Markdown")
+
 # Обработчик команды /start
 @dp.message(Command(commands=["start"]))
 async def cmd_start(message: Message):
@@ -411,25 +909,22 @@ async def cmd_start(message: Message):
     username = message.from_user.username
     referrer_id = None
 
-    # Ограничение частоты команды
-    if not await throttle_command(user_id, "start", rate=2):
-        await message.answer("⏳ Please wait before using this command again.")
-        return
-
     # Если сообщение содержит /start и реферальный код
     if len(message.text.split()) > 1:
         referrer_id = int(message.text.split()[1])
-        logging.info(f"Пользователь {user_id} пришел по реферальной ссылке от {referrer_id}")
+        logging.info("Пользователь %s пришел по реферальной ссылке от %s", user_id, referrer_id)
 
     # Добавляем пользователя в базу данных
-    add_user(user_id, username, referrer_id)
+    referral = await db.add_user(user_id, username, referrer_id)
+    if referral:
+        logging.info("Обновлены данные реферера: %s", referral[0])
+        notify_referrer(*referral)
 
     # Приветственное сообщение с фотографией и текстом
-    photo_url = "https://i.imgur.com/lnr4Z0M.jpeg" 
     user_name = message.from_user.first_name
-    await bot.send_photo(
-        chat_id=message.chat.id,
-        photo=photo_url,
+    await media.send(
+        "welcome",
+        message.chat.id,
         caption=(
             f"Hello, *{user_name}*! \nWelcome to *Horda Shop*! 🎉\n\n"
             "*💫 Tap the menu below to snoop around.*\n"
@@ -441,14 +936,13 @@ async def cmd_start(message: Message):
     )
 
 # Обработчик кнопки "Your Profile"
-@dp.message(F.text == "👤 My Profile")
+@buttons.on("👤 My Profile")
 async def handle_profile(message: Message):
     user_id = message.from_user.id
-    cursor.execute("SELECT referrals_count, discount FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
+    user = await db.get_user(user_id)
 
-    if result:
-        referrals_count, discount = result
+    if user:
+        referrals_count, discount = user.referrals_count, user.discount
         await message.answer(
             f"*👤 Your Profile*\n\n"
             f"*👥 Referrals: *{referrals_count}\n"
@@ -459,141 +953,8 @@ async def handle_profile(message: Message):
     else:
         await message.answer("You are not registered in the system yet.")
 
-# Обработчик кнопки "Assortiment"
-@dp.message(F.text == "🛒 Catalog")
-async def handle_assortiment(message: Message):                              
-    await message.answer(
-        "Choose a category:",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="🎧 Spotify Premium"), KeyboardButton(text="🔴 YouTube Premium")],
-                [KeyboardButton(text="🟣 Twitch Subscription"), KeyboardButton(text="💎 Discord Nitro")],
-                [KeyboardButton(text="⭐ Telegram Stars"), KeyboardButton(text="Turkish Bankcards 🇹🇷")],
-                                            [KeyboardButton(text="Back")]
-            ],
-            resize_keyboard=True
-        )
-    )
-
-# Обработчики для Spotify, YouTube Premium и Twitch Prime
-@dp.message(F.text == "🎧 Spotify Premium")
-async def handle_spotify(message: Message):
-    await message.answer(
-        "🎵 *Spotify Premium Individual*\n\n"
-        "▫️* 1 month — $3.99*\n\n"
-        "▫️* 3 months — $8.99*\n\n"
-        "▫️ *6 months — $12.99*\n\n"
-        "*▫️ 12 months — $22.99* \n\n"
-        "*Payment methods:\n🪙Crypto\n💸PayPal*\n\n"
-        "*To buy: @headphony*",
-    parse_mode="Markdown")
-
-@dp.message(F.text == "🔴 YouTube Premium")
-async def handle_youtube(message: Message):
-    await message.answer(
-        "soon..."
-    )
-
-@dp.message(F.text == "🟣 Twitch Subscription")
-async def handle_twitch(message: Message):
-    await message.answer(
-        "*🎮 Twitch Subscription*\n"
-        "*LEVEL 1✅\n\n*"
-        "*▫️ Level 1 — 1 Month — $3.99*\n\n"
-        "*▫️ Level 1 — 3 Months — $8.99*\n\n"
-        "*▫️ Level 1 — 6 Months — $17.99*\n\n"
-        "*LEVEL 2✅\n\n*"
-        "*▫️ Level 2 — 1 Month — $5.99*\n\n"
-        "*LEVEL 3✅\n\n*"
-        "*▫️ Level 3 — 1 Month — $14.99*\n\n"
-        "🥰No account access needed — just *your* and the *streamer’s* *nicknames!*\n\n"
-        "*Payment methods:\n- Crypto\n- PayPal*\n\n"
-        "*To buy: @heaphony*",
-        
-        parse_mode="Markdown"
-    )
-
-# Обработчик кнопки "Turkish Bankcards"
-@dp.message(F.text == "Turkish Bankcards 🇹🇷")
-async def handle_turkish_bankcards(message: Message):
-    await message.answer(
-        "Choose a card type:",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Popypara 🇹🇷")],
-                [KeyboardButton(text="Back")]
-            ],
-            resize_keyboard=True
-        )
-    )
-
-@dp.message(F.text == "💎 Discord Nitro")
-async def handle_discord(message: Message):
-    await message.answer(
-        "💎 *Discord Nitro Full*\n\n"
-        "*1 month — $6.49*\n\n"
-        "*3 months — $13.99*\n\n"
-        "*6 months — soon...*\n\n"
-        "*🎁 You'll get Nitro as a gift — no need to log in anywhere, no data required!*\n\n"
-        "*⚜️ You'll only have to activate it with VPN and that's it!*\n\n"
-        "*Payment methods:\n- Crypto (TON, BTC, USDC, BNB)\n- PayPal*\n\n"
-        "*To buy: @headphony*",
-        parse_mode="Markdown"
-    )
-
-@dp.message(F.text == "⭐ Telegram Stars")
-async def handle_telegram_stars(message: Message):
-    await message.answer(
-        "*⭐ Telegram Stars*\n\n"
-        "*100⭐ — $1.79*\n\n"
-        "*250⭐ — $4.59*\n\n"
-        "*500⭐ — $8.99*\n\n"
-        "*1000⭐ — $16.99*\n\n"
-        "*📦 All stars are purchased officially and delivered via Telegram!*\n\n"
-        "✅ No account info, no logins — just your *@username* to receive the gift.\n\n"
-        "*Payment methods:\n- Crypto (TON, BTC, USDC, BNB)\n- PayPal*\n\n"
-        "*To buy: @headphony*",
-        parse_mode="Markdown"
-    )
-
-# Обработчик кнопки "Popypara"
-@dp.message(F.text == "Popypara 🇹🇷")
-async def handle_popypara(message: Message):
-    await message.answer(
-        "🇹🇷 *Popypara*\n\n"
-        "*Features:\n\n*"
-        "▫️ Monthly limit of *2750 TRY🇹🇷*\n\n"
-        "▫️ Works with *all online services✅*\n\n"
-        "▫️ *Quick & easy* top-up process✅\n\n"
-        "▫️ *Stable & reliable* performance🤗\n\n"
-        "▫️ Super *user-friendly* experience\n\n"
-        "*Price:*\n\n"
-        "*⚠️Currently anavailable! Check our news channel for the updates*\n\n"
-        "Payment - Crypto, Paypal\n"
-        "*Contact us - @headphony*",
-        parse_mode="Markdown"
-    )
-
-# Обработчик кнопки "Назад"
-@dp.message(F.text == "Back")
-async def handle_back(message: Message):
-    await message.answer("You are back to the main menu.", reply_markup=main_menu())
-
-# Обработчик кнопки "Info about us"
-@dp.message(F.text == "ℹ️ About Us")
-async def handle_about(message: Message):
-    await message.answer(
-        "*Horda Shop. We don’t beg — we deliver.*\n\n"
-        "*Fast deals, clean setup, zero bullshit.*\n\n"
-        "You came for the *price* — you’ll stay for the service 👊\n\n"
-        "*Cheap? Yeah 🤩*\n"
-        "*Shady? Nah 😎*\n\n"
-        "*We move different...*",
-        parse_mode="Markdown"
-    )
-
 # Обработчик кнопки "Referral System"
-@dp.message(F.text == "🎁 Referral System")
+@buttons.on("🎁 Referral System")
 async def handle_referral(message: Message):
     user_id = message.from_user.id
     referral_link = f"https://t.me/hordashop_bot?start={user_id}"
@@ -606,32 +967,86 @@ async def handle_referral(message: Message):
         f"*Your referral link: {referral_link}*",
     parse_mode="Markdown")
 
-# Обработчик кнопки "Help"
-@dp.message(F.text == "💬 Help & Support")
-async def handle_help(message: Message):
-    await message.answer(
-        "*Got any questions?*\n\n"
-        "Feel free to reach out to us anytime:\n"
-        "*📩 @headphony*",
-       parse_mode="Markdown" 
-       )
-
 # Глобальный обработчик ошибок
 @dp.errors()
 async def handle_errors(update: Update, exception: Exception):
-    logging.error(f"An error occurred: {exception}\nUpdate: {update}")
+    logging.error(
+        "Ошибка при обработке апдейта %s: %s", update.update_id, exception,
+        exc_info=exception, extra={"update": update_summary(update)},
+    )
     return True  # Возвращаем True, чтобы ошибка не прерывала работу бота
 
+# Обработчик страниц каталога: текст и клавиатура уже готовы
+@dp.message(catalog.filter)
+async def handle_catalog_page(message: Message, page):
+    await message.answer(page.text, parse_mode=page.parse_mode, reply_markup=page.reply_markup)
+
+# Обработчик всех кнопок reply-клавиатуры
+@dp.message(buttons.filter)
+async def handle_button(message: Message, button_handler):
+    return await button_handler(message)
+
 # Обработчик для необработанных сообщений
 @dp.message()
 async def handle_unhandled_messages(message: Message):
     await message.answer("There is no such command. Try again!")
 
+# Открытие и закрытие базы данных и очереди отправки вместе с диспетчером
+@dp.startup()
+async def on_startup():
+    global catalog_watcher, metrics_runner
+    await db.connect()
+    await backups.start()
+    await activity.start()
+    if recorder:
+        await recorder.start()
+    await fsm_storage.start()
+    if lanes:
+        await lanes.start()
+    await media.load()
+    await sender.start()
+    await broadcaster.resume()
+    catalog_watcher = asyncio.create_task(catalog.watch())
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(metrics, METRICS_HOST, METRICS_PORT)
+        logging.info("Метрики доступны на http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+
+@dp.shutdown()
+async def on_shutdown():
+    # Принятые апдейты дорабатывают run_polling и вебхук до shutdown-колбэков (раньше
+    # закрытия FSM); здесь - на случай, если диспетчер остановили в обход них
+    if lanes:
+        await lanes.close()
+    await close_admin_jobs()
+    if catalog_watcher:
+        catalog_watcher.cancel()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    await broadcaster.close()
+    await sender.close()
+    await backups.close()
+    await activity.close()
+    if recorder:
+        await recorder.close()
+    await db.close()
+
 # Запуск бота
 async def main():
-    await dp.start_polling(bot)
-
-logging.basicConfig(level=logging.DEBUG)
+    if BOT_MODE == "webhook":
+        await run_webhook(
+            dp, bot, WEBHOOK_URL, path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+            host=WEBAPP_HOST, port=WEBAPP_PORT, lanes=lanes,
+        )
+    else:
+        # Если раньше был установлен вебхук, getUpdates с ним не работает
+        await bot.delete_webhook()
+        if lanes:
+            await run_polling(dp, bot, lanes)
+        else:
+            await dp.start_polling(bot)
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    finally:
+        log_listener.stop()
\ No newline at end of file
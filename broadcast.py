@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from db import Broadcast, Database
+from sender import MessageScheduler
+
+
+# Рассылка сообщения всем пользователям из таблицы users.
+# Получатели читаются пачками по user_id, отправка идёт через общую очередь
+# MessageScheduler (она и держит лимит Telegram), после каждой пачки прогресс
+# сохраняется в broadcasts, поэтому после перезапуска рассылка продолжается с того же места.
+class Broadcaster:
+    def __init__(
+        self,
+        bot: Bot,
+        db: Database,
+        sender: MessageScheduler,
+        batch_size: int = 100,
+        progress_interval: float = 3.0,
+        batches_in_flight: int = 2,
+    ):
+        self.bot = bot
+        self.db = db
+        self.sender = sender
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.batches_in_flight = batches_in_flight
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    @property
+    def active(self) -> Dict[int, asyncio.Task]:
+        return dict(self._tasks)
+
+    async def start(self, text: str, admin_chat_id: int) -> Broadcast:
+        broadcast = await self.db.create_broadcast(text, admin_chat_id)
+        status = await self.bot.send_message(admin_chat_id, self._progress_text(broadcast, 0.0))
+        await self.db.set_broadcast_message(broadcast.id, status.message_id)
+        self._spawn(broadcast.id)
+        return broadcast
+
+    # Продолжает рассылки, прерванные остановкой бота
+    async def resume(self) -> None:
+        for broadcast in await self.db.running_broadcasts():
+            logging.info("Продолжаем рассылку %d с пользователя %d", broadcast.id, broadcast.last_user_id)
+            self._spawn(broadcast.id)
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        task = self._tasks.get(broadcast_id)
+        if task is None:
+            return False
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await self.db.finish_broadcast(broadcast_id, "cancelled")
+        await self._report(broadcast_id)
+        return True
+
+    # Останавливает рассылки без смены статуса - при следующем запуске они продолжатся
+    async def close(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, broadcast_id: int) -> None:
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id: int) -> None:
+        broadcast = await self.db.get_broadcast(broadcast_id)
+        cursor = broadcast.last_user_id
+        started = time.monotonic()
+        sent_this_run = 0
+        last_report = 0.0
+        # В очереди держится до batches_in_flight пачек: следующая ставится до того, как
+        # дождались предыдущей, поэтому медленный получатель (например, ждущий RetryAfter)
+        # не останавливает рассылку и очередь не простаивает на хвосте пачки.
+        # Контрольные точки сохраняются строго по порядку пачек
+        batches: List[Tuple[List[int], List[asyncio.Future]]] = []
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(batches) < self.batches_in_flight:
+                    recipients = await self.db.broadcast_recipients(cursor, self.batch_size)
+                    if not recipients:
+                        exhausted = True
+                        break
+                    cursor = recipients[-1]
+                    batches.append((recipients, [
+                        self.sender.send_message(user_id, broadcast.text, parse_mode="HTML")
+                        for user_id in recipients
+                    ]))
+                if not batches:
+                    break
+
+                recipients, futures = batches[0]
+                await asyncio.wait(futures)
+                sent_this_run += await self._checkpoint(broadcast_id, recipients, futures)
+                batches.pop(0)
+
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    await self._report(broadcast_id, sent_this_run / (last_report - started))
+        except asyncio.CancelledError:
+            # Отправки после последней начатой снимаем с очереди, а начатые и стоящие перед
+            # ними дожидаемся: тогда доставлено ровно начало пачек, и после контрольной
+            # точки перезапуск не отправит повторно ни одно сообщение
+            futures = [future for _, batch in batches for future in batch]
+            keep = max((i + 1 for i, future in enumerate(futures) if self.sender.started(future)), default=0)
+            for future in futures[keep:]:
+                future.cancel()
+            if keep:
+                await asyncio.wait(futures[:keep])
+            for recipients, futures in batches:
+                done = 0
+                while done < len(futures) and not futures[done].cancelled():
+                    done += 1
+                if done:
+                    await self._checkpoint(broadcast_id, recipients[:done], futures[:done])
+                if done < len(futures):
+                    break
+            raise
+        except Exception:
+            logging.exception("Рассылка %d прервана ошибкой", broadcast_id)
+            await self.db.finish_broadcast(broadcast_id, "failed")
+            await self._report(broadcast_id)
+            return
+
+        await self.db.finish_broadcast(broadcast_id, "done")
+        elapsed = time.monotonic() - started
+        await self._report(broadcast_id, sent_this_run / elapsed if elapsed else 0.0)
+        logging.info("Рассылка %d завершена за %.1f с", broadcast_id, elapsed)
+
+    # Подсчитывает результаты отправленной части пачки и сохраняет контрольную точку;
+    # возвращает число доставленных сообщений
+    async def _checkpoint(self, broadcast_id: int, recipients: List[int], futures: List[asyncio.Future]) -> int:
+        sent, failed, blocked_ids = 0, 0, []
+        for user_id, future in zip(recipients, futures):
+            error = future.exception()
+            if error is None:
+                sent += 1
+            elif isinstance(error, TelegramForbiddenError) or (
+                isinstance(error, TelegramBadRequest) and "chat not found" in str(error)
+            ):
+                blocked_ids.append(user_id)
+            else:
+                failed += 1
+        await self.db.checkpoint_broadcast(broadcast_id, recipients[-1], sent, failed, blocked_ids)
+        return sent
+
+    async def _report(self, broadcast_id: int, rate: Optional[float] = None) -> None:
+        broadcast = await self.db.get_broadcast(broadcast_id)
+        if not broadcast.status_message_id:
+            return
+        try:
+            await self.bot.edit_message_text(
+                self._progress_text(broadcast, rate),
+                chat_id=broadcast.admin_chat_id,
+                message_id=broadcast.status_message_id,
+            )
+        except TelegramBadRequest:
+            # "message is not modified" и подобное не мешают рассылке
+            pass
+
+    @staticmethod
+    def _progress_text(broadcast: Broadcast, rate: Optional[float]) -> str:
+        finished = broadcast.finished_at or time.time()
+        text = (
+            f"📣 Broadcast #{broadcast.id}: {broadcast.status}\n\n"
+            f"✅ Sent: {broadcast.sent}\n"
+            f"🚫 Blocked: {broadcast.blocked}\n"
+            f"⚠️ Failed: {broadcast.failed}\n"
+            f"⏱ Elapsed: {finished - broadcast.started_at:.0f}s"
+        )
+        if rate is not None:
+            text += f"\n⚡ Throughput: {rate:.1f} msg/s"
+        return text
@@ -0,0 +1,37 @@
+import math
+import re
+from typing import List, Tuple
+
+# Не больше стольких строк в одной массовой операции
+MAX_ROWS = 10_000
+
+_SEPARATORS = re.compile(r"[,;\s]+")
+
+
+# Разбирает список "username amount" - по строке на пользователя, username с @ или без,
+# разделитель - пробел, запятая или точка с запятой (то есть подходит и CSV "username,amount").
+# Возвращает (строки, описания ошибок)
+def parse_discount_rows(text: str) -> Tuple[List[Tuple[str, float]], List[str]]:
+    rows: List[Tuple[str, float]] = []
+    errors: List[str] = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        fields = [field.strip("\"'") for field in _SEPARATORS.split(line.strip()) if field]
+        if not fields:
+            continue
+        username = fields[0].lstrip("@")
+        try:
+            amount = float(fields[1]) if len(fields) == 2 else math.nan
+        except ValueError:
+            amount = math.nan
+        if not math.isfinite(amount) or amount < 0 or not username:
+            if not rows and not errors:
+                # Первая непустая строка без числа - заголовок CSV
+                continue
+            errors.append(f"line {number}: {line.strip()[:40]}")
+            continue
+        rows.append((username, amount))
+        if len(rows) > MAX_ROWS:
+            errors.append(f"more than {MAX_ROWS} rows, the rest is ignored")
+            rows.pop()
+            break
+    return rows, errors
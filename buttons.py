@@ -0,0 +1,59 @@
+from typing import Any, Awaitable, Callable, Dict, Optional, Union
+
+from aiogram.filters import Filter
+from aiogram.types import Message
+
+ButtonHandler = Callable[[Message], Awaitable[Any]]
+
+
+# Диспетчеризация кнопок reply-клавиатуры по точному тексту.
+# Вместо десятка обработчиков с фильтром F.text == "...", которые aiogram проверяет
+# по очереди, все кнопки лежат в одном словаре: поиск обработчика - один lookup,
+# а сообщения без кнопки доходят до общего обработчика без перебора фильтров.
+class ButtonRouter:
+    def __init__(self):
+        self._handlers: Dict[str, ButtonHandler] = {}
+
+    # Пробелы по краям не важны: у кнопки "🛒 Catalog " текст с пробелом на конце
+    @staticmethod
+    def normalize(text: str) -> str:
+        return text.strip()
+
+    # Регистрирует обработчик для кнопки и её псевдонимов
+    def on(self, *texts: str) -> Callable[[ButtonHandler], ButtonHandler]:
+        def decorator(handler: ButtonHandler) -> ButtonHandler:
+            for text in texts:
+                key = self.normalize(text)
+                if key in self._handlers:
+                    raise ValueError(f"Button {key!r} is already registered")
+                self._handlers[key] = handler
+            return handler
+        return decorator
+
+    def resolve(self, text: Optional[str]) -> Optional[ButtonHandler]:
+        if not text:
+            return None
+        return self._handlers.get(self.normalize(text))
+
+    def __contains__(self, text: str) -> bool:
+        return self.normalize(text) in self._handlers
+
+    def __len__(self) -> int:
+        return len(self._handlers)
+
+    @property
+    def filter(self) -> "ButtonFilter":
+        return ButtonFilter(self)
+
+
+# Фильтр пропускает сообщение, если его текст - известная кнопка,
+# и передаёт найденный обработчик в аргумент button_handler
+class ButtonFilter(Filter):
+    def __init__(self, router: ButtonRouter):
+        self.router = router
+
+    async def __call__(self, message: Message) -> Union[bool, Dict[str, ButtonHandler]]:
+        handler = self.router.resolve(message.text)
+        if handler is None:
+            return False
+        return {"button_handler": handler}
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Union
+
+from aiogram.filters import Filter
+from aiogram.types import KeyboardButton, Message, ReplyKeyboardMarkup
+
+
+# Готовая к отправке страница каталога: текст и клавиатура собираются один раз при загрузке
+@dataclass(frozen=True)
+class Page:
+    text: str
+    parse_mode: Optional[str]
+    reply_markup: Optional[ReplyKeyboardMarkup]
+
+
+# Снимок каталога: заменяется целиком одним присваиванием, поэтому обработчики
+# никогда не видят наполовину перезагруженные данные
+@dataclass(frozen=True)
+class _Snapshot:
+    main_menu: ReplyKeyboardMarkup
+    pages: Dict[str, Page]
+
+
+def _keyboard(rows: List[List[str]]) -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=text) for text in row] for row in rows],
+        resize_keyboard=True,  # Уменьшает размер кнопок для компактного отображения
+    )
+
+
+def _text(value: Union[str, List[str]]) -> str:
+    # Многострочный текст можно хранить списком строк
+    return value if isinstance(value, str) else "\n".join(value)
+
+
+# Каталог товаров и статических страниц из JSON-файла (по умолчанию catalog.json).
+# Файл читается при старте и перечитывается при изменении, без перезапуска бота.
+class Catalog:
+    def __init__(self, path: str):
+        self.path = path
+        self._snapshot: Optional[_Snapshot] = None
+        self._mtime: Optional[float] = None
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return text.strip()
+
+    @property
+    def main_menu(self) -> ReplyKeyboardMarkup:
+        return self._snapshot.main_menu
+
+    def page(self, text: Optional[str]) -> Optional[Page]:
+        if not text:
+            return None
+        return self._snapshot.pages.get(self.normalize(text))
+
+    def load(self) -> None:
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, encoding="utf-8") as file:
+            data = json.load(file)
+        self._snapshot = self._build(data)
+        self._mtime = mtime
+        logging.info("Каталог %s загружен: %d страниц", self.path, len(self._snapshot.pages))
+
+    def _build(self, data: Dict[str, Any]) -> _Snapshot:
+        main_menu = _keyboard(data["main_menu"])
+        pages: Dict[str, Page] = {}
+        for item in data["pages"]:
+            keyboard = item.get("keyboard")
+            if keyboard == "main_menu":
+                reply_markup = main_menu
+            elif keyboard:
+                reply_markup = _keyboard(keyboard)
+            else:
+                reply_markup = None
+            page = Page(text=_text(item["text"]), parse_mode=item.get("parse_mode"), reply_markup=reply_markup)
+            for button in [item["button"], *item.get("aliases", [])]:
+                key = self.normalize(button)
+                if key in pages:
+                    raise ValueError(f"Button {key!r} is defined twice in {self.path}")
+                pages[key] = page
+        return _Snapshot(main_menu=main_menu, pages=pages)
+
+    # Следит за изменением файла и перезагружает каталог; при ошибке остаётся прежний
+    async def watch(self, interval: float = 2.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if os.stat(self.path).st_mtime != self._mtime:
+                    self.load()
+            except Exception:
+                logging.exception("Не удалось перезагрузить каталог %s, используется прежний", self.path)
+                # Не пытаемся перечитать тот же сломанный файл на каждом шаге
+                self._mtime = os.stat(self.path).st_mtime if os.path.exists(self.path) else None
+
+    @property
+    def filter(self) -> "CatalogFilter":
+        return CatalogFilter(self)
+
+
+# Фильтр пропускает сообщение, если его текст - кнопка страницы каталога,
+# и передаёт страницу в аргумент page
+class CatalogFilter(Filter):
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+
+    async def __call__(self, message: Message) -> Union[bool, Dict[str, Page]]:
+        page = self.catalog.page(message.text)
+        if page is None:
+            return False
+        return {"page": page}
@@ -0,0 +1,851 @@
+import asyncio
+import csv
+import gzip
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+import referrals
+from cache import TTLCache
+from migrations import explain_hot_queries, migrate
+from referrals import ReferralNode, ReferralStats
+
+T = TypeVar("T")
+
+USER_COLUMNS = "user_id, username, referrer_id, referrals_count, discount"
+
+
+# Строка таблицы users
+@dataclass(frozen=True)
+class User:
+    user_id: int
+    username: Optional[str]
+    referrer_id: Optional[int]
+    referrals_count: int
+    discount: float
+
+
+def _user(row: Optional[tuple]) -> Optional[User]:
+    return User(*row) if row else None
+
+
+PURCHASE_COLUMNS = "id, user_id, amount, created_at, referrer_id, referrer_bonus"
+
+
+# Строка журнала покупок
+@dataclass(frozen=True)
+class Purchase:
+    id: int
+    user_id: int
+    amount: float
+    created_at: float
+    referrer_id: Optional[int]
+    referrer_bonus: float
+
+
+# Итог продаж за период или по пользователю
+@dataclass(frozen=True)
+class Sales:
+    purchases: int
+    revenue: float
+
+
+# Маркер промаха кэша пользователей (None в кэше означает "такого пользователя нет")
+_MISSING = object()
+
+
+BROADCAST_COLUMNS = (
+    "id, text, admin_chat_id, status_message_id, status, last_user_id, sent, failed, blocked, started_at, finished_at"
+)
+
+
+# Строка таблицы broadcasts
+@dataclass(frozen=True)
+class Broadcast:
+    id: int
+    text: str
+    admin_chat_id: int
+    status_message_id: Optional[int]
+    status: str
+    last_user_id: int
+    sent: int
+    failed: int
+    blocked: int
+    started_at: float
+    finished_at: Optional[float]
+
+
+# Асинхронный слой доступа к SQLite.
+# Чтение идёт через пул потоков, у каждого потока своё соединение,
+# запись - через единственный поток-писатель, поэтому транзакции не конкурируют
+# за блокировку файла, а event loop никогда не ждёт диск.
+# С write_behind=True записи не коммитятся по одной, а копятся в очереди и
+# сбрасываются общей транзакцией раз в flush_interval секунд или по набору
+# flush_ops операций (group commit); await write() завершается после COMMIT пачки.
+# get_user обслуживается из кэша строк users; каждый метод записи обновляет
+# или сбрасывает записи кэша тех пользователей, которых он изменил.
+class Database:
+    def __init__(
+        self,
+        path: str,
+        readers: int = 4,
+        write_behind: bool = False,
+        flush_interval: float = 0.005,
+        flush_ops: int = 100,
+        synchronous: str = "NORMAL",
+        user_cache_size: int = 50_000,
+        user_cache_ttl: float = 300,
+        on_query: Optional[Callable[[str, float], None]] = None,
+    ):
+        self.path = path
+        self.readers = readers
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_ops = flush_ops
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._read_pool: Optional[ThreadPoolExecutor] = None
+        self._write_pool: Optional[ThreadPoolExecutor] = None
+        self._queue: List[Tuple[Callable[..., Any], Tuple[Any, ...], asyncio.Future]] = []
+        self._queued = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+        self._closing = False
+        self.flushes = 0
+        self.flushed_ops = 0
+        self.user_cache = TTLCache(user_cache_size, user_cache_ttl)
+        # Вызывается с (имя функции запроса, секунды ожидания результата) после каждого read/write
+        self.on_query = on_query
+        # Незавершённые чтения get_user: user_id -> метка последнего читателя
+        self._user_reads: Dict[int, object] = {}
+
+    def _connect(self, readonly: bool) -> sqlite3.Connection:
+        # isolation_level=None - транзакциями управляем сами (BEGIN IMMEDIATE / COMMIT)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute("PRAGMA busy_timeout=5000")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    def _thread_connection(self, readonly: bool) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect(readonly)
+        return conn
+
+    def _run_read(self, fn: Callable[..., T], args: Tuple[Any, ...]) -> T:
+        return fn(self._thread_connection(readonly=True), *args)
+
+    def _run_write(self, fn: Callable[..., T], args: Tuple[Any, ...]) -> T:
+        conn = self._thread_connection(readonly=False)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, *args)
+            conn.execute("COMMIT")
+        except BaseException:
+            _rollback(conn)
+            raise
+        return result
+
+    # Выполняет пачку отложенных записей одной транзакцией. Каждая операция
+    # под своим SAVEPOINT: ошибка одной откатывает только её, остальные коммитятся.
+    # Возвращает [(успех, результат или исключение)] в порядке пачки
+    def _run_batch(self, batch: List[Tuple[Callable[..., Any], Tuple[Any, ...]]]) -> List[Tuple[bool, Any]]:
+        conn = self._thread_connection(readonly=False)
+        results: List[Tuple[bool, Any]] = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for fn, args in batch:
+                conn.execute("SAVEPOINT op")
+                try:
+                    results.append((True, fn(conn, *args)))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    results.append((False, e))
+                conn.execute("RELEASE op")
+            conn.execute("COMMIT")
+        except BaseException:
+            _rollback(conn)
+            raise
+        return results
+
+    async def connect(self) -> None:
+        self._read_pool = ThreadPoolExecutor(self.readers, thread_name_prefix="db-read")
+        self._write_pool = ThreadPoolExecutor(1, thread_name_prefix="db-write")
+        loop = asyncio.get_running_loop()
+        # Миграции сами управляют транзакциями, поэтому идут мимо _run_write
+        version = await loop.run_in_executor(
+            self._write_pool, lambda: migrate(self._thread_connection(readonly=False))
+        )
+        await self.read(explain_hot_queries)
+        if self.write_behind:
+            self._closing = False
+            self._flusher = asyncio.create_task(self._flush_loop())
+        logging.info(
+            "База данных %s открыта (WAL, схема v%d, читателей: %d, отложенная запись: %s)",
+            self.path, version, self.readers,
+            f"{self.flush_interval * 1000:g} мс / {self.flush_ops} оп." if self.write_behind else "нет",
+        )
+
+    async def close(self) -> None:
+        # Сначала дописываем всё, что накопилось в очереди
+        if self._flusher is not None:
+            self._closing = True
+            self._queued.set()
+            self._full.set()
+            await self._flusher
+            self._flusher = None
+        for pool in (self._read_pool, self._write_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        self._read_pool = self._write_pool = None
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    # Выполнить fn(conn, *args) на соединении-читателе
+    async def read(self, fn: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._read_pool, self._run_read, fn, args)
+        finally:
+            if self.on_query:
+                self.on_query(fn.__name__.lstrip("_"), time.perf_counter() - started)
+
+    # Выполнить fn(conn, *args) в транзакции на соединении-писателе;
+    # в режиме write_behind - в общей транзакции ближайшего сброса очереди
+    async def write(self, fn: Callable[..., T], *args: Any) -> T:
+        started = time.perf_counter()
+        try:
+            if self.write_behind:
+                return await self._enqueue(fn, args)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._write_pool, self._run_write, fn, args)
+        finally:
+            if self.on_query:
+                self.on_query(fn.__name__.lstrip("_"), time.perf_counter() - started)
+
+    # Поставить запись в очередь, не дожидаясь её; возвращает future,
+    # которая завершится после COMMIT (ждать её нужно, только если важна надёжность)
+    def submit_write(self, fn: Callable[..., T], *args: Any) -> asyncio.Future:
+        if self.write_behind:
+            future = self._enqueue(fn, args)
+        else:
+            future = asyncio.ensure_future(self.write(fn, *args))
+        future.add_done_callback(_log_write_error)
+        return future
+
+    def _enqueue(self, fn: Callable[..., T], args: Tuple[Any, ...]) -> asyncio.Future:
+        if self._closing or self._flusher is None:
+            raise RuntimeError("База данных не открыта для записи")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((fn, args, future))
+        self._queued.set()
+        if len(self._queue) >= self.flush_ops:
+            self._full.set()
+        return future
+
+    async def _flush_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._queued.wait()
+            if not self._queue:
+                if self._closing:
+                    return
+                self._queued.clear()
+                continue
+            # Даём пачке набраться: до flush_interval или до flush_ops операций
+            if not self._full.is_set():
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            batch, self._queue = self._queue[:self.flush_ops], self._queue[self.flush_ops:]
+            if len(self._queue) < self.flush_ops:
+                self._full.clear()
+            if not self._queue and not self._closing:
+                self._queued.clear()
+
+            try:
+                results = await loop.run_in_executor(
+                    self._write_pool, self._run_batch, [(fn, args) for fn, args, _ in batch]
+                )
+            except Exception as e:
+                logging.exception("Не удалось записать пачку из %d операций", len(batch))
+                results = [(False, e)] * len(batch)
+            self.flushes += 1
+            self.flushed_ops += len(batch)
+            for (_, _, future), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    async def get_user(self, user_id: int) -> Optional[User]:
+        user = self.user_cache.get(user_id, _MISSING)
+        if user is not _MISSING:
+            return user
+        # Если за время чтения пользователя изменили, метку снимет _invalidate_users,
+        # и прочитанная (возможно, устаревшая) строка в кэш не попадёт
+        token = self._user_reads[user_id] = object()
+        try:
+            user = await self.read(_get_user, user_id)
+            if self._user_reads.get(user_id) is token:
+                self.user_cache.set(user_id, user)
+            return user
+        finally:
+            if self._user_reads.get(user_id) is token:
+                del self._user_reads[user_id]
+
+    # Сбрасывает кэш изменённых пользователей; вызывается после COMMIT
+    def _invalidate_users(self, user_ids: List[int]) -> None:
+        for user_id in user_ids:
+            self.user_cache.pop(user_id)
+            self._user_reads.pop(user_id, None)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self.user_cache),
+            "hits": self.user_cache.hits,
+            "misses": self.user_cache.misses,
+            "evictions": self.user_cache.evictions,
+            "hit_rate": self.user_cache.hit_rate,
+        }
+
+    async def get_user_by_username(self, username: str) -> Optional[User]:
+        return await self.read(_get_user_by_username, username)
+
+    # Поиск по фрагменту username (см. _search_users), лучшие совпадения первыми
+    async def search_users(self, fragment: str, limit: int = 10) -> List[User]:
+        return await self.read(_search_users, fragment, limit)
+
+    # Страница пользователей по ключу user_id: direction="next" - после cursor,
+    # "prev" - перед cursor. Возвращает (users, есть_предыдущая, есть_следующая)
+    async def users_page(self, cursor: int, direction: str = "next", limit: int = 10) -> Tuple[List[User], bool, bool]:
+        return await self.read(_users_page, cursor, direction, limit)
+
+    # Потоково выгружает всех пользователей в CSV, сжатый gzip, возвращает число строк
+    async def export_users_csv(self, path: str) -> int:
+        return await self.read(_export_users_csv, path)
+
+    async def get_invited(self, user_id: int) -> List[Tuple[Optional[str], int]]:
+        return await self.read(_get_invited, user_id)
+
+    # Добавляет пользователя; если у него есть реферер - возвращает
+    # (referrer_id, новая скидка реферера) для уведомления
+    async def add_user(
+        self, user_id: int, username: Optional[str], referrer_id: Optional[int] = None
+    ) -> Optional[Tuple[int, float]]:
+        touched: List[int] = []
+        try:
+            return await self.write(_add_user, user_id, username, referrer_id, touched)
+        finally:
+            self._invalidate_users(touched)
+
+    # Изменяет скидку на delta (скидка не может быть меньше 0), возвращает новую скидку
+    async def adjust_discount(self, user_id: int, delta: float) -> Optional[float]:
+        user = await self.write(_adjust_discount, user_id, delta)
+        self._invalidate_users([user_id])
+        if user is None:
+            return None
+        self.user_cache.set(user_id, user)
+        return user.discount
+
+    # Массовое изменение скидок по списку (username, delta) одной транзакцией.
+    # Повторы username складываются. Возвращает ([(пользователь после изменения, delta)],
+    # username, которых нет в базе)
+    async def bulk_adjust_discount(
+        self, changes: List[Tuple[str, float]]
+    ) -> Tuple[List[Tuple[User, float]], List[str]]:
+        deltas: Dict[str, float] = {}
+        names: Dict[str, str] = {}
+        for username, delta in changes:
+            deltas[username.lower()] = deltas.get(username.lower(), 0.0) + delta
+            names.setdefault(username.lower(), username)
+        users = await self.write(_bulk_adjust_discount, json.dumps(list(zip(names.values(), deltas.values()))))
+        self._invalidate_users([user.user_id for user in users])
+        for user in users:
+            self.user_cache.set(user.user_id, user)
+        updated = [(user, deltas[user.username.lower()]) for user in users]
+        found = {user.username.lower() for user in users}
+        return updated, [name for key, name in names.items() if key not in found]
+
+    # Записывает накопленную активность [(user_id, username, момент)] одной транзакцией:
+    # last_seen всех пользователей и username тех, у кого он изменился.
+    # Возвращает число обновлённых username
+    async def record_activity(self, entries: List[Tuple[int, Optional[str], float]]) -> int:
+        touched: List[int] = []
+        try:
+            return await self.write(_record_activity, json.dumps(entries), touched)
+        finally:
+            self._invalidate_users(touched)
+
+    # Сколько пользователей появлялось за каждый период: {имя: длительность в секундах} -> {имя: число}
+    async def active_users(self, periods: Dict[str, float]) -> Dict[str, int]:
+        now = time.time()
+        return await self.read(_count_active, {name: now - seconds for name, seconds in periods.items()})
+
+    async def delete_user(self, user_id: int) -> bool:
+        touched: List[int] = []
+        try:
+            return await self.write(_delete_user, user_id, touched)
+        finally:
+            self._invalidate_users(touched)
+
+    async def get_referral_stats(self, user_id: int) -> Optional[ReferralStats]:
+        return await self.read(referrals.get_referral_stats, user_id)
+
+    # Лидеры по размеру всей реферальной сети
+    async def top_referrers(self, limit: int = 10) -> List[ReferralStats]:
+        return await self.read(referrals.top_referrers, limit)
+
+    async def referral_tree(self, user_id: int, levels: int = 3, per_node: int = 5) -> Optional[ReferralNode]:
+        return await self.read(referrals.referral_tree, user_id, levels, per_node)
+
+    # Сверяет реферальную статистику с полным пересчётом и исправляет расхождения,
+    # возвращает (расхождений в referral_stats, расхождений в referrals_count)
+    async def check_referrals(self, repair: bool = True) -> Tuple[int, int]:
+        stats_drift, count_drift = await self.write(referrals.rebuild_referral_stats, repair)
+        if repair and count_drift:
+            self._user_reads.clear()
+            self.user_cache.clear()
+        return stats_drift, count_drift
+
+    # Записывает покупку и начисляет рефереру referrer_bonus процентов скидки одной транзакцией.
+    # Возвращает (покупка, новая скидка реферера или None); None - если покупка с таким
+    # idempotency_key уже записана или пользователя нет
+    async def register_purchase(
+        self, user_id: int, amount: float, idempotency_key: str, referrer_bonus: float = 10.0
+    ) -> Optional[Tuple[Purchase, Optional[float]]]:
+        result = await self.write(_register_purchase, user_id, amount, idempotency_key, referrer_bonus, time.time())
+        if result is None:
+            return None
+        purchase, referrer = result
+        if referrer is None:
+            return purchase, None
+        self._invalidate_users([referrer.user_id])
+        self.user_cache.set(referrer.user_id, referrer)
+        return purchase, referrer.discount
+
+    # Итоги продаж за всё время, текущий месяц и текущий день (UTC) - по готовым агрегатам
+    async def sales_summary(self) -> Dict[str, Sales]:
+        return await self.read(_sales_summary, time.time())
+
+    async def user_sales(self, user_id: int) -> Optional[Sales]:
+        return await self.read(_user_sales, user_id)
+
+    async def top_buyers(self, limit: int = 5) -> List[Tuple[int, Optional[str], Sales]]:
+        return await self.read(_top_buyers, limit)
+
+    # Следующая пачка получателей рассылки (без заблокировавших бота)
+    async def broadcast_recipients(self, after_id: int, limit: int) -> List[int]:
+        return await self.read(_broadcast_recipients, after_id, limit)
+
+    async def create_broadcast(self, text: str, admin_chat_id: int) -> Broadcast:
+        return await self.write(_create_broadcast, text, admin_chat_id)
+
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Broadcast]:
+        return await self.read(_get_broadcast, broadcast_id)
+
+    async def running_broadcasts(self) -> List[Broadcast]:
+        return await self.read(_running_broadcasts)
+
+    async def set_broadcast_message(self, broadcast_id: int, message_id: int) -> None:
+        await self.write(_set_broadcast_message, broadcast_id, message_id)
+
+    # Сохраняет прогресс пачки рассылки и помечает заблокировавших бота одной транзакцией
+    async def checkpoint_broadcast(
+        self, broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked_ids: List[int]
+    ) -> None:
+        await self.write(_checkpoint_broadcast, broadcast_id, last_user_id, sent, failed, blocked_ids)
+
+    async def finish_broadcast(self, broadcast_id: int, status: str) -> None:
+        await self.write(_finish_broadcast, broadcast_id, status)
+
+    # Сохранённые file_id медиафайлов: key -> (source, file_id)
+    async def media_file_ids(self) -> Dict[str, Tuple[str, str]]:
+        return await self.read(_media_file_ids)
+
+    async def set_media_file_id(self, key: str, source: str, file_id: str) -> None:
+        await self.write(_set_media_file_id, key, source, file_id)
+
+    async def delete_media_file_id(self, key: str) -> None:
+        await self.write(_delete_media_file_id, key)
+
+
+# Откат после ошибки в транзакции, в том числе после неудачного COMMIT. Некоторые ошибки
+# (например, SQLITE_FULL или I/O) SQLite откатывает сам - тогда ROLLBACK не нужен
+# и только заменил бы исходное исключение своим
+def _rollback(conn: sqlite3.Connection) -> None:
+    if conn.in_transaction:
+        conn.execute("ROLLBACK")
+
+
+def _log_write_error(future: asyncio.Future) -> None:
+    # Запись "выстрелил и забыл" никто не ждёт - ошибку хотя бы логируем
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("Отложенная запись не удалась", exc_info=future.exception())
+
+
+def _get_user(conn: sqlite3.Connection, user_id: int) -> Optional[User]:
+    row = conn.execute(f"SELECT {USER_COLUMNS} FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    return _user(row)
+
+
+def _get_user_by_username(conn: sqlite3.Connection, username: str) -> Optional[User]:
+    row = conn.execute(
+        f"SELECT {USER_COLUMNS} FROM users WHERE username = ? COLLATE NOCASE", (username,)
+    ).fetchone()
+    return _user(row)
+
+
+# Сколько совпадений берётся из индексов на каждом шаге поиска; ранжируются только они
+SEARCH_CANDIDATES = 500
+
+
+def _fts_phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+# Поиск пользователей по фрагменту username без учёта регистра:
+# сначала точное совпадение, затем username, начинающиеся с фрагмента (индекс
+# idx_users_username), затем содержащие его (триграммный индекс users_fts, миграция 9),
+# внутри группы - более короткие. Если ничего не нашлось (например, опечатка),
+# ищутся username с наибольшим числом общих с фрагментом триграмм
+def _search_users(conn: sqlite3.Connection, fragment: str, limit: int) -> List[User]:
+    fragment = fragment.strip().lstrip("@")
+    if not fragment:
+        return []
+    params = {
+        "fragment": fragment,
+        "prefix": fragment.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%",
+        "match": _fts_phrase(fragment),
+        "candidates": SEARCH_CANDIDATES,
+        "limit": limit,
+    }
+    sources = [
+        "SELECT user_id FROM (SELECT user_id FROM users WHERE username LIKE :prefix ESCAPE '\\' LIMIT :candidates)"
+    ]
+    # Триграммы находят фрагменты от трёх символов; более короткие ищутся только по началу
+    if len(fragment) >= 3:
+        sources.append(
+            "SELECT user_id FROM (SELECT rowid AS user_id FROM users_fts WHERE users_fts MATCH :match LIMIT :candidates)"
+        )
+    rows = conn.execute(f"""
+        SELECT {USER_COLUMNS} FROM users WHERE user_id IN ({" UNION ".join(sources)})
+        ORDER BY username = :fragment COLLATE NOCASE DESC, username LIKE :prefix ESCAPE '\\' DESC,
+                 length(username), username COLLATE NOCASE
+        LIMIT :limit
+    """, params).fetchall()
+    if rows or len(fragment) < 4:
+        return [User(*row) for row in rows]
+
+    # Нечёткий поиск: по каждой триграмме фрагмента берём до SEARCH_CANDIDATES
+    # пользователей и считаем, сколько триграмм у каждого совпало. Частые триграммы
+    # обрезаются лимитом, но редкие (самые отличительные) возвращаются полностью
+    lowered = fragment.lower()
+    trigrams = {lowered[i:i + 3] for i in range(len(lowered) - 2)}
+    shared: Dict[int, int] = {}
+    for trigram in trigrams:
+        for (user_id,) in conn.execute(
+            "SELECT rowid FROM users_fts WHERE users_fts MATCH ? LIMIT ?", (_fts_phrase(trigram), SEARCH_CANDIDATES)
+        ):
+            shared[user_id] = shared.get(user_id, 0) + 1
+    threshold = 1 if len(trigrams) <= 3 else max(2, len(trigrams) // 3)
+    best = sorted((user_id for user_id, count in shared.items() if count >= threshold), key=shared.get, reverse=True)
+    users = [User(*row) for row in conn.execute(
+        f"SELECT {USER_COLUMNS} FROM users WHERE user_id IN (SELECT value FROM json_each(?))",
+        (json.dumps(best[:limit * 5]),),
+    )]
+    users.sort(key=lambda user: (-shared[user.user_id], abs(len(user.username or "") - len(fragment))))
+    return users[:limit]
+
+
+def _users_page(conn: sqlite3.Connection, cursor: int, direction: str, limit: int) -> Tuple[List[User], bool, bool]:
+    if direction == "prev":
+        rows = conn.execute(
+            f"SELECT {USER_COLUMNS} FROM users WHERE user_id < ? ORDER BY user_id DESC LIMIT ?", (cursor, limit + 1)
+        ).fetchall()
+        has_prev, rows = len(rows) > limit, rows[:limit][::-1]
+        has_next = bool(rows)
+    else:
+        rows = conn.execute(
+            f"SELECT {USER_COLUMNS} FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (cursor, limit + 1)
+        ).fetchall()
+        has_next, rows = len(rows) > limit, rows[:limit]
+        has_prev = bool(rows) and conn.execute(
+            "SELECT EXISTS(SELECT 1 FROM users WHERE user_id < ?)", (rows[0][0],)
+        ).fetchone()[0] == 1
+    return [User(*row) for row in rows], has_prev, has_next
+
+
+# Обходит таблицу пачками по ключу, не держа в памяти больше одной пачки
+def _iter_users(conn: sqlite3.Connection, batch: int = 500) -> Iterator[tuple]:
+    last_id = -1
+    while True:
+        rows = conn.execute(
+            f"SELECT {USER_COLUMNS} FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (last_id, batch)
+        ).fetchall()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1][0]
+
+
+def _export_users_csv(conn: sqlite3.Connection, path: str) -> int:
+    count = 0
+    with gzip.open(path, "wt", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(USER_COLUMNS.split(", "))
+        for row in _iter_users(conn):
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def _get_invited(conn: sqlite3.Connection, user_id: int) -> List[Tuple[Optional[str], int]]:
+    return conn.execute("SELECT username, user_id FROM users WHERE referrer_id = ?", (user_id,)).fetchall()
+
+
+# В touched собираются id всех изменённых пользователей - для сброса кэша
+def _add_user(
+    conn: sqlite3.Connection, user_id: int, username: Optional[str], referrer_id: Optional[int], touched: List[int]
+) -> Optional[Tuple[int, float]]:
+    touched.append(user_id)
+    # Username уникален: если он остался у другой (устаревшей) записи, освобождаем его
+    if username:
+        touched.extend(row[0] for row in conn.execute(
+            "UPDATE users SET username = NULL WHERE username = ? COLLATE NOCASE AND user_id != ? RETURNING user_id",
+            (username, user_id),
+        ))
+
+    # Удалённый и зарегистрированный заново пользователь не может стать приглашённым своего же приглашённого
+    if referrer_id and referrals.in_downline(conn, user_id, referrer_id):
+        logging.warning("Реферер %s находится в сети пользователя %s, реферер не назначен.", referrer_id, user_id)
+        referrer_id = None
+
+    # Вставка и проверка реферера одним запросом: несуществующий реферер превращается в NULL,
+    # а для уже зарегистрированного пользователя RETURNING ничего не вернёт
+    row = conn.execute(
+        "INSERT INTO users (user_id, username, referrer_id) "
+        "VALUES (?, ?, (SELECT user_id FROM users WHERE user_id = ?)) "
+        "ON CONFLICT (user_id) DO NOTHING RETURNING referrer_id",
+        (user_id, username, referrer_id),
+    ).fetchone()
+    if row is None:
+        # Повторный /start означает, что бот снова разблокирован
+        conn.execute("UPDATE users SET blocked = 0 WHERE user_id = ? AND blocked = 1", (user_id,))
+        logging.info("Пользователь %s уже существует в базе данных.", user_id)
+        return None
+
+    referrals.user_added(conn, user_id)
+    if referrer_id and row[0] is None:
+        logging.warning("Реферальный ID %s не существует. Пользователь %s добавлен без реферера.", referrer_id, user_id)
+    referrer_id = row[0]
+    logging.info("Добавлен новый пользователь: %s, реферер: %s", user_id, referrer_id)
+    if not referrer_id:
+        return None
+
+    touched.append(referrer_id)
+    # Реферер получает +1 реферал и +2% скидки, но не больше 50% (выданное сверх лимита не отнимается)
+    discount = conn.execute(
+        "UPDATE users SET referrals_count = referrals_count + 1, discount = MAX(discount, MIN(discount + 2, 50)) "
+        "WHERE user_id = ? RETURNING discount",
+        (referrer_id,),
+    ).fetchone()[0]
+    logging.info("Скидка обновлена для пользователя %s: %s%%", referrer_id, discount)
+    return referrer_id, discount
+
+
+def _adjust_discount(conn: sqlite3.Connection, user_id: int, delta: float) -> Optional[User]:
+    row = conn.execute(
+        f"UPDATE users SET discount = MAX(discount + ?, 0) WHERE user_id = ? RETURNING {USER_COLUMNS}",
+        (delta, user_id),
+    ).fetchone()
+    return _user(row)
+
+
+def _bulk_adjust_discount(conn: sqlite3.Connection, changes_json: str) -> List[User]:
+    # Список приходит JSON-массивом [[username, delta], ...]; каждый username ищется
+    # по индексу idx_users_username, все изменения - один UPDATE
+    rows = conn.execute(
+        "UPDATE users SET discount = MAX(users.discount + c.delta, 0) "
+        "FROM (SELECT json_extract(value, '$[0]') AS username, json_extract(value, '$[1]') AS delta "
+        "FROM json_each(?)) AS c "
+        f"WHERE users.username = c.username COLLATE NOCASE RETURNING {USER_COLUMNS}",
+        (changes_json,),
+    )
+    return [User(*row) for row in rows]
+
+
+def _record_activity(conn: sqlite3.Connection, entries_json: str, touched: List[int]) -> int:
+    # Пачка приходит JSON-массивом [[user_id, username, момент], ...]
+    entries = (
+        "(SELECT json_extract(value, '$[0]') AS user_id, json_extract(value, '$[1]') AS username, "
+        "json_extract(value, '$[2]') AS seen FROM json_each(?)) AS c"
+    )
+    conn.execute(
+        f"INSERT INTO user_activity (user_id, first_seen, last_seen) SELECT user_id, seen, seen FROM {entries} "
+        "WHERE true ON CONFLICT (user_id) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)",
+        (entries_json,),
+    )
+    # Username уникален: новый username сначала освобождается у других записей (как в _add_user).
+    # OR IGNORE - на случай, если в пачке два пользователя с одним username (устаревшая запись)
+    touched.extend(row[0] for row in conn.execute(
+        f"UPDATE users SET username = NULL FROM {entries} "
+        "WHERE users.username = c.username COLLATE NOCASE AND users.user_id != c.user_id RETURNING users.user_id",
+        (entries_json,),
+    ))
+    renamed = [row[0] for row in conn.execute(
+        f"UPDATE OR IGNORE users SET username = c.username FROM {entries} "
+        "WHERE users.user_id = c.user_id AND users.username IS NOT c.username RETURNING users.user_id",
+        (entries_json,),
+    )]
+    touched.extend(renamed)
+    return len(renamed)
+
+
+def _count_active(conn: sqlite3.Connection, since: Dict[str, float]) -> Dict[str, int]:
+    return {
+        name: conn.execute("SELECT COUNT(*) FROM user_activity WHERE last_seen >= ?", (moment,)).fetchone()[0]
+        for name, moment in since.items()
+    }
+
+
+def _delete_user(conn: sqlite3.Connection, user_id: int, touched: List[int]) -> bool:
+    touched.append(user_id)
+    referrer_id = referrals.user_deleted(conn, user_id)
+    if referrer_id is not None:
+        touched.append(referrer_id)
+    return conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,)).rowcount > 0
+
+
+def _register_purchase(
+    conn: sqlite3.Connection, user_id: int, amount: float, idempotency_key: str, referrer_bonus: float, now: float
+) -> Optional[Tuple[Purchase, Optional[User]]]:
+    # Реферер определяется в момент покупки и записывается в журнал вместе с бонусом
+    row = conn.execute(
+        "INSERT INTO purchases (user_id, amount, created_at, idempotency_key, referrer_id, referrer_bonus) "
+        "SELECT u.user_id, ?, ?, ?, r.user_id, CASE WHEN r.user_id IS NULL THEN 0 ELSE ? END "
+        "FROM users u LEFT JOIN users r ON r.user_id = u.referrer_id WHERE u.user_id = ? "
+        f"ON CONFLICT (idempotency_key) DO NOTHING RETURNING {PURCHASE_COLUMNS}",
+        (amount, now, idempotency_key, referrer_bonus, user_id),
+    ).fetchone()
+    if row is None:
+        return None
+    purchase = Purchase(*row)
+    if purchase.referrer_id is None or not referrer_bonus:
+        return purchase, None
+
+    # Начисление одним UPDATE: параллельные покупки не теряют бонусы друг друга
+    referrer = conn.execute(
+        f"UPDATE users SET discount = discount + ? WHERE user_id = ? RETURNING {USER_COLUMNS}",
+        (referrer_bonus, purchase.referrer_id),
+    ).fetchone()
+    return purchase, _user(referrer)
+
+
+def _sales_summary(conn: sqlite3.Connection, now: float) -> Dict[str, Sales]:
+    periods = {
+        "all": "all",
+        "month": "month:" + time.strftime("%Y-%m", time.gmtime(now)),
+        "day": "day:" + time.strftime("%Y-%m-%d", time.gmtime(now)),
+    }
+    rows = conn.execute(
+        "SELECT period, purchases, revenue FROM sales_periods WHERE period IN (?, ?, ?)", tuple(periods.values())
+    )
+    found = {period: Sales(purchases, revenue) for period, purchases, revenue in rows}
+    return {name: found.get(period, Sales(0, 0.0)) for name, period in periods.items()}
+
+
+def _user_sales(conn: sqlite3.Connection, user_id: int) -> Optional[Sales]:
+    row = conn.execute("SELECT purchases, revenue FROM user_sales WHERE user_id = ?", (user_id,)).fetchone()
+    return Sales(*row) if row else None
+
+
+def _top_buyers(conn: sqlite3.Connection, limit: int) -> List[Tuple[int, Optional[str], Sales]]:
+    rows = conn.execute(
+        "SELECT s.user_id, u.username, s.purchases, s.revenue FROM user_sales s "
+        "LEFT JOIN users u ON u.user_id = s.user_id ORDER BY s.revenue DESC LIMIT ?",
+        (limit,),
+    )
+    return [(user_id, username, Sales(purchases, revenue)) for user_id, username, purchases, revenue in rows]
+
+
+def _broadcast_recipients(conn: sqlite3.Connection, after_id: int, limit: int) -> List[int]:
+    rows = conn.execute(
+        "SELECT user_id FROM users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?", (after_id, limit)
+    )
+    return [row[0] for row in rows]
+
+
+def _create_broadcast(conn: sqlite3.Connection, text: str, admin_chat_id: int) -> Broadcast:
+    row = conn.execute(
+        "INSERT INTO broadcasts (text, admin_chat_id, started_at) VALUES (?, ?, ?) RETURNING " + BROADCAST_COLUMNS,
+        (text, admin_chat_id, time.time()),
+    ).fetchone()
+    return Broadcast(*row)
+
+
+def _get_broadcast(conn: sqlite3.Connection, broadcast_id: int) -> Optional[Broadcast]:
+    row = conn.execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    return Broadcast(*row) if row else None
+
+
+def _running_broadcasts(conn: sqlite3.Connection) -> List[Broadcast]:
+    rows = conn.execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE status = 'running' ORDER BY id")
+    return [Broadcast(*row) for row in rows]
+
+
+def _set_broadcast_message(conn: sqlite3.Connection, broadcast_id: int, message_id: int) -> None:
+    conn.execute("UPDATE broadcasts SET status_message_id = ? WHERE id = ?", (message_id, broadcast_id))
+
+
+def _checkpoint_broadcast(
+    conn: sqlite3.Connection, broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked_ids: List[int]
+) -> None:
+    if blocked_ids:
+        conn.executemany("UPDATE users SET blocked = 1 WHERE user_id = ?", [(user_id,) for user_id in blocked_ids])
+    conn.execute(
+        "UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ? "
+        "WHERE id = ?",
+        (last_user_id, sent, failed, len(blocked_ids), broadcast_id),
+    )
+
+
+def _finish_broadcast(conn: sqlite3.Connection, broadcast_id: int, status: str) -> None:
+    conn.execute(
+        "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ?", (status, time.time(), broadcast_id)
+    )
+
+
+def _media_file_ids(conn: sqlite3.Connection) -> Dict[str, Tuple[str, str]]:
+    return {key: (source, file_id) for key, source, file_id in conn.execute("SELECT key, source, file_id FROM media")}
+
+
+def _set_media_file_id(conn: sqlite3.Connection, key: str, source: str, file_id: str) -> None:
+    conn.execute(
+        "INSERT INTO media (key, source, file_id, updated_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (key) DO UPDATE SET source = excluded.source, file_id = excluded.file_id, "
+        "updated_at = excluded.updated_at",
+        (key, source, file_id, time.time()),
+    )
+
+
+def _delete_media_file_id(conn: sqlite3.Connection, key: str) -> None:
+    conn.execute("DELETE FROM media WHERE key = ?", (key,))
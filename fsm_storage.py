@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from cache import TTLCache
+from db import Database
+
+# Запись кэша: (состояние, данные, момент истечения по time.time())
+_Entry = Tuple[Optional[str], Dict[str, Any], float]
+_EMPTY: _Entry = (None, {}, float("inf"))
+
+
+def _key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.destiny}"
+
+
+def _load(conn: sqlite3.Connection, key: str, now: float) -> Optional[Tuple[Optional[str], Optional[str], float]]:
+    return conn.execute(
+        "SELECT state, data, expires_at FROM fsm_states WHERE key = ? AND expires_at > ?", (key, now)
+    ).fetchone()
+
+
+def _save(conn: sqlite3.Connection, key: str, state: Optional[str], data: Optional[str], expires_at: float) -> None:
+    if state is None and data is None:
+        conn.execute("DELETE FROM fsm_states WHERE key = ?", (key,))
+    else:
+        conn.execute(
+            "INSERT INTO fsm_states (key, state, data, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+            "expires_at = excluded.expires_at",
+            (key, state, data, expires_at),
+        )
+
+
+def _delete_expired(conn: sqlite3.Connection, now: float, limit: int) -> int:
+    return conn.execute(
+        "DELETE FROM fsm_states WHERE key IN (SELECT key FROM fsm_states WHERE expires_at <= ? LIMIT ?)",
+        (now, limit),
+    ).rowcount
+
+
+# Хранилище FSM в SQLite (таблица fsm_states, см. миграцию 7) поверх общей Database.
+# Чтение идёт через кэш в памяти: FSM-мидлварь aiogram запрашивает состояние на
+# каждом апдейте, и повторные запросы (в том числе "состояния нет") не доходят до базы.
+# Запись сразу обновляет кэш и уходит в очередь писателя, не задерживая обработчик.
+# Состояние, не менявшееся state_ttl секунд, считается устаревшим и удаляется
+# фоновой очисткой пачками. Кэш рассчитан на то, что апдейты одного пользователя
+# обрабатывает один процесс; если это не так, cache_ttl нужно уменьшить.
+class SQLiteStorage(BaseStorage):
+    def __init__(
+        self,
+        db: Database,
+        state_ttl: float = 7 * 24 * 3600,
+        cache_size: int = 100_000,
+        cache_ttl: float = 600,
+        cleanup_interval: float = 600,
+        cleanup_batch: int = 500,
+    ):
+        self.db = db
+        self.state_ttl = state_ttl
+        self.cleanup_interval = cleanup_interval
+        self.cleanup_batch = cleanup_batch
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self._writes: Dict[str, asyncio.Future] = {}
+        self._cleanup_task: Optional[asyncio.Task] = None
+        self.expired = 0
+
+    async def start(self) -> None:
+        self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def close(self) -> None:
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+            await asyncio.gather(self._cleanup_task, return_exceptions=True)
+            self._cleanup_task = None
+        # Дожидаемся записей, ещё не дошедших до базы
+        await asyncio.gather(*self._writes.values(), return_exceptions=True)
+
+    async def _get(self, key: str) -> _Entry:
+        entry = self.cache.get(key)
+        if entry is None:
+            # Если запись из вытесненной записи кэша ещё не дошла до базы, ждём её
+            pending = self._writes.get(key)
+            if pending is not None:
+                await asyncio.gather(pending, return_exceptions=True)
+            row = await self.db.read(_load, key, time.time())
+            # Пока шло чтение, ключ могли записать - тогда свежее значение уже в кэше
+            entry = self.cache.get(key)
+            if entry is None:
+                entry = (row[0], json.loads(row[1]) if row[1] else {}, row[2]) if row else _EMPTY
+                self.cache.set(key, entry)
+        if entry[2] <= time.time():
+            self.expired += 1
+            entry = _EMPTY
+            self.cache.set(key, entry)
+        return entry
+
+    def _put(self, key: str, state: Optional[str], data: Dict[str, Any]) -> None:
+        expires_at = time.time() + self.state_ttl if state is not None or data else float("inf")
+        self.cache.set(key, (state, data, expires_at))
+        # Компактный JSON без пробелов; пустые данные хранятся как NULL
+        raw = json.dumps(data, separators=(",", ":"), ensure_ascii=False) if data else None
+        future = self.db.submit_write(_save, key, state, raw, expires_at)
+        self._writes[key] = future
+        future.add_done_callback(lambda f: self._writes.pop(key, None) if self._writes.get(key) is f else None)
+
+    async def set_state(self, bot: Bot, key: StorageKey, state: StateType = None) -> None:
+        storage_key = _key(key)
+        _, data, _ = await self._get(storage_key)
+        self._put(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, bot: Bot, key: StorageKey) -> Optional[str]:
+        return (await self._get(_key(key)))[0]
+
+    async def set_data(self, bot: Bot, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = _key(key)
+        state, _, _ = await self._get(storage_key)
+        self._put(storage_key, state, data.copy())
+
+    async def get_data(self, bot: Bot, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get(_key(key)))[1].copy()
+
+    async def _cleanup_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                await self.cleanup()
+            except Exception:
+                logging.exception("Не удалось очистить устаревшие состояния FSM")
+
+    # Удаляет истёкшие состояния пачками по cleanup_batch, каждая пачка - отдельная
+    # короткая транзакция, чтобы не задерживать остальные записи
+    async def cleanup(self) -> int:
+        deleted = 0
+        while True:
+            count = await self.db.write(_delete_expired, time.time(), self.cleanup_batch)
+            deleted += count
+            if count < self.cleanup_batch:
+                break
+        if deleted:
+            logging.info("Удалено устаревших состояний FSM: %d", deleted)
+        return deleted
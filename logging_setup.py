@@ -0,0 +1,131 @@
+import json
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import IO, Any, Dict, Optional, Tuple
+
+from aiogram.types import Update
+
+# Стандартные атрибуты LogRecord; всё остальное пришло через extra= и попадает в JSON
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "suppressed"}
+
+
+# Запись в JSON одной строкой: время, уровень, логгер, сообщение, поля из extra и трассировка
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# QueueHandler по умолчанию форматирует сообщение ещё в потоке, который пишет в лог.
+# Здесь запись уходит в очередь как есть: msg % args и трассировка собираются
+# в потоке QueueListener, event loop тратит только время на постановку в очередь
+class LazyQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# Ограничение частоты однотипных записей уровня INFO и ниже: на каждый шаблон
+# сообщения (logger + msg до подстановки аргументов) не больше burst записей сразу
+# и rate в секунду дальше. Число отброшенных записей приписывается к следующей
+# пропущенной записи этого шаблона (поле suppressed). WARNING и выше не ограничиваются
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate: float = 10, burst: float = 20, max_keys: int = 10_000):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: Dict[Tuple[str, Any], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.clear()
+                # [токены, время обновления, отброшено с прошлой записи]
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+# Краткое описание апдейта для логов ошибок вместо полного repr
+def update_summary(update: Optional[Update]) -> Dict[str, Any]:
+    if update is None:
+        return {}
+    summary: Dict[str, Any] = {"update_id": update.update_id}
+    if update.message:
+        message = update.message
+        text = message.text or message.caption or ""
+        summary.update(
+            type="message",
+            chat_id=message.chat.id,
+            user_id=message.from_user.id if message.from_user else None,
+            text=text[:64],
+        )
+    elif update.callback_query:
+        summary.update(
+            type="callback_query",
+            user_id=update.callback_query.from_user.id,
+            data=(update.callback_query.data or "")[:64],
+        )
+    else:
+        summary["type"] = next(
+            (name for name, value in update if value is not None and name != "update_id"), "unknown"
+        )
+    return summary
+
+
+# Настраивает корневой логгер: записи через очередь уходят в поток QueueListener,
+# который пишет их в stream (по умолчанию stderr) в JSON или обычным текстом.
+# Возвращает запущенный listener - его нужно остановить при выходе, чтобы дописать очередь
+def setup_logging(
+    level: str = "INFO", json_format: bool = True, info_rate: float = 10, stream: Optional[IO[str]] = None
+) -> QueueListener:
+    output = logging.StreamHandler(stream)
+    if json_format:
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = LazyQueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter(rate=info_rate, burst=info_rate * 2))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    # Строка aiogram о каждом обработанном апдейте дублирует метрики; видна с LOG_LEVEL=DEBUG
+    if root.level > logging.DEBUG:
+        logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from db import Database
+
+# Метод отправки и способ достать file_id из ответа для каждого вида медиа
+_KINDS = {
+    "photo": ("send_photo", lambda message: message.photo[-1].file_id),
+    "animation": ("send_animation", lambda message: message.animation.file_id),
+    "video": ("send_video", lambda message: message.video.file_id),
+    "document": ("send_document", lambda message: message.document.file_id),
+}
+
+# Ответы Telegram, означающие, что сам file_id больше не годится. Остальные ошибки
+# (например, неразбираемая подпись) повторятся и при загрузке - кэш не трогаем
+_STALE_FILE_ID_ERRORS = ("wrong file identifier", "file reference", "wrong remote file")
+
+
+def _is_stale_file_id(error: TelegramBadRequest) -> bool:
+    message = str(error).lower()
+    return any(marker in message for marker in _STALE_FILE_ID_ERRORS)
+
+
+# Реестр медиафайлов бота. Каждый файл загружается в Telegram один раз (с диска
+# или по URL), полученный file_id хранится в таблице media и дальше отправляется
+# вместо файла. Если Telegram перестал принимать file_id, файл загружается заново.
+class MediaRegistry:
+    def __init__(self, bot: Bot, db: Database):
+        self.bot = bot
+        self.db = db
+        self._assets: Dict[str, Tuple[str, str]] = {}
+        self._file_ids: Dict[str, str] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.uploads = 0
+        self.reuses = 0
+
+    # source - путь к локальному файлу или URL
+    def register(self, key: str, source: str, kind: str = "photo") -> None:
+        if kind not in _KINDS:
+            raise ValueError(f"Unsupported media kind: {kind}")
+        self._assets[key] = (kind, source)
+
+    async def load(self) -> None:
+        for key, (source, file_id) in (await self.db.media_file_ids()).items():
+            # Если источник файла поменялся, старый file_id больше не подходит
+            if key in self._assets and self._assets[key][1] == source:
+                self._file_ids[key] = file_id
+
+    async def send(self, key: str, chat_id: int, **kwargs: Any) -> Message:
+        kind, source = self._assets[key]
+        method_name, _ = _KINDS[kind]
+        file_id = self._file_ids.get(key)
+        if file_id:
+            try:
+                message = await getattr(self.bot, method_name)(chat_id, file_id, **kwargs)
+                self.reuses += 1
+                return message
+            except TelegramBadRequest as e:
+                if not _is_stale_file_id(e):
+                    raise
+                logging.warning("file_id медиа '%s' отклонён (%s), загружаем заново", key, e)
+                if self._file_ids.get(key) == file_id:
+                    del self._file_ids[key]
+                    await self.db.delete_media_file_id(key)
+
+        # Первую загрузку делает один обработчик, остальные ждут и берут её file_id
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            file_id = self._file_ids.get(key)
+            if file_id:
+                self.reuses += 1
+                return await getattr(self.bot, method_name)(chat_id, file_id, **kwargs)
+            return await self._upload(key, kind, source, chat_id, **kwargs)
+
+    async def _upload(self, key: str, kind: str, source: str, chat_id: int, **kwargs: Any) -> Message:
+        method_name, extract_file_id = _KINDS[kind]
+        media = source if source.startswith(("http://", "https://")) else FSInputFile(source)
+        message = await getattr(self.bot, method_name)(chat_id, media, **kwargs)
+        self.uploads += 1
+        file_id = extract_file_id(message)
+        self._file_ids[key] = file_id
+        await self.db.set_media_file_id(key, source, file_id)
+        logging.info("Медиа '%s' загружено из %s, file_id сохранён", key, os.path.basename(source) or source)
+        return message
+
+    def file_id(self, key: str) -> Optional[str]:
+        return self._file_ids.get(key)
@@ -0,0 +1,192 @@
+import time
+from bisect import bisect_left
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.methods import Response, TelegramMethod
+from aiogram.types import TelegramObject
+from aiohttp import web
+
+# Границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Гистограмма с фиксированными корзинами: запись - бинарный поиск и два сложения,
+# квантили оцениваются интерполяцией внутри корзины
+class Histogram:
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else lower
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.bounds[-1]
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+
+# Все метрики бота: задержки обработчиков, запросов к базе и к Bot API,
+# ожидание апдейтов в очереди, исходы апдейтов и произвольные показатели (gauge), снимаемые в момент выдачи
+class Metrics:
+    def __init__(self):
+        self.updates: Counter = Counter()
+        self.handlers: Dict[str, Histogram] = {}
+        self.sql: Dict[str, Histogram] = {}
+        self.api: Dict[str, Histogram] = {}
+        self.waits: Dict[str, Histogram] = {}
+        self.api_errors: Counter = Counter()
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self.started = time.time()
+
+    @staticmethod
+    def _observe(histograms: Dict[str, Histogram], name: str, seconds: float) -> None:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def observe_handler(self, name: str, seconds: float) -> None:
+        self._observe(self.handlers, name, seconds)
+
+    def observe_sql(self, name: str, seconds: float) -> None:
+        self._observe(self.sql, name, seconds)
+
+    def observe_api(self, name: str, seconds: float) -> None:
+        self._observe(self.api, name, seconds)
+
+    def observe_wait(self, name: str, seconds: float) -> None:
+        self._observe(self.waits, name, seconds)
+
+    def gauge(self, name: str, read: Callable[[], float]) -> None:
+        self.gauges[name] = read
+
+    # Самые затратные по суммарному времени: [(имя, гистограмма)]
+    @staticmethod
+    def top(histograms: Dict[str, Histogram], limit: int = 5) -> List[Tuple[str, Histogram]]:
+        return sorted(histograms.items(), key=lambda item: item[1].sum, reverse=True)[:limit]
+
+    # Текстовый формат Prometheus
+    def prometheus(self) -> str:
+        lines = ["# TYPE bot_updates_total counter"]
+        for result, count in sorted(self.updates.items()):
+            lines.append(f'bot_updates_total{{result="{result}"}} {count}')
+        for metric, label, histograms in (
+            ("bot_handler_seconds", "handler", self.handlers),
+            ("bot_sql_seconds", "query", self.sql),
+            ("bot_api_seconds", "method", self.api),
+            ("bot_update_wait_seconds", "type", self.waits),
+        ):
+            lines.append(f"# TYPE {metric} histogram")
+            for name, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{label}="{name}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.sum}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+        lines.append("# TYPE bot_api_errors_total counter")
+        for (method, error), count in sorted(self.api_errors.items()):
+            lines.append(f'bot_api_errors_total{{method="{method}",error="{error}"}} {count}')
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+
+# Внешняя мидлварь апдейтов: считает обработанные, необработанные и упавшие апдейты.
+# Регистрируется раньше остальных пользовательских мидлварей
+class UpdateMetricsMiddleware(BaseMiddleware):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        try:
+            result = await handler(event, data)
+        except Exception:
+            self.metrics.updates["error"] += 1
+            raise
+        self.metrics.updates["unhandled" if result is UNHANDLED else "handled"] += 1
+        return result
+
+
+# Внутренняя мидлварь наблюдателей (message, callback_query): задержка каждого обработчика
+class HandlerMetricsMiddleware(BaseMiddleware):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_object = data.get("handler")
+            name = handler_object.callback.__name__ if handler_object else "unknown"
+            self.metrics.observe_handler(name, time.perf_counter() - started)
+
+
+# Мидлварь сессии бота: задержка и ошибки каждого запроса к Bot API
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    async def __call__(
+        self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod
+    ) -> Response:
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            self.metrics.api_errors[(name, type(e).__name__)] += 1
+            raise
+        finally:
+            self.metrics.observe_api(name, time.perf_counter() - started)
+
+
+# Локальный HTTP-эндпоинт /metrics в формате Prometheus
+async def start_metrics_server(metrics: Metrics, host: str, port: int) -> web.AppRunner:
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(
+            text=metrics.prometheus(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,115 @@
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Iterable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from cache import TTLCache
+
+
+# Лимит токен-бакета: burst запросов сразу, дальше rate запросов в секунду
+@dataclass(frozen=True)
+class RateLimit:
+    burst: float
+    rate: float
+
+
+# Лимиты по видам апдейтов: отдельные команды, прочие команды, кнопки/текст, inline-кнопки
+THROTTLE_LIMITS = {
+    "start": RateLimit(burst=1, rate=0.5),
+    "command": RateLimit(burst=3, rate=1),
+    "text": RateLimit(burst=5, rate=2),
+    "callback": RateLimit(burst=5, rate=2),
+}
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.warned = False
+
+
+# Определяет, какой лимит применять к апдейту
+def throttle_key(update: Update) -> str:
+    if update.message:
+        text = update.message.text or update.message.caption or ""
+        if text.startswith("/"):
+            command = text.split(maxsplit=1)[0][1:].split("@", 1)[0].lower()
+            return command if command in THROTTLE_LIMITS else "command"
+        return "text"
+    if update.callback_query:
+        return "callback"
+    return "text"
+
+
+# Ограничение частоты апдейтов от каждого пользователя.
+# Бакеты хранятся в TTLCache: неактивный пользователь через ttl секунд снова имеет
+# полный бакет, поэтому его запись можно выбросить, и память не растёт с числом пользователей.
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(
+        self,
+        limits: Dict[str, RateLimit] = THROTTLE_LIMITS,
+        maxsize: int = 100_000,
+        ttl: float = 60,
+        exempt: Iterable[int] = (),
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.limits = limits
+        self.exempt = frozenset(exempt)
+        self.clock = clock
+        self.buckets = TTLCache(maxsize=maxsize, ttl=ttl, clock=clock)
+        self.passed = 0
+        self.dropped: Counter = Counter()
+
+    def allow(self, user_id: int, key: str) -> TokenBucket:
+        limit = self.limits[key]
+        now = self.clock()
+        bucket = self.buckets.get((user_id, key))
+        if bucket is None:
+            bucket = TokenBucket(limit.burst, now)
+        else:
+            bucket.tokens = min(limit.burst, bucket.tokens + (now - bucket.updated) * limit.rate)
+            bucket.updated = now
+        self.buckets.set((user_id, key), bucket)
+        return bucket
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        key = throttle_key(event)
+        bucket = self.allow(user.id, key)
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.warned = False
+            self.passed += 1
+            return await handler(event, data)
+
+        self.dropped[key] += 1
+        # Предупреждаем один раз, пока бакет не восстановится, чтобы не отвечать на каждый спам
+        if not bucket.warned:
+            bucket.warned = True
+            if event.message:
+                await event.message.answer("⏳ Please wait before using this command again.")
+            elif event.callback_query:
+                await event.callback_query.answer("⏳ Please wait a moment.")
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "passed": self.passed,
+            "dropped": dict(self.dropped),
+            "tracked_buckets": len(self.buckets),
+            "evicted_buckets": self.buckets.evictions,
+        }
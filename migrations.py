@@ -0,0 +1,286 @@
+import logging
+import sqlite3
+from typing import Callable, List, Tuple
+
+
+# Миграции схемы. Номер миграции = её позиция в списке (начиная с 1),
+# применённая версия хранится в PRAGMA user_version.
+# Новые шаги добавляются только в конец списка, старые не меняются.
+
+def _m001_users(conn: sqlite3.Connection) -> None:
+    # Таблица пользователей
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            referrer_id INTEGER,
+            referrals_count INTEGER DEFAULT 0,
+            discount REAL DEFAULT 0.0
+        )
+    """)
+    # В старых базах колонки discount может не быть
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+    if "discount" not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN discount REAL DEFAULT 0.0")
+
+
+def _m002_username_index(conn: sqlite3.Connection) -> None:
+    # Username в Telegram уникален без учёта регистра. Если в базе остались
+    # устаревшие дубликаты, оставляем username только у последней добавленной записи.
+    conn.execute("""
+        UPDATE users SET username = NULL
+        WHERE username IS NOT NULL AND rowid NOT IN (
+            SELECT MAX(rowid) FROM users WHERE username IS NOT NULL GROUP BY username COLLATE NOCASE
+        )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)")
+
+
+def _m003_referrer_index(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users (referrer_id)")
+
+
+def _m004_broadcasts(conn: sqlite3.Connection) -> None:
+    # Пользователи, заблокировавшие бота, пропускаются при рассылках
+    conn.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+    # Рассылки с контрольной точкой: last_user_id - последний обработанный получатель
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY,
+            text TEXT NOT NULL,
+            admin_chat_id INTEGER NOT NULL,
+            status_message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            started_at REAL NOT NULL,
+            finished_at REAL
+        )
+    """)
+
+
+def _m005_media(conn: sqlite3.Connection) -> None:
+    # file_id загруженных в Telegram медиафайлов, чтобы не загружать их повторно
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS media (
+            key TEXT PRIMARY KEY,
+            source TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+
+def _m006_referral_stats(conn: sqlite3.Connection) -> None:
+    # Материализованная сводка реферального дерева (см. referrals.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS referral_stats (
+            user_id INTEGER PRIMARY KEY,
+            invited INTEGER NOT NULL DEFAULT 0,
+            downline INTEGER NOT NULL DEFAULT 0,
+            depth INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_stats_top ON referral_stats (downline DESC, invited DESC)")
+    # Заполняем по текущим данным; заодно исправляются разошедшиеся referrals_count.
+    # Пересчёт записан здесь, а не взят из referrals.py: шаг миграции не должен меняться
+    # вместе с рабочим кодом. Обход ограничен 100 уровнями на случай зацикленной цепочки
+    conn.execute("DELETE FROM referral_stats")
+    conn.execute("""
+        INSERT INTO referral_stats (user_id, invited, downline, depth)
+        WITH RECURSIVE closure(ancestor, user_id, distance) AS (
+            SELECT u.referrer_id, u.user_id, 1 FROM users u JOIN users r ON r.user_id = u.referrer_id
+            UNION ALL
+            SELECT r.referrer_id, c.user_id, c.distance + 1 FROM closure c
+            JOIN users r ON r.user_id = c.ancestor
+            JOIN users rr ON rr.user_id = r.referrer_id
+            WHERE c.distance < 100
+        ),
+        totals(user_id, invited, downline, depth) AS (
+            SELECT ancestor, SUM(distance = 1), COUNT(*), MAX(distance) FROM closure GROUP BY ancestor
+        )
+        SELECT u.user_id, COALESCE(t.invited, 0), COALESCE(t.downline, 0), COALESCE(t.depth, 0)
+        FROM users u LEFT JOIN totals t ON t.user_id = u.user_id
+    """)
+    conn.execute("""
+        UPDATE users SET referrals_count = rs.invited FROM referral_stats rs
+        WHERE rs.user_id = users.user_id AND users.referrals_count IS NOT rs.invited
+    """)
+
+
+def _m007_fsm_states(conn: sqlite3.Connection) -> None:
+    # Состояния FSM: key = "bot_id:chat_id:user_id:destiny", data - компактный JSON или NULL
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_expires_at ON fsm_states (expires_at)")
+
+
+def _m008_purchases(conn: sqlite3.Connection) -> None:
+    # Журнал покупок только на добавление; idempotency_key не даёт зарегистрировать
+    # одну и ту же покупку дважды (например, при повторной доставке апдейта)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS purchases (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            created_at REAL NOT NULL,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            referrer_id INTEGER,
+            referrer_bonus REAL NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_id ON purchases (user_id)")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS purchases_no_update BEFORE UPDATE ON purchases
+        BEGIN SELECT RAISE(ABORT, 'purchases is append-only'); END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS purchases_no_delete BEFORE DELETE ON purchases
+        BEGIN SELECT RAISE(ABORT, 'purchases is append-only'); END
+    """)
+
+    # Агрегаты обновляются триггером в той же транзакции, что и вставка покупки:
+    # итоги по пользователю и по периодам ('all', 'month:YYYY-MM', 'day:YYYY-MM-DD', UTC)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_sales (
+            user_id INTEGER PRIMARY KEY,
+            purchases INTEGER NOT NULL,
+            revenue REAL NOT NULL,
+            last_purchase_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_sales_revenue ON user_sales (revenue DESC)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sales_periods (
+            period TEXT PRIMARY KEY,
+            purchases INTEGER NOT NULL,
+            revenue REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS purchases_aggregate AFTER INSERT ON purchases
+        BEGIN
+            INSERT INTO user_sales (user_id, purchases, revenue, last_purchase_at)
+            VALUES (NEW.user_id, 1, NEW.amount, NEW.created_at)
+            ON CONFLICT (user_id) DO UPDATE SET
+                purchases = purchases + 1,
+                revenue = revenue + excluded.revenue,
+                last_purchase_at = MAX(last_purchase_at, excluded.last_purchase_at);
+            INSERT INTO sales_periods (period, purchases, revenue)
+            VALUES
+                ('all', 1, NEW.amount),
+                ('month:' || strftime('%Y-%m', NEW.created_at, 'unixepoch'), 1, NEW.amount),
+                ('day:' || strftime('%Y-%m-%d', NEW.created_at, 'unixepoch'), 1, NEW.amount)
+            ON CONFLICT (period) DO UPDATE SET
+                purchases = purchases + 1,
+                revenue = revenue + excluded.revenue;
+        END
+    """)
+
+
+def _m009_users_fts(conn: sqlite3.Connection) -> None:
+    # Триграммный индекс username для поиска по фрагменту (/find). Таблица с внешним
+    # содержимым: сами username хранятся только в users, индекс синхронизируют триггеры.
+    # Строки с username = NULL тоже проходят через триггеры - в индекс они ничего не добавляют
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            username, content='users', content_rowid='user_id', tokenize='trigram'
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO users_fts (rowid, username) VALUES (NEW.user_id, NEW.username);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users
+        BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username) VALUES ('delete', OLD.user_id, OLD.username);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username ON users
+        BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username) VALUES ('delete', OLD.user_id, OLD.username);
+            INSERT INTO users_fts (rowid, username) VALUES (NEW.user_id, NEW.username);
+        END
+    """)
+    conn.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+
+def _m010_user_activity(conn: sqlite3.Connection) -> None:
+    # Первое и последнее появление пользователя (пишет ActivityTracker пачками).
+    # Отдельно от users, чтобы частые обновления не трогали строки users и их кэш
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_activity (
+            user_id INTEGER PRIMARY KEY,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_activity_last_seen ON user_activity (last_seen)")
+
+
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _m001_users,
+    _m002_username_index,
+    _m003_referrer_index,
+    _m004_broadcasts,
+    _m005_media,
+    _m006_referral_stats,
+    _m007_fsm_states,
+    _m008_purchases,
+    _m009_users_fts,
+    _m010_user_activity,
+]
+
+
+# Применяет недостающие миграции, каждую в своей транзакции вместе с новым user_version.
+# Соединение должно быть в режиме autocommit (isolation_level=None).
+def migrate(conn: sqlite3.Connection) -> int:
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        logging.info("Применена миграция %d: %s", number, step.__name__)
+    return len(MIGRATIONS)
+
+
+# Запросы горячего пути, план которых проверяется при старте
+HOT_QUERIES: List[Tuple[str, str, tuple]] = [
+    ("user by id", "SELECT * FROM users WHERE user_id = ?", (0,)),
+    ("user by username", "SELECT * FROM users WHERE username = ? COLLATE NOCASE", ("",)),
+    ("username prefix", "SELECT user_id FROM users WHERE username LIKE ? ESCAPE '\\'", ("a%",)),
+    ("active users", "SELECT COUNT(*) FROM user_activity WHERE last_seen >= ?", (0,)),
+    ("invited users", "SELECT username, user_id FROM users WHERE referrer_id = ?", (0,)),
+    (
+        "top referrers",
+        "SELECT user_id FROM referral_stats WHERE downline > 0 ORDER BY downline DESC, invited DESC LIMIT 10",
+        (),
+    ),
+]
+
+
+# Логирует EXPLAIN QUERY PLAN для горячих запросов и предупреждает о полном сканировании
+def explain_hot_queries(conn: sqlite3.Connection) -> None:
+    for name, sql, params in HOT_QUERIES:
+        plan = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        if any(detail.startswith("SCAN") for detail in plan):
+            logging.warning("Запрос '%s' сканирует таблицу: %s", name, "; ".join(plan))
+        else:
+            logging.info("План запроса '%s': %s", name, "; ".join(plan))
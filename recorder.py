@@ -0,0 +1,257 @@
+import asyncio
+import glob
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+# Администратор в записи всегда получает этот id: при воспроизведении ADMIN_ID=1
+RECORDED_ADMIN_ID = 1
+
+# Аргументы команд, в которых передаются id и username пользователей
+ID_COMMANDS = {"start", "user", "delete_user"}
+USERNAME_COMMANDS = {
+    "userstat", "referral_tree", "give_discount", "remove_discount", "register_purchase", "sales", "find",
+}
+# Списки "@username amount" по строке на пользователя (формат bulk.parse_discount_rows)
+BULK_COMMANDS = {"give_discount_bulk", "remove_discount_bulk"}
+# Callback data с id пользователей в числовых полях (UsersPage, UserProfile)
+ID_CALLBACKS = {"users", "profile"}
+
+_WHITESPACE = re.compile(r"(\s+)")
+# Первое поле строки списка - username, с @ и в кавычках или без
+_BULK_USERNAME = re.compile(r"^(\s*[\"']?@?)([^,;\s\"']+)")
+
+_PERSONAL_FIELDS = ("first_name", "last_name", "phone_number", "bio")
+
+
+# Стабильная анонимизация по секрету: один и тот же id (username) всегда превращается
+# в один и тот же, поэтому связи между апдейтами и с копией базы сохраняются, а
+# восстановить исходные значения без секрета нельзя. Анонимные id не пересекаются
+# с настоящими (они от 10^13), знак сохраняется - у групп id отрицательные
+class Anonymizer:
+    def __init__(self, secret: str, admin_ids: Iterable[int] = ()):
+        self._key = secret.encode()
+        self.admin_ids = set(admin_ids)
+
+    def _digest(self, value: str) -> str:
+        return hmac.new(self._key, value.encode(), hashlib.sha256).hexdigest()
+
+    def user_id(self, value: Optional[int]) -> Optional[int]:
+        if value is None or value == 0:
+            return value
+        if value in self.admin_ids:
+            return RECORDED_ADMIN_ID
+        mapped = 10 ** 13 + int(self._digest(str(abs(value)))[:12], 16) % 10 ** 12
+        return mapped if value > 0 else -mapped
+
+    def username(self, value: Optional[str]) -> Optional[str]:
+        if not value:
+            return value
+        # Username сравниваются без учёта регистра - и анонимные тоже
+        return "u" + self._digest(value.lower())[:10]
+
+    # Заменяет id, username и имена во всём апдейте (словарь из Update.json)
+    def update(self, data: Any) -> Any:
+        if isinstance(data, list):
+            return [self.update(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        result = {}
+        # Пользователь (is_bot) или чат (type) - у них id это id пользователя/чата
+        is_peer = "is_bot" in data or "type" in data and "id" in data and isinstance(data["id"], int)
+        for key, value in data.items():
+            if key in ("id", "user_id") and is_peer or key == "user_id":
+                result[key] = self.user_id(value)
+            elif key == "username":
+                result[key] = self.username(value)
+            elif key in _PERSONAL_FIELDS:
+                result[key] = "User" if key == "first_name" else None
+            elif key in ("text", "caption") and isinstance(value, str) and value.startswith("/"):
+                result[key] = self._command(value)
+            elif key == "data" and isinstance(value, str):
+                result[key] = self._callback_data(value)
+            else:
+                result[key] = self.update(value)
+        return {key: value for key, value in result.items() if value is not None}
+
+    # Разделители между аргументами сохраняются, чтобы команда разбиралась так же, как исходная
+    def _command(self, text: str) -> str:
+        command, *rest = _WHITESPACE.split(text, maxsplit=1)
+        if not rest:
+            return text
+        separator, args = rest
+        name = command[1:].split("@", 1)[0].lower()
+        if name in BULK_COMMANDS:
+            args = "\n".join(
+                _BULK_USERNAME.sub(lambda match: match.group(1) + self.username(match.group(2)), line)
+                for line in args.split("\n")
+            )
+        elif name in ID_COMMANDS:
+            tokens = _WHITESPACE.split(args)
+            args = "".join(
+                str(self.user_id(int(token))) if token.lstrip("-").isdigit() else token for token in tokens
+            )
+        elif name in USERNAME_COMMANDS:
+            # Первый аргумент - username (для /find - фрагмент, он тоже не сохраняется как есть)
+            first, *tail = _WHITESPACE.split(args, maxsplit=1)
+            prefix = "@" if first.startswith("@") else ""
+            args = prefix + self.username(first.lstrip("@")) + "".join(tail)
+        return command + separator + args
+
+    def _callback_data(self, data: str) -> str:
+        parts = data.split(":")
+        if parts[0] not in ID_CALLBACKS:
+            return data
+        return ":".join(
+            [parts[0]] + [str(self.user_id(int(part))) if part.isdigit() else part for part in parts[1:]]
+        )
+
+
+# Внешняя мидлварь апдейтов, которая пишет все входящие апдейты в сжатый JSONL
+# (строка - {"t": время получения, "update": апдейт}) для воспроизведения в bench.replay.
+# В обработчике апдейт только добавляется в буфер; сериализация, анонимизация и
+# сжатие идут в отдельном потоке раз в flush_interval. Файл сменяется, когда
+# сжатый размер достигает rotate_bytes, хранятся keep последних файлов.
+# Если запись не успевает и в буфере больше max_buffer апдейтов, новые отбрасываются
+class UpdateRecorder(BaseMiddleware):
+    def __init__(
+        self,
+        directory: str,
+        anonymizer: Anonymizer,
+        rotate_bytes: int = 64 * 2 ** 20,
+        keep: int = 20,
+        flush_interval: float = 1.0,
+        max_buffer: int = 100_000,
+    ):
+        self.directory = directory
+        self.anonymizer = anonymizer
+        self.rotate_bytes = rotate_bytes
+        self.keep = keep
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer: List[Tuple[float, Update]] = []
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._task: Optional[asyncio.Task] = None
+        self._raw = None
+        self._file: Optional[gzip.GzipFile] = None
+        self.path: Optional[str] = None
+        self.recorded = 0
+        self.dropped = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if len(self._buffer) < self.max_buffer:
+            self._buffer.append((time.time(), event))
+        else:
+            self.dropped += 1
+        return await handler(event, data)
+
+    async def start(self) -> None:
+        self._pool = ThreadPoolExecutor(1, thread_name_prefix="update-recorder")
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._pool:
+            await self.flush()
+            await asyncio.get_running_loop().run_in_executor(self._pool, self._close_file)
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        if self.dropped:
+            logging.warning("Запись апдейтов не успевала: пропущено %d апдейтов", self.dropped)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Не удалось записать апдейты в %s", self.directory)
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        await asyncio.get_running_loop().run_in_executor(self._pool, self._write, batch)
+        self.recorded += len(batch)
+
+    def _write(self, batch: List[Tuple[float, Update]]) -> None:
+        if self._file is None:
+            self._open_file()
+        lines = []
+        for received_at, update in batch:
+            data = self.anonymizer.update(json.loads(update.json(by_alias=True, exclude_none=True)))
+            lines.append(json.dumps({"t": round(received_at, 6), "update": data}, ensure_ascii=False,
+                                    separators=(",", ":")))
+        self._file.write(("\n".join(lines) + "\n").encode())
+        # Сброс сжатого потока на диск: записанное читается, даже если процесс упадёт
+        self._file.flush()
+        if self._raw.tell() >= self.rotate_bytes:
+            self._close_file()
+
+    def _open_file(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        name = f"updates-{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now * 1000) % 1000:03d}.jsonl.gz"
+        self.path = os.path.join(self.directory, name)
+        self._raw = open(self.path, "ab")
+        self._file = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=6)
+        self._rotate()
+
+    def _close_file(self) -> None:
+        if self._file is None:
+            return
+        self._file.close()
+        self._raw.close()
+        self._file = self._raw = None
+        logging.info("Запись апдейтов сохранена в %s", self.path)
+
+    def recordings(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.directory, "updates-*.jsonl.gz")))
+
+    def _rotate(self) -> None:
+        for old in self.recordings()[:-self.keep] if self.keep > 0 else []:
+            os.remove(old)
+            logging.info("Удалена старая запись апдейтов %s", old)
+
+
+# Читает записи по порядку: (время получения, апдейт в виде словаря). Каталоги
+# разворачиваются в лежащие в них файлы. Незавершённый хвост файла (процесс
+# остановлен без close или файл ещё пишется) пропускается
+def read_recording(paths: Iterable[str]) -> Iterator[Tuple[float, Dict[str, Any]]]:
+    files: List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "updates-*.jsonl.gz"))))
+        else:
+            files.append(path)
+    for path in files:
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            try:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.warning("Пропущена повреждённая строка в %s", path)
+                        continue
+                    yield record["t"], record["update"]
+            except (EOFError, zlib.error, gzip.BadGzipFile):
+                logging.warning("Запись %s оборвана, прочитано до обрыва", path)
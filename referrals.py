@@ -0,0 +1,244 @@
+import logging
+import sqlite3
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+# Реферальное дерево строится по users.referrer_id, а его сводка хранится
+# материализованно в referral_stats (см. миграцию 6): для каждого пользователя
+# invited - прямые приглашённые, downline - все приглашённые по цепочке,
+# depth - число уровней под ним. Таблица обновляется инкрементально при
+# добавлении и удалении пользователя, а rebuild_referral_stats пересчитывает её целиком.
+
+# Ограничение глубины обхода - защита от зацикленной цепочки рефереров
+MAX_DEPTH = 100
+
+# Предки пользователя ? с расстоянием до него (1 - его реферер).
+# Обход останавливается на удалённом пользователе: его предки уже не связаны с поддеревом
+_ANCESTORS = f"""
+    WITH RECURSIVE up(user_id, distance) AS (
+        SELECT referrer_id, 1 FROM users WHERE user_id = ? AND referrer_id IS NOT NULL
+        UNION ALL
+        SELECT u.referrer_id, up.distance + 1 FROM up JOIN users u ON u.user_id = up.user_id
+        WHERE u.referrer_id IS NOT NULL AND up.distance < {MAX_DEPTH}
+    )
+"""
+
+# Потомки пользователя ? с расстоянием до него (1 - прямые приглашённые)
+_DESCENDANTS = f"""
+    WITH RECURSIVE down(user_id, distance) AS (
+        SELECT user_id, 1 FROM users WHERE referrer_id = ?
+        UNION ALL
+        SELECT u.user_id, down.distance + 1 FROM down JOIN users u ON u.referrer_id = down.user_id
+        WHERE down.distance < {MAX_DEPTH}
+    )
+"""
+
+STATS_COLUMNS = "rs.user_id, u.username, rs.invited, rs.downline, rs.depth"
+
+
+# Строка referral_stats вместе с username
+@dataclass(frozen=True)
+class ReferralStats:
+    user_id: int
+    username: Optional[str]
+    invited: int
+    downline: int
+    depth: int
+
+
+# Узел дерева для /referral_tree; hidden - сколько прямых приглашённых не показано
+@dataclass
+class ReferralNode:
+    stats: ReferralStats
+    children: List["ReferralNode"] = field(default_factory=list)
+    hidden: int = 0
+
+
+# Есть ли candidate среди потомков user_id (проверяется подъёмом от candidate,
+# это дешевле обхода всей сети). Нужна при повторной регистрации удалённого
+# пользователя: его прежние приглашённые остаются в базе, и назначить одного
+# из них его реферером значит замкнуть цепочку в цикл
+def in_downline(conn: sqlite3.Connection, user_id: int, candidate: int) -> bool:
+    row = conn.execute(
+        f"{_ANCESTORS} SELECT EXISTS(SELECT 1 FROM up WHERE user_id = ?)", (candidate, user_id)
+    ).fetchone()
+    return row[0] == 1
+
+
+# Вызывается в транзакции сразу после вставки пользователя в users
+def user_added(conn: sqlite3.Connection, user_id: int) -> None:
+    # Обычно поддерево нового пользователя пустое, но у повторно
+    # зарегистрированного остаются приглашённые из прошлой жизни
+    invited, downline, depth = conn.execute(
+        f"{_DESCENDANTS} SELECT COALESCE(SUM(distance = 1), 0), COUNT(*), COALESCE(MAX(distance), 0) FROM down",
+        (user_id,),
+    ).fetchone()
+    conn.execute(
+        "INSERT OR REPLACE INTO referral_stats (user_id, invited, downline, depth) VALUES (?, ?, ?, ?)",
+        (user_id, invited, downline, depth),
+    )
+    if invited:
+        conn.execute("UPDATE users SET referrals_count = ? WHERE user_id = ?", (invited, user_id))
+
+    conn.execute(
+        f"""{_ANCESTORS}
+        UPDATE referral_stats SET
+            invited = invited + (up.distance = 1),
+            downline = downline + ?,
+            depth = MAX(depth, up.distance + ?)
+        FROM up WHERE referral_stats.user_id = up.user_id
+        """,
+        (user_id, downline + 1, depth),
+    )
+
+
+# Вызывается в транзакции перед удалением пользователя из users.
+# Его поддерево перестаёт считаться у предков, а прямой реферер теряет одного приглашённого.
+# Возвращает id прямого реферера, если он есть
+def user_deleted(conn: sqlite3.Connection, user_id: int) -> Optional[int]:
+    row = conn.execute("SELECT downline, depth FROM referral_stats WHERE user_id = ?", (user_id,)).fetchone()
+    downline, depth = row or (0, 0)
+    ancestors = conn.execute(
+        f"{_ANCESTORS} SELECT up.user_id, up.distance, rs.depth FROM up "
+        "JOIN referral_stats rs ON rs.user_id = up.user_id ORDER BY up.distance",
+        (user_id,),
+    ).fetchall()
+    conn.execute("DELETE FROM referral_stats WHERE user_id = ?", (user_id,))
+    if not ancestors:
+        return None
+
+    referrer_id = ancestors[0][0]
+    conn.execute("UPDATE users SET referrals_count = MAX(referrals_count - 1, 0) WHERE user_id = ?", (referrer_id,))
+    conn.execute(
+        f"""{_ANCESTORS}
+        UPDATE referral_stats SET
+            invited = invited - (up.distance = 1),
+            downline = downline - ?
+        FROM up WHERE referral_stats.user_id = up.user_id
+        """,
+        (user_id, downline + 1),
+    )
+
+    # Глубину нельзя просто уменьшить: пересчитываем её снизу вверх по детям,
+    # пока удалённая ветка могла быть самой длинной
+    for ancestor_id, distance, ancestor_depth in ancestors:
+        if ancestor_depth != distance + depth:
+            break
+        new_depth = conn.execute(
+            "SELECT COALESCE(MAX(rs.depth + 1), 0) FROM users u JOIN referral_stats rs USING (user_id) "
+            "WHERE u.referrer_id = ? AND u.user_id != ?",
+            (ancestor_id, user_id),
+        ).fetchone()[0]
+        if new_depth == ancestor_depth:
+            break
+        conn.execute("UPDATE referral_stats SET depth = ? WHERE user_id = ?", (new_depth, ancestor_id))
+    return referrer_id
+
+
+# Пересчитывает сводку по всему дереву во временную таблицу referral_expected
+def _compute_expected(conn: sqlite3.Connection) -> None:
+    conn.execute("DROP TABLE IF EXISTS temp.referral_expected")
+    conn.execute(f"""
+        CREATE TEMP TABLE referral_expected AS
+        WITH RECURSIVE closure(ancestor, user_id, distance) AS (
+            SELECT u.referrer_id, u.user_id, 1 FROM users u JOIN users r ON r.user_id = u.referrer_id
+            UNION ALL
+            SELECT r.referrer_id, c.user_id, c.distance + 1 FROM closure c
+            JOIN users r ON r.user_id = c.ancestor
+            JOIN users rr ON rr.user_id = r.referrer_id
+            WHERE c.distance < {MAX_DEPTH}
+        ),
+        totals(user_id, invited, downline, depth) AS (
+            SELECT ancestor, SUM(distance = 1), COUNT(*), MAX(distance) FROM closure GROUP BY ancestor
+        )
+        SELECT u.user_id AS user_id,
+               COALESCE(t.invited, 0) AS invited,
+               COALESCE(t.downline, 0) AS downline,
+               COALESCE(t.depth, 0) AS depth
+        FROM users u LEFT JOIN totals t ON t.user_id = u.user_id
+    """)
+
+
+# Проверка согласованности: сравнивает referral_stats и users.referrals_count
+# с полным пересчётом и при repair=True заменяет их одной транзакцией.
+# Возвращает (расхождений в referral_stats, расхождений в referrals_count)
+def rebuild_referral_stats(conn: sqlite3.Connection, repair: bool = True) -> Tuple[int, int]:
+    _compute_expected(conn)
+    stats_drift = conn.execute("""
+        SELECT COUNT(DISTINCT user_id) FROM (
+            SELECT user_id FROM (
+                SELECT user_id, invited, downline, depth FROM referral_expected
+                EXCEPT SELECT user_id, invited, downline, depth FROM referral_stats
+            )
+            UNION ALL
+            SELECT user_id FROM (
+                SELECT user_id, invited, downline, depth FROM referral_stats
+                EXCEPT SELECT user_id, invited, downline, depth FROM referral_expected
+            )
+        )
+    """).fetchone()[0]
+    count_drift = conn.execute("""
+        SELECT COUNT(*) FROM users u JOIN referral_expected e USING (user_id)
+        WHERE u.referrals_count IS NOT e.invited
+    """).fetchone()[0]
+
+    if repair and stats_drift:
+        conn.execute("DELETE FROM referral_stats")
+        conn.execute(
+            "INSERT INTO referral_stats (user_id, invited, downline, depth) "
+            "SELECT user_id, invited, downline, depth FROM referral_expected"
+        )
+    if repair and count_drift:
+        conn.execute("""
+            UPDATE users SET referrals_count = e.invited FROM referral_expected e
+            WHERE e.user_id = users.user_id AND users.referrals_count IS NOT e.invited
+        """)
+    conn.execute("DROP TABLE temp.referral_expected")
+    if stats_drift or count_drift:
+        logging.warning(
+            "Реферальная статистика расходилась: %d строк referral_stats, %d счётчиков referrals_count%s",
+            stats_drift, count_drift, " (исправлено)" if repair else "",
+        )
+    return stats_drift, count_drift
+
+
+def get_referral_stats(conn: sqlite3.Connection, user_id: int) -> Optional[ReferralStats]:
+    row = conn.execute(
+        f"SELECT {STATS_COLUMNS} FROM referral_stats rs JOIN users u USING (user_id) WHERE rs.user_id = ?",
+        (user_id,),
+    ).fetchone()
+    return ReferralStats(*row) if row else None
+
+
+def top_referrers(conn: sqlite3.Connection, limit: int) -> List[ReferralStats]:
+    rows = conn.execute(
+        f"SELECT {STATS_COLUMNS} FROM referral_stats rs JOIN users u USING (user_id) "
+        "WHERE rs.downline > 0 ORDER BY rs.downline DESC, rs.invited DESC LIMIT ?",
+        (limit,),
+    )
+    return [ReferralStats(*row) for row in rows]
+
+
+# Верхние уровни дерева пользователя: на каждом уровне не больше per_node
+# самых крупных веток, размеры веток берутся из referral_stats
+def referral_tree(conn: sqlite3.Connection, user_id: int, levels: int, per_node: int) -> Optional[ReferralNode]:
+    root_stats = get_referral_stats(conn, user_id)
+    if root_stats is None:
+        return None
+    root = ReferralNode(root_stats)
+    frontier = [root]
+    for _ in range(levels):
+        next_frontier = []
+        for node in frontier:
+            if not node.stats.invited:
+                continue
+            rows = conn.execute(
+                f"SELECT {STATS_COLUMNS} FROM users u JOIN referral_stats rs USING (user_id) "
+                "WHERE u.referrer_id = ? ORDER BY rs.downline DESC, rs.user_id LIMIT ?",
+                (node.stats.user_id, per_node),
+            )
+            node.children = [ReferralNode(ReferralStats(*row)) for row in rows]
+            node.hidden = node.stats.invited - len(node.children)
+            next_frontier.extend(node.children)
+        frontier = next_frontier
+    return root
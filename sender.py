@@ -0,0 +1,230 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError,
+)
+from aiogram.methods import SendMessage, TelegramMethod
+
+
+# Элемент очереди: метод, future для результата, номер попытки и признак того,
+# что отправка уже начата (после этого сообщение могло дойти, отменять её нельзя)
+class _Job:
+    __slots__ = ("method", "future", "attempt", "started")
+
+    def __init__(self, method: TelegramMethod, future: asyncio.Future):
+        self.method = method
+        self.future = future
+        self.attempt = 0
+        self.started = False
+
+
+def _consume_exception(future: asyncio.Future) -> None:
+    # Ошибки доставки уже залогированы; не даём asyncio ругаться на неполученное исключение
+    if not future.cancelled():
+        future.exception()
+
+
+# Центральная очередь исходящих сообщений.
+# Соблюдает общий лимит Telegram (~30 сообщений в секунду) и лимит на один чат
+# (1 сообщение в секунду в личке, 20 в минуту в группе), сохраняет порядок сообщений
+# внутри чата, при RetryAfter ставит отправку на паузу, а сетевые и 5xx ошибки
+# повторяет с экспоненциальной задержкой и джиттером.
+class MessageScheduler:
+    def __init__(
+        self,
+        bot: Bot,
+        rate: float = 30,
+        private_interval: float = 1.0,
+        group_interval: float = 3.0,
+        max_retries: int = 5,
+        max_in_flight: int = 30,
+    ):
+        self.bot = bot
+        self.rate = rate
+        self.private_interval = private_interval
+        self.group_interval = group_interval
+        self.max_retries = max_retries
+        self.max_in_flight = max_in_flight
+        self._chats: Dict[Any, Deque[_Job]] = {}
+        self._heap: List[Tuple[float, int, Any]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task: Optional[asyncio.Task] = None
+        self._in_flight: set = set()
+        self._jobs: Dict[asyncio.Future, _Job] = {}
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.flood_waits = 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _loop_time(self) -> float:
+        return asyncio.get_running_loop().time()
+
+    def _chat_interval(self, chat_id: Any) -> float:
+        return self.group_interval if isinstance(chat_id, int) and chat_id < 0 else self.private_interval
+
+    def _schedule(self, chat_id: Any, ready_at: float) -> None:
+        heapq.heappush(self._heap, (ready_at, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    # Поставить метод в очередь; возвращает future с результатом, ждать его не обязательно
+    def submit(self, method: TelegramMethod) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        chat_id = getattr(method, "chat_id", None)
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+            self._schedule(chat_id, self._loop_time())
+        job = self._jobs[future] = _Job(method, future)
+        queue.append(job)
+        self._pending += 1
+        self._idle.clear()
+        return future
+
+    def send_message(self, chat_id: Any, text: str, **kwargs: Any) -> asyncio.Future:
+        return self.submit(SendMessage(chat_id=chat_id, text=text, **kwargs))
+
+    # Начата ли отправка по future из submit. Отменять можно только не начатые:
+    # начатая уже могла дойти до получателя, и её результат надо дождаться
+    def started(self, future: asyncio.Future) -> bool:
+        job = self._jobs.get(future)
+        return job.started if job is not None else future.done()
+
+    async def start(self) -> None:
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._task = asyncio.create_task(self._run())
+
+    # Дожидается отправки очереди (не дольше timeout) и останавливает планировщик
+    async def close(self, timeout: float = 10) -> None:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Очередь отправки не опустела за %s с, осталось %d сообщений", timeout, self._pending)
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for task in list(self._in_flight):
+            task.cancel()
+        await asyncio.gather(*self._in_flight, return_exceptions=True)
+        for job in self._jobs.values():
+            job.future.cancel()
+        self._jobs.clear()
+        self._chats.clear()
+        self._heap.clear()
+
+    async def _run(self) -> None:
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            ready_at, _, chat_id = self._heap[0]
+            now = self._loop_time()
+            delay = max(ready_at, self._next_slot, self._paused_until) - now
+            if delay > 0:
+                # Новое сообщение может оказаться готовым раньше - просыпаемся и по нему
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            job = self._chats[chat_id].popleft()
+            if job.future.cancelled():
+                # Отправитель передумал (например, рассылку остановили) - пропускаем
+                self._done(job)
+                self._reschedule(chat_id, now)
+                continue
+
+            # До ожидания слота: с этого момента отправку уже не отменяют
+            job.started = True
+            await self._slots.acquire()
+            self._next_slot = max(now, self._next_slot) + 1 / self.rate
+            task = asyncio.create_task(self._send(chat_id, job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, chat_id: Any, job: _Job) -> None:
+        retry_at = None
+        try:
+            result = await self.bot(job.method)
+        except TelegramRetryAfter as e:
+            # Флуд-контроль: приостанавливаем все отправки и повторяем это же сообщение
+            self.flood_waits += 1
+            retry_at = self._loop_time() + e.retry_after
+            self._paused_until = max(self._paused_until, retry_at)
+            logging.warning("Флуд-контроль Telegram, пауза %s с (чат %s)", e.retry_after, chat_id)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            job.attempt += 1
+            if job.attempt > self.max_retries:
+                self._fail(job, e)
+            else:
+                self.retried += 1
+                delay = min(30.0, 0.5 * 2 ** job.attempt) * random.uniform(0.5, 1.5)
+                retry_at = self._loop_time() + delay
+                logging.info("Повтор отправки в чат %s через %.1f с: %s", chat_id, delay, e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.sent += 1
+            self._done(job)
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._slots.release()
+
+        if retry_at is not None:
+            self._chats[chat_id].appendleft(job)
+        self._reschedule(chat_id, max(self._loop_time() + self._chat_interval(chat_id), retry_at or 0))
+
+    def _reschedule(self, chat_id: Any, ready_at: float) -> None:
+        if self._chats[chat_id]:
+            self._schedule(chat_id, ready_at)
+        else:
+            del self._chats[chat_id]
+
+    def _fail(self, job: _Job, error: Exception) -> None:
+        self.failed += 1
+        # Пользователь, заблокировавший бота, - обычная ситуация, а не сбой
+        level = logging.INFO if isinstance(error, TelegramForbiddenError) else logging.WARNING
+        logging.log(level, "Не удалось отправить %s: %s", type(job.method).__name__, error)
+        self._done(job)
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def _done(self, job: _Job) -> None:
+        self._jobs.pop(job.future, None)
+        self._pending -= 1
+        if not self._pending:
+            self._idle.set()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": self._pending,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "flood_waits": self.flood_waits,
+        }
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import signal
+import time
+from contextlib import suppress
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import GetUpdates, TelegramMethod
+from aiogram.types import Update
+from aiogram.utils.backoff import Backoff, BackoffConfig
+
+from metrics import Metrics
+
+POLLING_BACKOFF = BackoffConfig(min_delay=1.0, max_delay=5.0, factor=1.3, jitter=0.1)
+
+
+# Ключ полосы: отправитель апдейта, если его нет - чат, иначе сам апдейт
+def lane_key(update: Update) -> int:
+    event = update.event
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return chat.id
+    return update.update_id
+
+
+# Обработка апдейтов фиксированным числом воркеров ("полос").
+# Апдейты одного пользователя всегда попадают в одну полосу и обрабатываются строго
+# по очереди, поэтому два апдейта одного пользователя не гоняются друг с другом
+# (например, в add_user); разные пользователи обрабатываются параллельно.
+# Всего в очередях и в обработке не больше queue_size апдейтов: когда лимит
+# исчерпан, put ждёт, и цикл getUpdates не запрашивает новые (backpressure).
+class UpdateLanes:
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        workers: int = 64,
+        queue_size: int = 1000,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.workers = workers
+        self.queue_size = queue_size
+        self.metrics = metrics
+        self._lanes: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.queued = 0
+        self.processed = 0
+        self.stalls = 0
+
+    # Апдейты в очередях и в обработке
+    @property
+    def depth(self) -> int:
+        return self.queued
+
+    async def start(self) -> None:
+        self._slots = asyncio.Semaphore(self.queue_size)
+        self._lanes = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(lane)) for lane in self._lanes]
+
+    # Ставит апдейт в его полосу; ждёт, если очередь заполнена
+    async def put(self, update: Update) -> None:
+        if self._slots.locked():
+            self.stalls += 1
+        await self._slots.acquire()
+        self.queued += 1
+        self._lanes[lane_key(update) % self.workers].put_nowait((update, time.perf_counter()))
+
+    async def _worker(self, lane: asyncio.Queue) -> None:
+        while True:
+            update, queued_at = await lane.get()
+            try:
+                if self.metrics:
+                    self.metrics.observe_wait(update.event_type, time.perf_counter() - queued_at)
+                await self._process(update)
+            finally:
+                self.queued -= 1
+                self.processed += 1
+                self._slots.release()
+                lane.task_done()
+
+    async def _process(self, update: Update) -> None:
+        try:
+            response = await self.dispatcher.feed_update(self.bot, update)
+            # Как и в polling aiogram: метод, возвращённый обработчиком, выполняется как ответ
+            if isinstance(response, TelegramMethod):
+                await self.dispatcher.silent_call_request(self.bot, response)
+        except Exception:
+            logging.exception("Ошибка обработки апдейта %s", update.update_id)
+
+    # Дожидается обработки уже принятых апдейтов (не дольше timeout) и останавливает воркеров
+    async def close(self, timeout: float = 30) -> None:
+        if not self._tasks:
+            return
+        if self.queued:
+            logging.info("Ждём обработки %d апдейтов из очереди", self.queued)
+            try:
+                await asyncio.wait_for(asyncio.gather(*(lane.join() for lane in self._lanes)), timeout)
+            except asyncio.TimeoutError:
+                logging.warning("Не дождались обработки %d апдейтов", self.queued)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": self.queued,
+            "capacity": self.queue_size,
+            "busiest_lane": max((lane.qsize() for lane in self._lanes), default=0),
+            "processed": self.processed,
+            "stalls": self.stalls,
+        }
+
+
+# Цикл getUpdates, который кладёт апдейты в полосы. Смещение подтверждается только
+# после того, как апдейт принят в очередь, поэтому при заполненной очереди новые
+# апдейты не запрашиваются, а не принятые до остановки придут при следующем запуске
+async def _poll(bot: Bot, lanes: UpdateLanes, polling_timeout: int, allowed_updates: Optional[List[str]]) -> None:
+    backoff = Backoff(config=POLLING_BACKOFF)
+    get_updates = GetUpdates(timeout=polling_timeout, allowed_updates=allowed_updates)
+    # Таймаут запроса должен быть больше времени long polling
+    request_timeout = int(bot.session.timeout + polling_timeout)
+    while True:
+        try:
+            updates: Tuple[Update, ...] = await bot(get_updates, request_timeout=request_timeout)
+        except Exception as e:
+            logging.error("Не удалось получить апдейты (%s: %s), повтор через %.1f с",
+                          type(e).__name__, e, backoff.next_delay)
+            await backoff.asleep()
+            continue
+        backoff.reset()
+        for update in updates:
+            await lanes.put(update)
+            get_updates.offset = update.update_id + 1
+
+
+# Long polling через полосы вместо dp.start_polling: запускает startup-колбэки диспетчера,
+# работает до SIGTERM/SIGINT, дожидается обработки очереди и вызывает shutdown-колбэки.
+# Очередь дорабатывается до emit_shutdown: первым shutdown-колбэком aiogram закрывает
+# хранилище FSM, а обработчикам из очереди оно ещё нужно
+async def run_polling(dispatcher: Dispatcher, bot: Bot, lanes: UpdateLanes, polling_timeout: int = 10) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    await dispatcher.emit_startup(dispatcher=dispatcher, bot=bot, bots=[bot])
+    user = await bot.me()
+    logging.info("Polling @%s: %d полос, очередь до %d апдейтов", user.username, lanes.workers, lanes.queue_size)
+    poller = asyncio.create_task(
+        _poll(bot, lanes, polling_timeout, dispatcher.resolve_used_update_types())
+    )
+    stopped = asyncio.create_task(stop.wait())
+    try:
+        done, _ = await asyncio.wait({poller, stopped}, return_when=asyncio.FIRST_COMPLETED)
+        if poller in done:
+            poller.result()
+    finally:
+        for task in (poller, stopped):
+            task.cancel()
+        await asyncio.gather(poller, stopped, return_exceptions=True)
+        logging.info("Polling остановлен")
+        try:
+            try:
+                await lanes.close()
+            finally:
+                await dispatcher.emit_shutdown(dispatcher=dispatcher, bot=bot, bots=[bot])
+        finally:
+            await bot.session.close()
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import secrets
+import signal
+from contextlib import suppress
+from typing import Any, Optional, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from aiohttp.abc import Application
+
+from update_lanes import UpdateLanes
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# Приём апдейтов через вебхук: проверяет секретный токен, сразу отвечает Telegram 200
+# и обрабатывает апдейт в фоне. При остановке новые апдейты получают 503
+# (Telegram пришлёт их повторно), а уже начатые обработчики дорабатывают до конца.
+# С lanes апдейт ставится в полосу пользователя; пока очередь полос заполнена,
+# ответ Telegram задерживается, и он сам снижает частоту доставки.
+class WebhookHandler(SimpleRequestHandler):
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        secret_token: Optional[str] = None,
+        drain_timeout: float = 30,
+        lanes: Optional[UpdateLanes] = None,
+        **data: Any,
+    ):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **data)
+        self.secret_token = secret_token
+        self.drain_timeout = drain_timeout
+        self.lanes = lanes
+        self._tasks: Set[asyncio.Task] = set()
+        self._closing = False
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    def register(self, app: Application, /, path: str, **kwargs: Any) -> None:
+        app.router.add_route("POST", path, self.handle, **kwargs)
+        # Ждём обработчики раньше остальных shutdown-колбэков (закрытия БД и очереди отправки)
+        app.on_shutdown.append(self._drain)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token and not secrets.compare_digest(
+            request.headers.get(SECRET_HEADER, ""), self.secret_token
+        ):
+            logging.warning("Вебхук: запрос с неверным секретным токеном от %s", request.remote)
+            raise web.HTTPUnauthorized()
+        if self._closing:
+            raise web.HTTPServiceUnavailable()
+
+        update = await request.json(loads=self.bot.session.json_loads)
+        if self.lanes:
+            await self.lanes.put(Update(**update))
+            return web.Response()
+        task = asyncio.create_task(self._feed(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _feed(self, update: dict) -> None:
+        try:
+            await self._background_feed_update(bot=self.bot, update=update)
+        except Exception:
+            logging.exception("Вебхук: ошибка обработки апдейта %s", update.get("update_id"))
+
+    async def _drain(self, app: Application) -> None:
+        self._closing = True
+        if self.lanes:
+            # До shutdown-колбэков диспетчера: первым из них aiogram закрывает хранилище FSM
+            await self.lanes.close(self.drain_timeout)
+        if not self._tasks:
+            return
+        logging.info("Вебхук: ждём завершения %d обработчиков", len(self._tasks))
+        done, pending = await asyncio.wait(set(self._tasks), timeout=self.drain_timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logging.warning("Вебхук: %d обработчиков не успели завершиться и отменены", len(pending))
+
+    async def close(self) -> None:
+        await self.bot.session.close()
+
+
+# Запускает aiohttp-сервер с вебхуком и работает до SIGTERM/SIGINT.
+# URL и секрет обязательны: все процессы за балансировщиком должны устанавливать
+# один и тот же вебхук с одним секретом, иначе последний set_webhook выигрывает,
+# а остальные процессы отвечают 401 на все апдейты
+async def run_webhook(
+    dispatcher: Dispatcher,
+    bot: Bot,
+    base_url: Optional[str],
+    path: str = "/webhook",
+    secret_token: Optional[str] = None,
+    host: str = "0.0.0.0",
+    port: int = 8080,
+    lanes: Optional[UpdateLanes] = None,
+) -> None:
+    # Проверяем до запуска приложения, то есть до открытия базы и очереди отправки
+    if not base_url:
+        raise ValueError("WEBHOOK_URL must be set in webhook mode")
+    if not secret_token:
+        raise ValueError("WEBHOOK_SECRET must be set in webhook mode (the same value in every process)")
+
+    app = web.Application()
+    handler = WebhookHandler(dispatcher, bot, secret_token=secret_token, lanes=lanes)
+    handler.register(app, path=path)
+    setup_application(app, dispatcher, bot=bot)
+
+    async def set_webhook(_: Application) -> None:
+        await bot.set_webhook(
+            base_url.rstrip("/") + path,
+            secret_token=secret_token,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+        logging.info("Вебхук установлен: %s%s", base_url.rstrip("/"), path)
+
+    async def close_session(_: Application) -> None:
+        await handler.close()
+
+    app.on_startup.append(set_webhook)
+    app.on_cleanup.append(close_session)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logging.info("Вебхук-сервер слушает %s:%d", host, port)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()